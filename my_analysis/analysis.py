@@ -1,100 +1,194 @@
-from importlib import reload
+from importlib import reload, import_module
 
 import pandas as pd
 
 from nowpipes import Pipeline, pipe
 
 from helpers import (delete_file_if_exists, make_org_report_fname,
-                     make_correlation_table, top_effects_table)
+                     label_correlation_table, top_effects_table)
+
+from dump import build_tables, write_dump
 
 import config
 
+# Modules that stages import inside their functions. Importing a module
+# for the first time from several threads at once can deadlock, so these
+# are imported before the stages run concurrently.
+STAGE_IMPORTS = ('scipy.stats', 'scipy.sparse', 'semopy')
 
-@pipe
-def results(**p):
-    """
-    Compute results.
-    """
-    import helpers
+
+def analysis_parts():
+    """The modules with the stages of the analysis, in order."""
     import prepare_data
     import benchmark
     import models
     import rankings
     import prev
     import entities
+    import bootstrap
 
-    reload(helpers)
-    reload(prepare_data)
-    reload(benchmark)
-    reload(models)
-    reload(rankings)
-    reload(prev)
-    reload(entities)
+    return (prepare_data, benchmark, models, rankings, prev, entities,
+            bootstrap)
+
+
+@pipe
+def results(**p):
+    """
+    Compute results.
+    """
+    import helpers
+    import stages
+    import profiler
+    import memo
+    import dag
+    import snapshot
+
+    # Reload modules that changed during an interactive session
+    if p.get('reload', False):
+        reload(helpers)
+        for part in analysis_parts():
+            reload(part)
+        reload(stages)
+        reload(profiler)
+        reload(memo)
+        reload(dag)
+        reload(snapshot)
 
     # Make pipeline
     analysis = Pipeline()
     analysis_config = config.analysis
     analysis.config(**analysis_config)
 
+    # The analysis parts
+    parts = analysis_parts()
+
+    # Profile every stage if requested
+    stage_profiler = None
+    if p.get('profile', False):
+        stage_profiler = profiler.StageProfiler(p['outputdir'],
+                                                p.get('cprofile', False))
+
+    # Reuse results of stages that did not change since the previous run
+    stage_cache = None
+    if analysis_config.get('memoize', False):
+        stage_cache = memo.StageCache(p['outputdir'],
+                                      p.get('recompute', False))
+
+    hook = None
+    if stage_profiler is not None or stage_cache is not None:
+        hook = stages.chain_hooks(stage_profiler, stage_cache)
+
     # Add analysis parts and run analysis
-    analysis.add(prepare_data, benchmark, models, rankings,
-                 prev, entities)
-    analysis.run(verbose=True, indent=1)
+    workers = analysis_config.get('stage_workers', 1)
+    if workers > 1:
+        # Run independent stages concurrently, following the dependency
+        # graph of the stages. The pipeline only collects their results.
+        for name in STAGE_IMPORTS:
+            import_module(name)
+        all_stages = [stage for part in parts
+                      for stage in stages.pipe_stages(part)]
+        computed = dag.run_stages(all_stages, analysis_config, hook, workers)
+        analysis.add(*stages.hooked_stages(parts, dag.computed_hook(computed)))
+        analysis.run(verbose=False)
+    else:
+        if hook is not None:
+            analysis.add(*stages.hooked_stages(parts, hook))
+        else:
+            analysis.add(*parts)
+        analysis.run(verbose=True, indent=1)
+
+    if stage_cache is not None:
+        stage_cache.summary()
+    if stage_profiler is not None:
+        stage_profiler.write()
+
+    # Write the results, so that reports can be made without running the
+    # analysis again (see run.py). The analyze command always writes them.
+    if p.get('snapshot', False) or analysis_config.get('snapshot', False):
+        path = snapshot.write_snapshot(analysis.results, p['outputdir'])
+        print(f" Results snapshot in: {path}")
 
     return analysis
 
 
-@pipe
-def output_files(results, **p):
+def dump_tables(r):
     """
-    Make a data dump to excel.
+    The tables of the data dump as (sheet name, function) pairs. The
+    functions make the tables from the results r (see dump.build_tables()).
     """
     # TODO: account for different nestings enabled/disabled
-    fname = p['outputdir'] + make_org_report_fname('_dump') + '.xlsx'
-    delete_file_if_exists(fname)
-
-    writer = pd.ExcelWriter(fname)
-
-    r = results
-
-    r.nesting.team.to_excel(writer, sheet_name='team_names')
-    r.data.hr.to_excel(writer, sheet_name='hrdata')
-    r.aggregate.org.to_excel(writer, sheet_name='mean_org')
-    r.aggregate.team.to_excel(writer, sheet_name='mean_team')
-    r.r10.org.to_excel(writer, sheet_name='r10_org')
-    r.r10.team.to_excel(writer, sheet_name='r10_team')
-    r.growth.team.to_excel(writer, sheet_name='growth_team')
-    r.growth_descriptives.team.to_excel(writer, sheet_name='gdesc_team')
-    r.excellent.team.to_excel(writer, sheet_name='excel_team')
-    r.data.rm.to_excel(writer, sheet_name='rmmodel')
-    r.models.all.ivstats.to_excel(writer, sheet_name='allmodels')
-    r.prev.org.to_excel(writer, sheet_name='prev_org')
-    r.prev.team.to_excel(writer, sheet_name='prev_team')
-    r.prev.functie.to_excel(writer, sheet_name='prev_func')
-
-    # r.nesting.unit.to_excel(writer, sheet_name='unit_names')
-    # r.aggregate.unit.to_excel(writer, sheet_name='mean_unit')
-    # r.r10.unit.to_excel(writer, sheet_name='r10_unit')
-
-    r.nesting.onderdeel.to_excel(writer, sheet_name='onderdeel_names')
-    r.aggregate.onderdeel.to_excel(writer, sheet_name='mean_onderdeel')
-    r.r10.onderdeel.to_excel(writer, sheet_name='r10_onderdeel')
-
-    signs_df = pd.concat(r.signs.by_dvcluster)
-    signs_df.to_excel(writer, sheet_name='signs')
-
-    df = r.data.use[r.research_model.grade_name]
-    names = r.glossary[['name']]
-    corrs = make_correlation_table(df, names)
-    corrs.to_excel(writer, sheet_name='correlations')
-
-    topeffects = top_effects_table(r)
-    topeffects.to_excel(writer, sheet_name='top_effects')
+
+    def correlations(stat, round):
+        names = r.glossary[['name']]
+        return label_correlation_table(r.correlations[stat], names, round)
+
+    builders = [
+        ('team_names', lambda: r.nesting.team),
+        ('hrdata', lambda: r.data.hr),
+        ('mean_org', lambda: r.aggregate.org),
+        ('mean_team', lambda: r.aggregate.team),
+        ('r10_org', lambda: r.r10.org),
+        ('r10_team', lambda: r.r10.team),
+        ('growth_team', lambda: r.growth.team),
+        ('gdesc_team', lambda: r.growth_descriptives.team),
+        ('excel_team', lambda: r.excellent.team),
+        ('rmmodel', lambda: r.data.rm),
+        ('reliability', lambda: r.reliability.scales),
+        ('reliability_items', lambda: r.reliability['items']),
+        ('allmodels', lambda: r.models.all.ivstats),
+        ('prev_org', lambda: r.prev.org),
+        ('prev_team', lambda: r.prev.team),
+        ('prev_func', lambda: r.prev.functie),
+
+        # ('unit_names', lambda: r.nesting.unit),
+        # ('mean_unit', lambda: r.aggregate.unit),
+        # ('r10_unit', lambda: r.r10.unit),
+
+        ('onderdeel_names', lambda: r.nesting.onderdeel),
+        ('mean_onderdeel', lambda: r.aggregate.onderdeel),
+        ('r10_onderdeel', lambda: r.r10.onderdeel),
+
+        ('signs', lambda: pd.concat(r.signs.by_dvcluster)),
+        ('correlations', lambda: correlations('corr', 2)),
+        ('correlations_p', lambda: correlations('p', 4)),
+        ('correlations_n', lambda: correlations('n', 0)),
+        ('top_effects', lambda: top_effects_table(r))
+    ]
+
+    builders.append(('agreement', lambda: pd.concat(
+        r.agreement.icc, names=['nesting', None]).reset_index('nesting')))
+    for n in r.agreement.rwg:
+        builders.append(('rwg_' + n, lambda n=n: r.agreement.rwg[n]))
+
+    for n in r.entity_models.ivstats:
+        builders.append(('entity_ivstats_' + n,
+                         lambda n=n: r.entity_models.ivstats[n]))
+
+    # The bootstrap is optional (see the bootstrap_resamples parameter)
+    builders.append(('bootstrap_weights', lambda: r.bootstrap.get('summary')))
+    for n in r.bootstrap.get('frequency', {}):
+        builders.append(('bootstrap_' + n,
+                         lambda n=n: r.bootstrap.frequency[n]))
 
     for modname in r.models.all.table['model'].unique():
-        r.models[modname].table.to_excel(writer, modname)
+        builders.append((modname,
+                         lambda modname=modname: r.models[modname].table))
 
-    writer.save()
+    return builders
+
+
+@pipe
+def output_files(results, **p):
+    """
+    Make a data dump to excel (one sheet per table) or parquet (one file per
+    table), see the dump_format parameter. Tables are made concurrently.
+    """
+    fname = p['outputdir'] + make_org_report_fname('_dump')
+    dump_format = p.get('dump_format', 'xlsx')
+    delete_file_if_exists(fname + '.xlsx')
+
+    tables = build_tables(dump_tables(results))
+    write_dump(tables, fname, dump_format)
 
 
 @pipe
@@ -103,7 +197,8 @@ def output_dataset(results, **p):
     Generate the questionnaire dataset with all additional computed results
     from the analyses (scale means, grade scores, etc.).
     """
-    fname = p['outputdir'] + make_org_report_fname('_dataset') + '.xlsx'
-    delete_file_if_exists(fname)
-    dataset = results.data.all
-    dataset.to_excel(fname)
+    fname = p['outputdir'] + make_org_report_fname('_dataset')
+    dump_format = p.get('dump_format', 'xlsx')
+    delete_file_if_exists(fname + '.xlsx')
+
+    write_dump([('dataset', results.data.all)], fname, dump_format)
@@ -2,11 +2,34 @@ import argparse
 
 parser = argparse.ArgumentParser(description='Run analysis and generate reports.')
 
+# What to run: the analysis and reports, only the analysis (which writes a
+# snapshot of the results), or only the reports from a snapshot
+parser.add_argument('command', nargs='?', choices=('all', 'analyze', 'report'),
+                    help='all (default): run the analysis and make reports; '
+                         'analyze: only run the analysis; report: make '
+                         'reports from the results snapshot of a previous '
+                         'analysis',
+                    default='all')
+
+# Snapshot to make reports from
+parser.add_argument('--snapshot', dest='snapshot',
+                    help='The snapshot directory to make reports from '
+                         '(default: the snapshot in the output directory)',
+                    default=None)
+
 # Switch whether to make an excel data dump or not
 parser.add_argument('-p', '--dump', dest='dodump', action='store_true',
                     help='Write an excel data dump of the results',
                     default=False)
 
+# Format of the data dump and dataset
+parser.add_argument('--dump-format', dest='dump_format',
+                    choices=('xlsx', 'parquet'),
+                    help='Write the data dump and dataset as one excel file '
+                         '(xlsx, default) or as a directory with a parquet '
+                         'file per table (parquet)',
+                    default='xlsx')
+
 # Switch where to output a dataset file or not
 parser.add_argument('-d', '--dataset', dest='dodataset', action='store_true',
                     help='Write the dataset with results of analyses',
@@ -16,3 +39,29 @@ parser.add_argument('-d', '--dataset', dest='dodataset', action='store_true',
 parser.add_argument('-n', '--nestings', dest='nestings', nargs='+',
                     help='Nestings to generate reports for',
                     default=['org', 'team', 'functie'])
+
+# Switch whether to reload modules (for interactive sessions)
+parser.add_argument('--reload', dest='reload', action='store_true',
+                    help='Reload the analysis and report modules, to pick up '
+                         'changes made during an interactive session',
+                    default=False)
+
+# Switch whether to profile every stage of the analysis
+parser.add_argument('--profile', dest='profile', action='store_true',
+                    help='Profile every analysis stage (wall time, cpu time, '
+                         'memory, output size) and write the profile to the '
+                         'output directory',
+                    default=False)
+
+# Switch whether to write a cProfile dump for every stage of the analysis
+parser.add_argument('--cprofile', dest='cprofile', action='store_true',
+                    help='With --profile, also write a cProfile dump per '
+                         'stage',
+                    default=False)
+
+# Switch whether to recompute all analysis stages instead of using the results
+# of a previous run (see memo.py)
+parser.add_argument('--recompute', dest='recompute', action='store_true',
+                    help='Recompute every analysis stage, ignoring the '
+                         'results cached by previous runs',
+                    default=False)
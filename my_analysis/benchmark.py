@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 from pandas import DataFrame
@@ -5,7 +6,8 @@ from pandas import DataFrame
 from nowpipes import pipe
 
 from helpers import (scale_var_names, scale_negative_var_names, df_standardize,
-                     score_percentage_multiply)
+                     df_standardize_columns, score_percentage_multiply,
+                     score_percentages)
 
 
 def r10_quantiles(df, varnames, lo, hi, pfx=''):
@@ -38,6 +40,18 @@ def r10_from_quantiles_and_direction(row):
                           row.low10_grade])
 
 
+def r10_by_direction(df):
+    """Vectorized r10_from_quantiles_and_direction() for all rows of df."""
+    positive = (df['direction'] == 'positive').to_numpy()
+    negative = (df['direction'] == 'negative').to_numpy()
+    r = DataFrame(index=df.index)
+    for scale in ('mean', 'grade'):
+        r['r10_' + scale] = np.where(positive, df['high10_' + scale],
+                                     np.where(negative, df['low10_' + scale],
+                                              np.nan))
+    return r
+
+
 def r10_nesting_comparison_values(nesting, r10, research_model):
     """Returns the r10 comparison values for the specified nesting variable."""
     n = nesting
@@ -55,10 +69,11 @@ def r10_nesting_comparison_values(nesting, r10, research_model):
     return g
 
 
-def make_r10_df(df, scores, q_lo, q_hi):
+def make_r10_df(df, scores, q_lo, q_hi, fast=False):
     """
     Make an r10 dataframe based on the base df in r10() and using provided
-    scores.
+    scores. With fast, rows are not processed one by one (see the engine
+    parameter).
     """
     df = df.copy()
 
@@ -72,6 +87,14 @@ def make_r10_df(df, scores, q_lo, q_hi):
                                 pfx='_grade'),
                   left_on='grade_name', right_index=True, how='left')
 
+    if fast:
+        df[['r10_mean', 'r10_grade']] = r10_by_direction(df)
+        df['low10_grade_per'] = score_percentages(df['low10_grade'], 10.0,
+                                                  True)
+        df['high10_grade_per'] = score_percentages(df['high10_grade'], 10.0,
+                                                   True)
+        return df
+
     # Select r10 value based on the direction in basedf
     r10_values = df.apply(r10_from_quantiles_and_direction,
                           axis='columns')
@@ -95,6 +118,8 @@ def r10(research_model, data, nesting, aggregate, **p):
     # are used to determine the high and low r10 comparison standard values.
     q_hi = p['r10_quantile']
     q_lo = 1 - q_hi
+    # Use the vectorized implementation (see the engine parameter)
+    fast = p.get('engine', 'reference') == 'fast'
 
     # Get organization-level means
     org_scores = aggregate.org.transpose()
@@ -112,10 +137,10 @@ def r10(research_model, data, nesting, aggregate, **p):
     basedf['score_mean'] = list(org_scores[mean_vars]['score'])
     basedf['score_grade'] = list(org_scores[grade_vars]['score'])
 
-    r['org'] = make_r10_df(basedf, data.use, q_lo, q_hi)
+    r['org'] = make_r10_df(basedf, data.use, q_lo, q_hi, fast)
 
     for n in p['nestings']:
-        df = make_r10_df(basedf, aggregate[n], q_lo, q_hi)
+        df = make_r10_df(basedf, aggregate[n], q_lo, q_hi, fast)
 
         # NOTE: In porting this function from the equivalent R-code, it was
         # discovered that no code relies on these 'absolute growth potential'
@@ -201,7 +226,10 @@ def zgrowth(growth, research_model, **p):
     varnames = scale_var_names(research_model)
 
     for n in p['nestings']:
-        r[n] = df_standardize(growth[n][varnames], axis='rows')
+        if p.get('engine', 'reference') == 'fast':
+            r[n] = df_standardize_columns(growth[n][varnames])
+        else:
+            r[n] = df_standardize(growth[n][varnames], axis='rows')
 
     return r
 
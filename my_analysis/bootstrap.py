@@ -0,0 +1,158 @@
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from nowpipes import pipe
+
+from helpers import (descending_order, weighted_cross_products,
+                     moments_covariance)
+from models import model_specs, batched_regression
+
+
+# The number of resamples per task of a worker
+BATCH_SIZE = 50
+# The number of respondents whose cross-products are made at once
+CHUNK_ROWS = 2000
+# Methods to weigh growth (see the weigh_growth_by parameter) that can be
+# bootstrapped
+WEIGHTS = ('mean_est', 'max_est')
+
+# The data of a worker process (see init_worker())
+shared = dict()
+
+
+def resample_weights(cov, n, specs, nivs, pval, weigh_by):
+    """
+    The weights of the ivs (see models.model_iv_stats() and
+    models.weighted_growth()) for every resample, from the covariances of the
+    grade scores and number of respondents of the resamples. All resamples
+    of a model are solved at once (like models.cov_regression()).
+    """
+    total = np.zeros((len(cov), nivs))
+    counts = np.zeros(nivs)
+    for ivs, dvs, overall in specs:
+        coefs, p = batched_regression(cov, n, ivs, dvs)
+        # Non-significant estimates are 0 (see models.model_table())
+        estabs = np.abs(np.where(p < pval, coefs, 0))
+        stat = estabs.mean(axis=2) if weigh_by == 'mean_est' else \
+            estabs.max(axis=2)
+        total[:, overall] += stat
+        counts[overall] += 1
+    # The mean over models (see the overall ivstats in models.models())
+    return total / counts
+
+
+def init_worker(data):
+    shared.update(data)
+
+
+def resample_batch(seed, size):
+    """
+    Draw size resamples of the respondents (as multinomial weights), and
+    count per nesting entry how often every iv is among its top advice_n
+    weighted growth potentials. Returns the weights of the ivs per resample
+    and the counts per nesting.
+    """
+    z = shared['z']
+    rng = np.random.default_rng(seed)
+    # How often every respondent is drawn: multinomial weights, counted from
+    # the draws (faster than rng.multinomial())
+    weights = np.stack([np.bincount(rng.integers(0, len(z), len(z)),
+                                    minlength=len(z))
+                        for _ in range(size)]).astype(float)
+
+    n = weights.sum(axis=1)
+    sums, products = weighted_cross_products(z, weights, CHUNK_ROWS)
+    cov = moments_covariance(sums, products, n)
+    iv_weights = resample_weights(cov, n, shared['specs'], shared['nivs'],
+                                  shared['pval'], shared['weigh_by'])
+
+    counts = dict()
+    for nesting, growth in shared['growth'].items():
+        entries, nivs = growth.shape
+        wg = (growth[None, :, :] * iv_weights[:, None, :]).reshape(-1, nivs)
+        top = descending_order(wg)[:, :shared['advice_n']]
+        entry = np.repeat(np.tile(np.arange(entries), size), top.shape[1])
+        counts[nesting] = np.bincount(entry * nivs + top.ravel(),
+                                      minlength=entries * nivs).reshape(
+                                          entries, nivs)
+    return iv_weights, counts
+
+
+@pipe
+def bootstrap(data, research_model, models, growth, weighted_growth, **p):
+    """
+    Stability of the advice: resample respondents (bootstrap_resamples
+    times), estimate all models again from the covariances of every resample
+    and count how often every iv is among the top advice_n weighted growth
+    potentials of a nesting entry. The growth potentials of the entries are
+    kept; the weights of the ivs vary. The models are estimated like the
+    pairwise estimator (see models.cov_regression()), from respondents
+    without missing grade scores. Resamples are spread over
+    bootstrap_workers processes. Turned off (empty results) with 0
+    resamples.
+    """
+    resamples = p.get('bootstrap_resamples', 0)
+    if resamples == 0:
+        return dict()
+
+    weigh_by = p.get('weigh_growth_by', 'mean_est')
+    if weigh_by not in WEIGHTS:
+        raise ValueError(f'Cannot bootstrap weights {weigh_by}, use one ' +
+                         'of: ' + ', '.join(WEIGHTS))
+    advice_n = p.get('advice_n', 5)
+
+    ivs = list(models.overall.ivstats.index)
+    used = set(models.all.table['iv']) | set(models.all.table['dv'])
+    grades = [g for g in research_model['grade_name'] if g in used]
+    specs = [(ivpos, dvpos, [ivs.index(grades[i]) for i in ivpos])
+             for _, ivpos, dvpos in model_specs(models.all.table, grades)]
+
+    # Center the grade scores, so the cross-products keep their precision
+    z = data.use[grades].dropna().to_numpy(dtype=float)
+    z = z - z.mean(axis=0)
+
+    worker_data = dict(
+        z=z, specs=specs, nivs=len(ivs), pval=p['models_p_value'],
+        weigh_by=weigh_by, advice_n=advice_n,
+        growth={n: growth[n][ivs].to_numpy(dtype=float)
+                for n in p['nestings']})
+
+    # Seeds per batch, so results do not depend on the number of workers
+    sizes = [min(BATCH_SIZE, resamples - start)
+             for start in range(0, resamples, BATCH_SIZE)]
+    seeds = np.random.SeedSequence(p.get('bootstrap_seed', 0)).spawn(
+        len(sizes))
+    workers = min(p.get('bootstrap_workers') or os.cpu_count(), len(sizes))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(worker_data,)) as pool:
+        batches = list(pool.map(resample_batch, seeds, sizes))
+
+    iv_weights = DataFrame(np.concatenate([w for w, _ in batches]),
+                           columns=ivs)
+    observed = models.overall.ivstats[weigh_by]
+    r = dict(weights=iv_weights, frequency=dict())
+    r['summary'] = DataFrame({
+        'weight': observed,
+        'mean': iv_weights.mean(),
+        'sd': iv_weights.std(),
+        'low': iv_weights.quantile(.025),
+        'high': iv_weights.quantile(.975)})
+
+    for n in p['nestings']:
+        counts = sum(c[n] for _, c in batches)
+        frequency = DataFrame(counts / resamples, index=growth[n].index,
+                              columns=ivs)
+        # The mean frequency of the ivs in the advice (see entities.advice())
+        top = descending_order(weighted_growth[n][ivs].to_numpy(
+            dtype=float))[:, :advice_n]
+        frequency['stability'] = np.take_along_axis(
+            frequency[ivs].to_numpy(), top, axis=1).mean(axis=1)
+        r['frequency'][n] = pd.concat([growth[n][['value', 'code']],
+                                       frequency], axis='columns')
+
+    return r
@@ -19,6 +19,25 @@ reports = dict(
     # The number of processor cores to uses for parallel execution.
     # Set this to the number of LOGICAL cores in the system.
     multiproc=16,
+    # Pages that are the same for every report in a nesting (e.g., front
+    # matter, model explanations) are laid out only once and spliced into
+    # every pdf.
+    static_pages=True,
+    # Only render pdfs whose contents (html, stylesheets, templates) changed
+    # since the previous run. Unchanged pdfs are linked from a cache in the
+    # output directory (see pdfs.py).
+    incremental=True,
+    # Whether pdfs are also written to a directory next to the zip archive.
+    loose_pdfs=True,
+    # Compression for the zip archives: 'stored', 'deflated', 'bzip2' or
+    # 'lzma'. PDFs barely compress, so storing them is the fastest.
+    zip_compression='stored',
+    # Compression level for 'deflated' and 'bzip2' (None is the default).
+    zip_compresslevel=None,
+    # Log the timings of every report (data gathering, html rendering, pdf
+    # layout and writing) to a JSONL file in the output directory, and print
+    # a summary at the end (see timings.py).
+    log_timings=True,
     # Whether results of a previous comparison year should be displayed
     # in the reports.
     prev=True,
@@ -31,6 +50,43 @@ reports = dict(
 analysis = dict(
     # The directory where data is stored to be read
     datapath="/where/the/input/data/is",
+
+    # Store the result of every analysis stage in the output directory and
+    # reuse it in the next run when its code, the parameters it reads, its
+    # input files and upstream results did not change (see memo.py). The
+    # stored results include the respondent data, in .stagecache/ in the
+    # output directory. Use the --recompute switch to ignore stored results.
+    memoize=False,
+
+    # The number of analysis stages that can run at the same time. With more
+    # than 1, stages that do not depend on each other (e.g., prev and the
+    # models, r10/growth and the models) are run concurrently on a pool of
+    # threads (see dag.py). Stages that modify their arguments in place are
+    # found from their source (see stages.stage_mutates()), so check new
+    # stages with 1 and more workers.
+    stage_workers=1,
+
+    # The implementation of the analysis stages: 'reference' (the original
+    # pandas implementation) or 'fast' (vectorized implementations of r10,
+    # zgrowth, signs, advice, scores and summary that process all nesting
+    # entities or models at once). Use runequiv.py to verify that both give
+    # the same results.
+    engine='reference',
+
+    # Raise an error when a scale has negative inter-item correlations
+    # (usually an item that should be reversed, see the reliability stage),
+    # instead of printing a warning.
+    reliability_strict=False,
+
+    # The precision of the correlations between scales (see the correlations
+    # stage): 'float64', or 'float32' for large datasets.
+    correlation_dtype='float64',
+
+    # Write a snapshot of the analysis results to the output directory, from
+    # which reports can be made without running the analysis again
+    # (python3 run.py report, see snapshot.py). Applies to python3 run.py
+    # (all), python3 run.py analyze always writes a snapshot.
+    snapshot=True,
     # The file with employee data (must be CSV!)
     hrfile="hrfile.csv",
     # The file with the survey responses from qualtrics (must be CSV!)
@@ -85,6 +141,18 @@ analysis = dict(
     # NOTE: .1 is used to be a bit more lenient in practice.
     models_p_value=0.1,
 
+    # How the regression models are estimated: 'sem' (fit every model with
+    # semopy), or from one covariance matrix of all grade scores that uses
+    # incomplete responses: 'pairwise' (pairwise complete observations) or
+    # 'em' (EM algorithm). The latter two report the effective number of
+    # respondents per model (n) and are much faster with many models.
+    models_estimator='sem',
+
+    # Only keep the tables (estimates, stats) of every regression model in the
+    # results, not the semopy model and fit objects. These hold a copy of the
+    # data and optimizer state for every model.
+    slim_models=True,
+
     # Which statistic from the regression models to use to weigh growth
     # potentials. The default is 'mean_est', which means that it uses the
     # the absolute (without positive/negative sign) average regression
@@ -93,6 +161,15 @@ analysis = dict(
     # See models.model_iv_stats() for reference.
     weigh_growth_by='mean_est',
 
+    # Also fit the regression models per entity of these nestings (e.g.,
+    # ('onderdeel',)), for entities with at least entity_models_min_n
+    # respondents (see models.entity_models()). With weigh_growth_by_entity,
+    # the growth potentials of those entities are weighed by their own
+    # ivstats (mean_est or max_est) instead of those of all respondents.
+    entity_model_nestings=(),
+    entity_models_min_n=100,
+    weigh_growth_by_entity=False,
+
     # To compute and advice, weighted growth potentials are weighted
     # and ranked based on their relative contribution. This can be seen as
     # the 'explained variance' of every variable. This cutoff indicates
@@ -123,6 +200,15 @@ analysis = dict(
     # The number of advice entries to display.
     advice_n=3,
 
+    # The number of bootstrap resamples of the respondents, to see how stable
+    # the advice is: how often every iv is among the top advice_n of a
+    # nesting entry (see bootstrap.py). 0 turns the bootstrap off. The
+    # resamples are spread over bootstrap_workers processes (None: all
+    # cores), and are the same for a seed.
+    bootstrap_resamples=0,
+    bootstrap_workers=None,
+    bootstrap_seed=0,
+
     # The number of summary entries to display.
     summary_ivs_high_n=4,
     summary_ivs_low_n=4,
@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from box import Box
+
+
+def stage_dependencies(all_stages):
+    """
+    Derive the dependency graph of stages (in pipeline order) from their
+    arguments. Returns a dict with, per stage name, the names of the stages
+    that have to be finished before it can run:
+
+    - the stages whose results are its arguments,
+    - for stages that modify an argument in place (e.g., scale_means modifies
+      data): the stages before it that read that argument, so they see it
+      unmodified,
+    - for stages that read an argument that an earlier stage modifies: that
+      stage, so they see it modified.
+    """
+    names = set(stage.name for stage in all_stages)
+    deps = {stage.name: set(arg for arg in stage.args if arg in names)
+            for stage in all_stages}
+
+    for i, mutator in enumerate(all_stages):
+        for arg in mutator.mutates:
+            for j, reader in enumerate(all_stages):
+                if reader is mutator or arg not in reader.args:
+                    continue
+                if j < i:
+                    deps[mutator.name].add(reader.name)
+                else:
+                    deps[reader.name].add(mutator.name)
+
+    return deps
+
+
+def as_result(result):
+    """Make dicts accessible like nowpipes does for its results (as Box)."""
+    if isinstance(result, dict) and not isinstance(result, Box):
+        return Box(result)
+    return result
+
+
+def run_stages(all_stages, p, hook=None, workers=4, verbose=True, indent=1):
+    """
+    Run stages concurrently on a pool of threads. A stage is started as soon
+    as all stages it depends on are finished (see stage_dependencies()). When
+    provided, stages are run through hook(stage, call, inputs, p) (see
+    stages.hooked_stage()). Returns the results per stage name.
+    """
+    deps = stage_dependencies(all_stages)
+    results = dict()
+    done = set()
+    pending = list(all_stages)
+    running = dict()
+
+    def run(stage, inputs):
+        fn = getattr(stage.module, stage.name)
+        call = lambda: fn(**inputs, **p)
+        if hook is None:
+            return call()
+        return hook(stage, call, inputs, p)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            # Start every stage whose dependencies are finished, in pipeline
+            # order
+            for stage in list(pending):
+                if len(running) >= workers:
+                    break
+                if deps[stage.name] <= done:
+                    pending.remove(stage)
+                    if verbose:
+                        print(' ' * indent + 'running', stage.name)
+                    inputs = {arg: results[arg] for arg in stage.args}
+                    running[pool.submit(run, stage, inputs)] = stage
+
+            if len(running) == 0:
+                raise RuntimeError('Cannot resolve the dependencies of ' +
+                                   ', '.join(s.name for s in pending))
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    # Let the running stages finish, but do not start new ones
+                    wait(running)
+                    raise error
+                results[stage.name] = as_result(future.result())
+                done.add(stage.name)
+
+    return results
+
+
+def computed_hook(results):
+    """Stage hook that returns results computed by run_stages(), so that a
+    pipeline only collects them."""
+    def computed(stage, call, inputs, p):
+        return results[stage.name]
+    return computed
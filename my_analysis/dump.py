@@ -0,0 +1,154 @@
+import os
+import math
+
+from importlib.util import find_spec
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+
+# Formats for data dumps: one excel file with a sheet per table, or a
+# directory with a parquet (columnar) file per table
+DUMP_FORMATS = ('xlsx', 'parquet')
+# The number of rows that are converted at once when writing a sheet
+CHUNK_ROWS = 10000
+# Excel limits the length of sheet names
+MAX_SHEET_NAME = 31
+
+
+def build_tables(builders, workers=4):
+    """
+    Build tables concurrently. Builders is a list of (name, function) pairs,
+    where every function returns a DataFrame (or None to leave it out).
+    Returns a list of (name, DataFrame) pairs in the order of builders.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(name, pool.submit(build)) for name, build in builders]
+        tables = [(name, future.result()) for name, future in futures]
+    return [(name, df) for name, df in tables if df is not None]
+
+
+def header_label(column):
+    """The header of a column. Columns of a MultiIndex are joined."""
+    if isinstance(column, tuple):
+        return ' / '.join(str(c) for c in column)
+    return column if isinstance(column, str) else str(column)
+
+
+def cell_value(value):
+    """Make a value writable to a cell: missing and infinite numbers become
+    empty cells, objects that are not numbers or text their text."""
+    if value is None:
+        return None
+    if isinstance(value, float):
+        return None if math.isnan(value) or math.isinf(value) else value
+    if isinstance(value, (bool, int, str)):
+        return value
+    if value is pd.NaT:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    return str(value)
+
+
+def table_rows(df, index=True):
+    """Yield the rows of a table (including the index) as lists of cell
+    values, converting CHUNK_ROWS rows at a time."""
+    for start in range(0, len(df.index), CHUNK_ROWS):
+        chunk = df.iloc[start:start + CHUNK_ROWS]
+        columns = [chunk.iloc[:, j].tolist() for j in range(chunk.shape[1])]
+        if index:
+            levels = [chunk.index.get_level_values(i).tolist()
+                      for i in range(chunk.index.nlevels)]
+            columns = levels + columns
+        for row in zip(*columns):
+            yield [cell_value(v) for v in row]
+
+
+def write_sheet(workbook, name, df, index=True):
+    """Write a table to a new sheet, row by row, as required by the constant
+    memory mode of xlsxwriter."""
+    sheet = workbook.add_worksheet(name[:MAX_SHEET_NAME])
+    header = [header_label(c) for c in df.columns]
+    if index:
+        header = [header_label(n) if n is not None else ''
+                  for n in df.index.names] + header
+    sheet.write_row(0, 0, header)
+    for i, row in enumerate(table_rows(df, index), start=1):
+        sheet.write_row(i, 0, row)
+
+
+def write_xlsx(tables, fname):
+    """
+    Write tables to an excel file, one sheet per table. With xlsxwriter,
+    sheets are streamed to disk row by row, so memory use does not grow with
+    the size of the tables. Otherwise, pandas (openpyxl) is used.
+    """
+    if find_spec('xlsxwriter') is None:
+        with pd.ExcelWriter(fname) as writer:
+            for name, df in tables:
+                df.to_excel(writer, sheet_name=name)
+        return
+
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(fname, {'constant_memory': True})
+    try:
+        for name, df in tables:
+            write_sheet(workbook, name, df)
+    finally:
+        workbook.close()
+
+
+def columnar_frame(df):
+    """
+    Prepare a table for parquet: the index becomes columns (unless it is just
+    the row number), column names become text and columns of mixed objects
+    become text.
+    """
+    columns = [header_label(c) for c in df.columns]
+    if isinstance(df.index, pd.RangeIndex) and df.index.name is None:
+        df = df.reset_index(drop=True)
+    else:
+        # Index names must not collide with column names
+        names = [header_label(n) if n is not None else
+                 ('index' if df.index.nlevels == 1 else f'level_{i}')
+                 for i, n in enumerate(df.index.names)]
+        names = [n if n not in columns else 'index_' + n for n in names]
+        df = df.copy()
+        df.index.names = names
+        df = df.reset_index()
+        columns = names + columns
+    df.columns = columns
+
+    for c in df.columns:
+        if df[c].dtype == object and pd.api.types.infer_dtype(
+                df[c], skipna=True) not in ('string', 'empty'):
+            df[c] = df[c].map(lambda v: None if pd.api.types.is_scalar(v) and
+                              pd.isnull(v) else str(v))
+    return df
+
+
+def write_parquet(tables, dirname, workers=4):
+    """Write tables to a directory, one parquet file per table, named after
+    the table (like the sheets of write_xlsx())."""
+    os.makedirs(dirname, exist_ok=True)
+
+    def write(name, df):
+        columnar_frame(df).to_parquet(os.path.join(dirname, name + '.parquet'))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(write, name, df) for name, df in tables]:
+            future.result()
+
+
+def write_dump(tables, fname, dump_format='xlsx'):
+    """Write tables as an excel file (fname + '.xlsx') or as parquet files in a
+    directory (fname). Returns the name of the file or directory."""
+    if dump_format not in DUMP_FORMATS:
+        raise ValueError(f"Unknown dump format '{dump_format}', use one of: " +
+                         ', '.join(DUMP_FORMATS))
+    if dump_format == 'parquet':
+        write_parquet(tables, fname)
+        return fname
+    write_xlsx(tables, fname + '.xlsx')
+    return fname + '.xlsx'
@@ -2,10 +2,48 @@ from nowslides import get_template
 from entities import get_score, get_ivstat, get_prev
 from helpers import df_to_list, score_percentage_multiply
 from numpy import isnan
+from functools import lru_cache, wraps
 
 from sys import exit
 
 
+# Element parsers whose output only depends on the element specification, and
+# not on the entity the report is made for
+STATIC_ELPARSERS = ('team_top4', 'listing', 'numberbox')
+
+
+@lru_cache(maxsize=None)
+def template(name):
+    """Resolve a template only once."""
+    return get_template(name)
+
+
+def static_elparser(elparser):
+    """Memoize the html of an element parser whose output only depends on the
+    element specification."""
+    cache = {}
+
+    @wraps(elparser)
+    def parse(e, v, p):
+        key = repr(e)
+        if key not in cache:
+            cache[key] = elparser(e, v, p)
+        return cache[key]
+
+    return parse
+
+
+def compile_elparsers(elparsers):
+    """
+    Make the element parsers for a render plan: static elements are rendered
+    once and then reused for every report made with these parsers. Compile
+    once per presentation (e.g., per nesting).
+    """
+    return [static_elparser(elparser)
+            if elparser.__name__ in STATIC_ELPARSERS else elparser
+            for elparser in elparsers]
+
+
 def team_top4(e, v, p):
     return('<div>TEAM TOP4</div>')
 
@@ -24,8 +62,11 @@ def listing(e, v, p):
 
 
 def score(e, v, p):
-    tpl = get_template('score')
-    score = get_score(v['scores'], e['var'])
+    tpl = template('score')
+    if 'score_slots' in v:
+        score = dict(v['score_slots'][e['var']])
+    else:
+        score = get_score(v['scores'], e['var'])
     # No score available (slight hack, see score_percentage_multiply)
     if score['current_score_per_width'] == 0:
         score['current_score'] = "-"
@@ -57,8 +98,13 @@ def score(e, v, p):
 
 
 def ivstat(e, v, p):
-    tpl = get_template('bar')
-    score = get_ivstat(v['ivstats'], e['var'], e['dvcluster'], e['ivcluster'])
+    tpl = template('bar')
+    if 'ivstat_slots' in v:
+        score = dict(v['ivstat_slots'][(e['dvcluster'], e['ivcluster'],
+                                        e['var'])])
+    else:
+        score = get_ivstat(v['ivstats'], e['var'], e['dvcluster'],
+                           e['ivcluster'])
     score['current_score'] = round(score['rel_est'], 1)
     score['mean_est'] = round(score['mean_est'], 2)
     score['showb'] = p.get('showb', True)
@@ -114,7 +160,7 @@ def advice(e, v, p):
 
 
 def numberbox(e, v, p):
-    tpl = get_template('number')
+    tpl = template('number')
     return tpl.render(**e)
 
 
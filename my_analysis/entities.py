@@ -1,10 +1,13 @@
 # from nowpipes import pipe
 
 # from copy import deepcopy
+import numpy as np
+import pandas as pd
 from pandas import DataFrame
 
-from helpers import (score_percentage_multiply,
-                     scale_iv_var_names, scale_dv_var_names)
+from helpers import (score_percentage_multiply, score_percentages,
+                     scale_iv_var_names, scale_dv_var_names,
+                     descending_order)
 
 from prev import has_prev, has_prev_for_nesting_no
 
@@ -45,6 +48,46 @@ def ranked_advice(wg, signs, n=5, dvclus=None):
     return wglist
 
 
+def ranked_advice_rows(wg, signs, n=5, dvclus=None):
+    """
+    Vectorized wg.apply(ranked_advice, axis='columns', args=(...)): the top n
+    weighted growth potentials of every nesting entry in wg, sorted once for
+    all entries. Returns a Series with an advice table per entry.
+    """
+    names = np.asarray(wg.columns, dtype=object)
+    values = wg.to_numpy(dtype=float)
+    order = descending_order(values)[:, :n]
+    top = np.take_along_axis(values, order, axis=1)
+
+    if dvclus is not None:
+        # Signs per grade name, in the order of the signs table (like the
+        # merge in ranked_advice())
+        signs = signs.by_dvcluster[dvclus]
+        matches = {}
+        for row in signs[['grade_name', 'majority', 'direction']].itertuples(
+                index=False):
+            matches.setdefault(row.grade_name, []).append(row)
+
+    advice = []
+    for scores, grade_names in zip(top, names[order]):
+        if dvclus is None:
+            advice.append(DataFrame({'score': scores,
+                                     'grade_name': grade_names}))
+            continue
+        rows = [(score, match) for score, name in zip(scores, grade_names)
+                for match in matches.get(name, [])]
+        advice.append(DataFrame({
+            'score': np.array([score for score, _ in rows], dtype=float),
+            'grade_name': np.array([m.grade_name for _, m in rows],
+                                   dtype=object),
+            'majority': np.array([m.majority for _, m in rows],
+                                 dtype=signs['majority'].dtype),
+            'direction': np.array([m.direction for _, m in rows],
+                                  dtype=signs['direction'].dtype)}))
+
+    return pd.Series(advice, index=wg.index, dtype=object)
+
+
 def response_stats(response):
     r = response.to_dict()
     r['respons'] = round(float(r['respons']))
@@ -71,6 +114,32 @@ def nesting_scores(agg, r10):
     return scores
 
 
+def nesting_scores_rows(agg, r10):
+    """
+    Vectorized agg.apply(nesting_scores, axis='columns', args=(r10, )): the
+    scores of every nesting entry in agg combined with the r10 values, which
+    are matched to the variables once for all entries. Returns a Series with
+    a scores table per entry.
+    """
+    # Match variables to r10 values like the merge in nesting_scores()
+    positions = DataFrame({'grade_name': agg.columns,
+                           'position': np.arange(len(agg.columns))})
+    matched = positions.merge(r10, how='inner', left_on='grade_name',
+                              right_on='grade_name')
+    r10_columns = {c: matched[c].to_numpy() for c in r10.columns
+                   if c != 'grade_name'}
+
+    values = agg.to_numpy(dtype=float)[:, matched['position'].to_numpy()]
+    widths = score_percentages(DataFrame(values), 10.0, True).to_numpy()
+    grade_names = matched['grade_name'].to_numpy()
+
+    scores = [DataFrame({'grade_name': grade_names,
+                         'current_score': current,
+                         'current_score_per_width': width} | r10_columns)
+              for current, width in zip(values, widths)]
+    return pd.Series(scores, index=agg.index, dtype=object)
+
+
 def scores_r10_df(agg, r10):
     r10keep = ['low10_grade', 'high10_grade',
                'low10_grade_per', 'high10_grade_per',
@@ -93,6 +162,31 @@ def sort_and_summarize(col, lown=3, highn=3):
     return res
 
 
+def sort_and_summarize_rows(agg, lown=3, highn=3):
+    """Vectorized agg.apply(sort_and_summarize, axis='columns', args=(...)):
+    the lowest and highest scores of every nesting entry in agg, sorted once
+    for all entries. Returns a Series with a summary per entry."""
+    names = np.asarray(agg.columns, dtype=object)
+    values = agg.to_numpy(dtype=float)
+    order = descending_order(values)
+    ncols = len(names)
+    # Positions of the tail (low) and head (high) of the sorted scores
+    low = range(ncols - min(lown, ncols) if lown > 0 else ncols, ncols)
+    high = range(0, min(highn, ncols))
+
+    summaries = []
+    for scores, grade_names in zip(np.take_along_axis(values, order, axis=1),
+                                   names[order]):
+        summaries.append({
+            'low': DataFrame({'score': scores[low.start:],
+                              'grade_name': grade_names[low.start:]},
+                             index=pd.RangeIndex(low.start, low.stop)),
+            'high': DataFrame({'score': scores[:high.stop],
+                               'grade_name': grade_names[:high.stop]},
+                              index=pd.RangeIndex(high.start, high.stop))})
+    return pd.Series(summaries, index=agg.index, dtype=object)
+
+
 def get_advice(results, nesting, no):
     """
     Make an advice dict with all data required to render it to a report.
@@ -155,6 +249,17 @@ def get_score(scores, varname):
     return score
 
 
+def get_score_slots(scores):
+    """
+    Index scores by variable name, so that score elements do not have to
+    search the scores table (see get_score()).
+    """
+    slots = {}
+    for score in scores.reset_index().to_dict('records'):
+        slots.setdefault(score['meanname'], score)
+    return slots
+
+
 def get_prev(prev, varname):
     if prev is None:
         return False
@@ -223,6 +328,18 @@ def get_ivstat(ivstats, varname, dvcluster=None, ivcluster=None):
     return score
 
 
+def get_ivstat_slots(ivstats):
+    """
+    Index ivstats by dvcluster, ivcluster and variable name, so that ivstat
+    elements do not have to search the ivstats table (see get_ivstat()).
+    """
+    slots = {}
+    for score in ivstats.reset_index().to_dict('records'):
+        key = (score['dvcluster'], score['ivcluster'], score['meanname'])
+        slots.setdefault(key, score)
+    return slots
+
+
 def get_ivstats(results):
     ivstats = results.models.all.ivstats
     ivstats['grade_name'] = ivstats.index
@@ -254,6 +371,8 @@ def advice(glossary, models, weighted_growth, signs, **p):
     r = {'by_dvcluster': {dvclus: {} for dvclus in dvclusters}}
 
     advice_n = p.get('advice_n', 5)
+    # Use the vectorized implementation (see the engine parameter)
+    fast = p.get('engine', 'reference') == 'fast'
 
     # Org advice
     r['org'] = {'by_dvcluster': {dvclus: {} for dvclus in dvclusters}}
@@ -269,15 +388,24 @@ def advice(glossary, models, weighted_growth, signs, **p):
         r['org']['by_dvcluster'][dvclus] = org_dvclus
 
     for n in p['nestings']:
-        advice = weighted_growth[n].apply(ranked_advice, axis='columns',
-                                          args=(advice_n,))
+        if fast:
+            advice = ranked_advice_rows(weighted_growth[n], signs, advice_n)
+        else:
+            advice = weighted_growth[n].apply(ranked_advice, axis='columns',
+                                              args=(signs, advice_n))
         r[n] = advice
 
         # Advice per dvcluster
         for dvclus in dvclusters:
             wg_dvclus = weighted_growth['by_dvcluster'][dvclus][n]
-            advice_dvclus = wg_dvclus.apply(ranked_advice, axis='columns',
-                                            args=(signs, advice_n, dvclus))
+            if fast:
+                advice_dvclus = ranked_advice_rows(wg_dvclus, signs, advice_n,
+                                                   dvclus)
+            else:
+                advice_dvclus = wg_dvclus.apply(ranked_advice,
+                                                axis='columns',
+                                                args=(signs, advice_n,
+                                                      dvclus))
             r['by_dvcluster'][dvclus][n] = advice_dvclus
 
     return r
@@ -314,7 +442,10 @@ def scores(nesting, r10, aggregate, research_model, **p):
         agg = aggregate[n][varnames]
         cstd = p.get('r10_' + n + '_comparison', n)
         r10s = scores_r10_df(agg, r10[cstd])
-        scor = agg.apply(nesting_scores, axis='columns', args=(r10s,))
+        if p.get('engine', 'reference') == 'fast':
+            scor = nesting_scores_rows(agg, r10s)
+        else:
+            scor = agg.apply(nesting_scores, axis='columns', args=(r10s,))
         r[n] = scor
 
     return r
@@ -341,6 +472,13 @@ def summary(nesting, aggregate, research_model, **p):
         agg_ivs = aggregate[n][ivs]
         agg_dvs = aggregate[n][dvs]
 
+        if p.get('engine', 'reference') == 'fast':
+            r[n] = {'ivs': sort_and_summarize_rows(agg_ivs, ivs_low_n,
+                                                   ivs_high_n),
+                    'dvs': sort_and_summarize_rows(agg_dvs, dvs_low_n,
+                                                   dvs_high_n)}
+            continue
+
         summ_ivs = agg_ivs.apply(sort_and_summarize, axis='columns', args=(
                                  ivs_low_n, ivs_high_n))
         summ_dvs = agg_dvs.apply(sort_and_summarize, axis='columns', args=(
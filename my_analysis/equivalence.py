@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+
+from profiler import StageProfiler
+from scaling import time_analysis, workload_params
+from snapshot import is_semopy
+from synthetic import write_workload
+
+import config
+
+
+# Engines of the analysis (see the engine parameter in config.analysis)
+ENGINES = ('reference', 'fast')
+# Directory (in outputdir) for the synthetic workloads
+EQUIVALENCE_DIR = 'equivalence/'
+# Tolerance for differences between numbers. The fit statistics of the
+# regression models (semopy) differ slightly between runs.
+RTOL = 1e-7
+ATOL = 1e-12
+# The number of differences that is printed per stage
+MAX_PRINTED = 5
+# Results that are measurements rather than computations (memory sizes, see
+# models.slim_sem()), which are not compared
+MEASUREMENTS = ('slimmed_size',)
+
+
+def run_engine(analysis_config, engine):
+    """Run the analysis with an engine. Returns the results and the wall time
+    per stage."""
+    profiler = StageProfiler('')
+    r = time_analysis(analysis_config | dict(engine=engine), profiler)
+    return r, {record['stage']: record['wall'] for record in profiler.records}
+
+
+def is_table(value):
+    return isinstance(value, (DataFrame, Series))
+
+
+def element_differences(reference, fast, path, rtol, atol):
+    """Differences between Series of tables or dicts (e.g., the advice per
+    nesting entry). Tables are compared at once, after comparing their
+    columns and types per element."""
+    if not reference.index.equals(fast.index):
+        return [(path, 'index differs')]
+
+    elements = list(zip(reference, fast))
+    if all(isinstance(a, dict) and isinstance(b, dict) for a, b in elements):
+        keys = set(k for a, _ in elements for k in a)
+        return [d for k in sorted(keys, key=str) for d in differences(
+                Series([a.get(k) for a, _ in elements], dtype=object),
+                Series([b.get(k) for _, b in elements], dtype=object),
+                f'{path}.{k}', rtol, atol)]
+
+    if not all(isinstance(a, DataFrame) and isinstance(b, DataFrame)
+               for a, b in elements):
+        return [d for i, (a, b) in zip(reference.index, elements)
+                for d in differences(a, b, f'{path}[{i}]', rtol, atol)]
+
+    for i, (a, b) in zip(reference.index, elements):
+        if not (a.columns.equals(b.columns) and a.dtypes.equals(b.dtypes)):
+            return [(f'{path}[{i}]', 'columns or types differ: ' +
+                     f'{dict(a.dtypes)} != {dict(b.dtypes)}')]
+    if len(elements) == 0:
+        return []
+    keys = range(len(elements))
+    return differences(pd.concat([a for a, _ in elements], keys=keys),
+                       pd.concat([b for _, b in elements], keys=keys),
+                       path + '[*]', rtol, atol)
+
+
+def differences(reference, fast, path='', rtol=RTOL, atol=ATOL):
+    """
+    Compare two results (dicts, tables, Series of tables, values) and return
+    the differences as (path, message) pairs. Numbers may differ within
+    tolerance. Semopy objects and measurements are not compared.
+    """
+    if is_semopy(reference) or is_semopy(fast):
+        return []
+
+    if isinstance(reference, dict):
+        if not isinstance(fast, dict) or set(reference) != set(fast):
+            other = set(fast) if isinstance(fast, dict) else type(fast)
+            return [(path, f'keys differ: {set(reference)} != {other}')]
+        return [d for k in reference if k not in MEASUREMENTS
+                for d in differences(reference[k], fast[k], f'{path}.{k}',
+                                     rtol, atol)]
+
+    if is_table(reference):
+        if type(reference) != type(fast):
+            return [(path, f'{type(reference)} != {type(fast)}')]
+        if isinstance(reference, Series) and reference.dtype == object and \
+                any(isinstance(v, (dict, DataFrame, Series))
+                    for v in reference):
+            return element_differences(reference, fast, path, rtol, atol)
+        try:
+            if isinstance(reference, DataFrame):
+                pd.testing.assert_frame_equal(reference, fast, rtol=rtol,
+                                              atol=atol)
+            else:
+                pd.testing.assert_series_equal(reference, fast, rtol=rtol,
+                                               atol=atol)
+        except AssertionError as error:
+            return [(path, ' '.join(str(error).split()))]
+        return []
+
+    if isinstance(reference, (float, np.floating)) and \
+            isinstance(fast, (float, np.floating)):
+        if np.isclose(reference, fast, rtol=rtol, atol=atol, equal_nan=True):
+            return []
+    elif type(reference) == type(fast) and np.all(reference == fast):
+        return []
+    return [(path, f'{reference!r} != {fast!r}')]
+
+
+def check(analysis_config, label, rtol=RTOL, atol=ATOL):
+    """
+    Run the analysis with both engines and compare the results of every
+    stage. Returns a table with, per stage, the wall time of both engines,
+    the speedup and the number of differences, and the differences.
+    """
+    print(f" Equivalence on {label}..")
+    reference, reference_wall = run_engine(analysis_config, 'reference')
+    fast, fast_wall = run_engine(analysis_config, 'fast')
+
+    found = {stage: differences(reference[stage], fast[stage], stage, rtol,
+                                atol) for stage in reference_wall}
+    table = DataFrame({'reference': reference_wall, 'fast': fast_wall})
+    table['speedup'] = table['reference'] / table['fast']
+    table['differences'] = Series({stage: len(d) for stage, d in
+                                   found.items()})
+    table.loc['total'] = table[['reference', 'fast']].sum().tolist() + \
+        [table['reference'].sum() / table['fast'].sum(),
+         table['differences'].sum()]
+    return table, found
+
+
+def equivalence(outputdir, sizes, recorded=False, rtol=RTOL, atol=ATOL):
+    """
+    Check that the fast engine gives the same results as the reference
+    engine on synthetic workloads of the given sizes (respondents, teams)
+    and, with recorded, on the input data in config.analysis. Prints the
+    speedup per stage and the differences. Returns whether all results are
+    the same.
+    """
+    inputs = []
+    for respondents, teams in sizes:
+        datapath = outputdir + EQUIVALENCE_DIR + f'data_{respondents}_{teams}/'
+        overrides = write_workload(datapath,
+                                   **workload_params(respondents, teams))
+        inputs.append((f'{respondents} respondents, {teams} teams',
+                       config.analysis | overrides))
+    if recorded:
+        inputs.append((f"the data in {config.analysis['datapath']}",
+                       config.analysis))
+
+    same = True
+    for label, analysis_config in inputs:
+        table, found = check(analysis_config, label, rtol, atol)
+        for line in table.round(3).to_string().split('\n'):
+            print("  " + line)
+        for stage, diffs in found.items():
+            for path, message in diffs[:MAX_PRINTED]:
+                print(f"  DIFFERENCE {path}: {message[:300]}")
+            if len(diffs) > MAX_PRINTED:
+                print(f"  .. and {len(diffs) - MAX_PRINTED} more in {stage}")
+        same = same and table['differences'].sum() == 0
+
+    print(" Engines are " + ("equivalent" if same else "NOT equivalent"))
+    return same
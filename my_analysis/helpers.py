@@ -1,6 +1,7 @@
 import os
 import yaml
 import sys
+import types
 from functools import reduce
 
 from importlib import reload
@@ -12,7 +13,6 @@ from numpy import isnan
 import pandas as pd
 from pandas import DataFrame, isnull
 
-from scipy.stats import zscore
 
 
 def reload_modules(modnames=[]):
@@ -59,7 +59,7 @@ def join_range(pfx, sep, v):
     """Join a series of numbers into variable names, essentially"""
     if (len(v) == 0):
         return [pfx]
-    return (pfx + sep + str(i) for i in v)
+    return [pfx + sep + str(i) for i in v]
 
 
 def mean_prefix(var):
@@ -146,24 +146,242 @@ def items_scale_means(df, rm):
     return(means)
 
 
-#TODO: What is going on here?
-def get_inter_item_corrs(df, rm):
-    subdfs = rm.apply(lambda row: df[list(row['items_names'])], axis='columns')
-    varnames = scale_var_names(rm)
-    corrs = dict(zip(varnames, list(map(lambda subdf: subdf.corr(), subdfs))))
+def pairwise_stats(df, dtype=np.float64):
+    """
+    The number of observations, covariances and correlations of all pairs of
+    columns in df, computed with a few matrix products instead of per pair.
+    Like DataFrame.cov() and DataFrame.corr(), every pair uses the rows in
+    which both columns are present. With dtype np.float32, the products take
+    half the memory and time, at the cost of precision (about 1e-6). Returns
+    three DataFrames.
+    """
+    values = df.to_numpy(dtype=dtype)
+    present = ~np.isnan(values)
+    mask = present.astype(dtype)
+    # Center on the column means for precision; the pairwise means are
+    # computed from the sums below
+    x = np.where(present, values - np.nanmean(values, axis=0), 0).astype(dtype)
+
+    n = mask.T @ mask
+    sums = x.T @ mask
+    squares = (x * x).T @ mask
+    products = x.T @ x
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # sums[i, j] is the sum of column i over the rows where j is present
+        cross = products - sums * sums.T / n
+        ss = squares - sums * sums / n
+        cov = cross / (n - 1)
+        corr = cross / np.sqrt(ss * ss.T)
+    cov[n < 2] = np.nan
+    corr[n < 2] = np.nan
+    # Rounding may take correlations just beyond 1
+    corr = np.clip(corr, -1, 1)
+    np.fill_diagonal(corr, np.where(np.diag(ss) > 0, 1.0, np.nan))
+
+    def frame(a):
+        return DataFrame(a, index=df.columns, columns=df.columns)
+
+    return frame(n.astype(np.int64)), frame(cov), frame(corr)
+
+
+def correlation_pvalues(corr, n):
+    """Two-sided p-values of (Pearson) correlations with n observations, as
+    in scipy.stats.pearsonr()."""
+    # Imported here, because importing scipy.stats is slow
+    from scipy.stats import t
+
+    r = np.asarray(corr, dtype=np.float64)
+    df = np.asarray(n, dtype=np.float64) - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tvalues = r * np.sqrt(df / ((1 - r) * (1 + r)))
+        p = 2 * t.sf(np.abs(tvalues), df)
+    p[df < 1] = np.nan
+    return p
+
+
+def pairwise_corr(df, dtype=np.float64):
+    """
+    Pairwise correlations between the columns of df, like df.corr(), with
+    their p-values and number of observations, computed at once (see
+    pairwise_stats()). Returns three DataFrames: correlations, p-values and
+    n.
+    """
+    n, _, corr = pairwise_stats(df, dtype)
+    p = DataFrame(correlation_pvalues(corr, n), index=corr.index,
+                  columns=corr.columns)
+    return corr, p, n
+
+
+def weighted_cross_products(z, weights, chunk_rows=2000):
+    """
+    The weighted sums and cross-products of the columns of z for every row of
+    weights (e.g., a resample, or a one-hot group indicator as a sparse
+    matrix): weights @ z and, per row of weights, the sum of
+    weight * outer(z_i, z_i) over the rows i of z. The cross-products of all
+    rows of weights are one matrix product per chunk of chunk_rows rows of z.
+    """
+    ncols = z.shape[1]
+    upper = np.triu_indices(ncols)
+    products = np.zeros((weights.shape[0], len(upper[0])))
+    for start in range(0, len(z), chunk_rows):
+        chunk = z[start:start + chunk_rows]
+        outer = chunk[:, upper[0]] * chunk[:, upper[1]]
+        products += weights[:, start:start + chunk_rows] @ outer
+
+    full = np.empty((weights.shape[0], ncols, ncols))
+    full[:, upper[0], upper[1]] = products
+    full[:, upper[1], upper[0]] = products
+    return np.asarray(weights @ z), full
 
-    problems = []
 
-    for varname, subdf in corrs.items():
-        test = subdf.values < 0
-        if True in test:
-            problems.append(varname)
+def moments_covariance(sums, products, n):
+    """The (maximum likelihood) covariance matrices from the sums,
+    cross-products and number of observations of every row (see
+    weighted_cross_products())."""
+    means = sums / n[:, None]
+    return products / n[:, None, None] - means[:, :, None] * means[:, None, :]
 
-    if len(problems) > 0:
-        raise ValueError('There are negative inter-item corrs for scales: ' +
-                         ' '.join(problems))
 
-    return True
+def em_covariance(df, tol=1e-8, max_iter=500):
+    """
+    Maximum likelihood means and covariances of the columns of df, assuming
+    a multivariate normal distribution, estimated with the EM algorithm from
+    all (incomplete) rows. Rows with the same missing values are handled at
+    once. Rows without any value are left out. Returns the means as a Series
+    and the covariances as a DataFrame.
+    """
+    values = df.to_numpy(dtype=float)
+    present = ~np.isnan(values)
+    keep = present.any(axis=1)
+    values, present = values[keep], present[keep]
+    patterns, which = np.unique(present, axis=0, return_inverse=True)
+    groups = [(o, values[which.ravel() == i]) for i, o in enumerate(patterns)]
+    total = len(values)
+
+    mu = np.nanmean(values, axis=0)
+    sigma = np.diag(np.nanvar(values, axis=0))
+    for _ in range(max_iter):
+        sums = np.zeros(len(mu))
+        products = np.zeros((len(mu), len(mu)))
+        for o, rows in groups:
+            m = ~o
+            filled = rows.copy()
+            if m.any():
+                # Expected missing values given the present ones, and the
+                # variance that remains
+                coef = np.linalg.solve(sigma[np.ix_(o, o)],
+                                       sigma[np.ix_(o, m)]).T
+                filled[:, m] = mu[m] + (rows[:, o] - mu[o]) @ coef.T
+                products[np.ix_(m, m)] += len(rows) * (
+                    sigma[np.ix_(m, m)] - coef @ sigma[np.ix_(o, m)])
+            sums += filled.sum(axis=0)
+            products += filled.T @ filled
+
+        new_mu = sums / total
+        new_sigma = products / total - np.outer(new_mu, new_mu)
+        change = max(np.abs(new_mu - mu).max(),
+                     np.abs(new_sigma - sigma).max())
+        mu, sigma = new_mu, new_sigma
+        if change < tol:
+            break
+
+    return (pd.Series(mu, index=df.columns),
+            DataFrame(sigma, index=df.columns, columns=df.columns))
+
+
+def scale_reliability(cov, corr):
+    """
+    Reliability of one scale from the covariances and correlations of its
+    items (see pairwise_stats()): Cronbach's alpha, the standardized
+    alpha and the mean and lowest inter-item correlation, and per item the
+    correlation with the sum of the other items (item-rest) and the alpha
+    without the item. Returns the scale statistics as a dict and the item
+    statistics as a DataFrame.
+    """
+    c = cov.to_numpy()
+    k = len(c)
+    variances = np.diag(c)
+    total = c.sum()
+    rowsums = c.sum(axis=1)
+    between = corr.to_numpy()[~np.eye(k, dtype=bool)]
+
+    # Alpha needs two items, and alpha without an item three
+    factor = k / (k - 1) if k > 1 else np.nan
+    factor_dropped = (k - 1) / (k - 2) if k > 2 else np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = factor * (1 - variances.sum() / total)
+        mean_corr = between.mean() if k > 1 else np.nan
+        alpha_std = k * mean_corr / (1 + (k - 1) * mean_corr)
+        # Variance of the sum of the other items, and its covariance with
+        # the item
+        rest = total - 2 * rowsums + variances
+        item_rest = (rowsums - variances) / np.sqrt(variances * rest)
+        alpha_dropped = factor_dropped * \
+            (1 - (variances.sum() - variances) / rest)
+
+    scale = dict(items=k, alpha=alpha, alpha_std=alpha_std,
+                 mean_corr=mean_corr,
+                 min_corr=between.min() if k > 1 else np.nan)
+    items = DataFrame({'item_rest_corr': item_rest,
+                       'alpha_if_deleted': alpha_dropped,
+                       'min_corr': corr.where(~np.eye(k, dtype=bool)).min()},
+                      index=cov.index)
+    return scale, items
+
+
+def group_moments(df, by, columns):
+    """
+    The sum, sum of squares and number of (non-missing) values of columns
+    per group of df, in one grouped pass. Returns three DataFrames with a row
+    per group.
+    """
+    values = df[columns]
+    moments = pd.concat([values, values * values, values.notna()],
+                        keys=['sums', 'squares', 'n'], axis='columns')
+    moments = moments.groupby(df[by]).sum()
+    return moments['sums'], moments['squares'], moments['n']
+
+
+def icc_oneway(sums, squares, n):
+    """
+    ICC(1) and ICC(2) of every column from its sums, sums of squares and
+    number of values per group (see group_moments()), with a one-way
+    analysis of variance. Unequal group sizes use the adjusted group size
+    k0. Returns a DataFrame with a row per column.
+    """
+    sums, squares, n = (x.to_numpy(dtype=float) for x in (sums, squares, n))
+    total = n.sum(axis=0)
+    groups = (n > 0).sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Sum of squares between groups (of the group means), and within
+        # groups
+        between = np.nansum(sums ** 2 / n, axis=0)
+        ssb = between - sums.sum(axis=0) ** 2 / total
+        ssw = squares.sum(axis=0) - between
+        msb = ssb / (groups - 1)
+        msw = ssw / (total - groups)
+        k0 = (total - (n ** 2).sum(axis=0) / total) / (groups - 1)
+        icc1 = (msb - msw) / (msb + (k0 - 1) * msw)
+        icc2 = (msb - msw) / msb
+
+    return DataFrame(dict(groups=groups, n=total.astype(np.int64), k0=k0,
+                          msb=msb, msw=msw, icc1=icc1, icc2=icc2))
+
+
+def rwg_j(variances, nitems, scalemax):
+    """
+    Within-group agreement rwg(J) of a scale with nitems items, from the
+    mean within-group variance of its items, against a uniform (no
+    agreement) distribution over the scalemax response options, which has
+    variance (scalemax ** 2 - 1) / 12. Variances beyond that of the uniform
+    distribution mean no agreement (0). With one item, this is rwg.
+    """
+    ratio = np.minimum(variances / ((scalemax ** 2 - 1) / 12), 1)
+    agreement = nitems * (1 - ratio)
+    return agreement / (agreement + ratio)
 
 
 def rm_subcluster_vars(clus, rm, op):
@@ -199,6 +417,41 @@ def score_percentage_multiply(score, oldmax=7, doround=False):
     return percentage
 
 
+def score_percentages(scores, oldmax=7, doround=False):
+    """Vectorized score_percentage_multiply() for a Series of scores. Missing
+    scores are 0%."""
+    percentage = ((scores.astype(float) - 1) / (oldmax - 1)) * 100
+    percentage = percentage.fillna(0)
+    if doround:
+        return percentage.round().astype('int64')
+    return percentage
+
+
+def descending_order(values):
+    """
+    Per row of a 2d array, the positions that sort it from high to low, with
+    NaNs last. Ties are ordered exactly like Series.sort_values(
+    ascending=False) does (see pandas.core.sorting.nargsort): the reversed
+    row is sorted ascending and the result is reversed.
+    """
+    values = np.asarray(values, dtype=float)
+    ncols = values.shape[1]
+    order = np.empty(values.shape, dtype=np.intp)
+    nans = np.isnan(values)
+    complete = ~nans.any(axis=1)
+
+    reverse = values[complete][:, ::-1]
+    order[complete] = (ncols - 1 - reverse.argsort(axis=1,
+                                                   kind='quicksort'))[:, ::-1]
+
+    for i in np.flatnonzero(~complete):
+        positions = np.flatnonzero(~nans[i])[::-1]
+        positions = positions[values[i, positions].argsort(kind='quicksort')]
+        order[i] = np.concatenate([positions[::-1], np.flatnonzero(nans[i])])
+
+    return order
+
+
 def score_transform(score, oldmin=1, oldmax=7, newmin=1, newmax=10):
     """Apply linear transformation to a score to realign it from and old range
     to a new range."""
@@ -216,10 +469,22 @@ def df_standardize(df, axis='rows'):
     """Calculate standardized (z) scores per column or rows in specified
     dataframe."""
 
+    # Imported here, because importing scipy.stats is slow
+    from scipy.stats import zscore
+
     # Apply zscore over axis
     return df.apply(zscore, axis=axis)
 
 
+def df_standardize_columns(df):
+    """Vectorized df_standardize(df, axis='rows'): standardize all columns at
+    once."""
+    from scipy.stats import zscore
+
+    return DataFrame(zscore(df.to_numpy(dtype=float), axis=0),
+                     index=df.index, columns=df.columns)
+
+
 def delete_file_if_exists(fname):
     if os.path.exists(fname):
         os.remove(fname)
@@ -262,13 +527,55 @@ def make_org_report_fname(name):
     return fname
 
 
+def object_size(obj, seen=None):
+    """
+    Estimate the memory size of an object in bytes, including the objects
+    it contains (dicts, lists, DataFrames, arrays, attributes).
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        size = int(obj.memory_usage(index=True, deep=True))
+        # Series of objects (e.g., DataFrames per nesting entity)
+        if obj.dtype == object:
+            size += sum(object_size(x, seen) for x in obj.values)
+        return size
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(object_size(k, seen) +
+                                        object_size(v, seen)
+                                        for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(object_size(x, seen) for x in obj)
+    # Other objects (e.g., semopy models) with their attributes. Modules,
+    # classes and functions are shared and not counted.
+    if hasattr(obj, '__dict__') and not isinstance(
+            obj, (type, types.ModuleType, types.FunctionType,
+                  types.MethodType)):
+        return sys.getsizeof(obj) + object_size(vars(obj), seen)
+    return sys.getsizeof(obj)
+
+
 def isinteractive():
     import sys
     return bool(getattr(sys, 'ps1', sys.flags.interactive))
 
 
 def make_correlation_table(df, names=None, round=2):
-    corrs = df.corr().round(round)
+    return label_correlation_table(pairwise_corr(df)[0], names, round)
+
+
+def label_correlation_table(corrs, names=None, round=2):
+    """Round a table of correlations (or their p-values or n) and add the
+    names of the variables as first column."""
+    corrs = corrs.round(round)
 
     if names is not None:
         names = names.set_index(corrs.index)
@@ -0,0 +1,139 @@
+from importlib.util import find_spec
+
+import numpy as np
+
+
+# Whether the kernels are compiled with numba (an optional dependency, see
+# pyproject.toml). Without it, the numpy implementations are used.
+HAVE_NUMBA = find_spec('numba') is not None
+
+
+def rank_rows_numpy(values):
+    """Per row, rank values from high (1) to low; ties get their average rank
+    and NaNs no rank, like DataFrame.rank(ascending=False, axis=1)."""
+    # Sort every row from high to low (NaNs last) and find the first and
+    # last position of every run of ties
+    order = np.argsort(-values, axis=1, kind='stable')
+    hi_to_lo = np.take_along_axis(values, order, axis=1)
+    positions = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    starts = np.ones(values.shape, dtype=bool)
+    starts[:, 1:] = hi_to_lo[:, 1:] != hi_to_lo[:, :-1]
+    ends = np.ones(values.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.where(ends, positions, values.shape[1] - 1)
+    last = np.minimum.accumulate(last[:, ::-1], axis=1)[:, ::-1]
+
+    rank = np.empty(values.shape)
+    np.put_along_axis(rank, order, (first + last) / 2 + 1, axis=1)
+    rank[np.isnan(values)] = np.nan
+    return rank
+
+
+def cutoff_rows_numpy(relative, cutoff):
+    """Per row, sort the relative values from high to low and return the
+    number of values whose cumulative sum reaches cutoff (including the
+    first value that exceeds it) and their cumulative sum (see
+    models.sort_and_cutoff_pos())."""
+    hi_to_lo = -np.sort(-relative, axis=1)
+    # Cumulative sums skip NaNs, like DataFrame.cumsum()
+    cumulative = np.where(np.isnan(hi_to_lo), np.nan,
+                          np.nancumsum(hi_to_lo, axis=1))
+    cutoffs = np.minimum((cutoff > cumulative).sum(axis=1) + 1,
+                         relative.shape[1])
+    explained = cumulative[np.arange(len(cumulative)), cutoffs - 1]
+    return cutoffs.astype(np.int64), explained
+
+
+def rank_cutoff_numpy(values, relative, cutoff):
+    """See rank_cutoff()."""
+    cutoffs, explained = cutoff_rows_numpy(relative, cutoff)
+    return rank_rows_numpy(values), cutoffs, explained
+
+
+if HAVE_NUMBA:
+    from numba import njit
+
+    @njit(cache=True)
+    def rank_cutoff_numba(values, relative, cutoff):
+        """See rank_cutoff(). Rows are short (one value per iv), so they are
+        sorted by insertion into buffers, without allocations per row."""
+        nrows, ncols = values.shape
+        rank = np.full((nrows, ncols), np.nan)
+        cutoffs = np.empty(nrows, dtype=np.int64)
+        explained = np.empty(nrows)
+        order = np.empty(ncols, dtype=np.int64)
+        hi_to_lo = np.empty(ncols)
+
+        for i in range(nrows):
+            # Positions of the values from high to low, without NaNs
+            nvalues = 0
+            for j in range(ncols):
+                x = values[i, j]
+                if np.isnan(x):
+                    continue
+                k = nvalues
+                while k > 0 and values[i, order[k - 1]] < x:
+                    order[k] = order[k - 1]
+                    k -= 1
+                order[k] = j
+                nvalues += 1
+
+            # Every run of ties gets its average rank
+            start = 0
+            while start < nvalues:
+                x = values[i, order[start]]
+                end = start + 1
+                while end < nvalues and values[i, order[end]] == x:
+                    end += 1
+                for k in range(start, end):
+                    rank[i, order[k]] = (start + 1 + end) / 2
+                start = end
+
+            # Relative values from high to low, without NaNs
+            nrelative = 0
+            for j in range(ncols):
+                x = relative[i, j]
+                if np.isnan(x):
+                    continue
+                k = nrelative
+                while k > 0 and hi_to_lo[k - 1] < x:
+                    hi_to_lo[k] = hi_to_lo[k - 1]
+                    k -= 1
+                hi_to_lo[k] = x
+                nrelative += 1
+
+            # Count the cumulative sums below cutoff. The cumulative sums of
+            # the (trailing) NaNs are NaN.
+            total = 0.0
+            below = 0
+            for k in range(nrelative):
+                total += hi_to_lo[k]
+                if cutoff > total:
+                    below += 1
+            cutoffs[i] = min(below + 1, ncols)
+            if cutoffs[i] > nrelative:
+                explained[i] = np.nan
+            else:
+                total = 0.0
+                for k in range(cutoffs[i]):
+                    total += hi_to_lo[k]
+                explained[i] = total
+
+        return rank, cutoffs, explained
+
+
+def rank_cutoff(values, relative, cutoff):
+    """
+    The weighted growth statistics of every row (nesting entry) in one pass:
+    the rank of the values from high to low (ties get their average rank),
+    and the number of relative values (sorted from high to low) needed for
+    their cumulative sum to reach cutoff, with that cumulative sum (the
+    explained share). Returns the ranks, cutoffs and explained shares as
+    arrays. Compiled with numba when it is installed.
+    """
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    relative = np.ascontiguousarray(relative, dtype=np.float64)
+    if HAVE_NUMBA:
+        return rank_cutoff_numba(values, relative, float(cutoff))
+    return rank_cutoff_numpy(values, relative, cutoff)
@@ -0,0 +1,282 @@
+import io
+import os
+import re
+import ast
+import sys
+import json
+import pickle
+import hashlib
+
+from importlib import metadata
+
+
+# Directory (in outputdir) where stage results are stored
+CACHE_DIR = '.stagecache/'
+# The number of results that are kept per stage. Older results are removed.
+MAX_ENTRIES = 8
+# The packages that make or hold the results of the stages: cached results
+# are only valid for the same versions of python and these packages
+PACKAGES = ('numpy', 'pandas', 'semopy', 'nowpipes')
+
+
+def package_version(name):
+    """The installed version of a package, or 'unknown'."""
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+VERSION = '/'.join([f'{sys.version_info[0]}.{sys.version_info[1]}'] +
+                   [package_version(name) for name in PACKAGES])
+
+
+def digest(*parts):
+    """Return the sha256 hex digest of a number of strings."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+_file_digests = {}
+
+
+def file_digest(fname):
+    """Return the sha256 hex digest of the contents of a file. Digests are
+    kept per process as long as the file does not change."""
+    stat = os.stat(fname)
+    key = (fname, stat.st_mtime_ns, stat.st_size)
+    if key not in _file_digests:
+        with open(fname, 'rb') as f:
+            _file_digests[key] = hashlib.sha256(f.read()).hexdigest()
+    return _file_digests[key]
+
+
+def package_imports(module):
+    """The modules from the same directory that a module imports (directly
+    or indirectly), including the module itself."""
+    dirname = os.path.dirname(os.path.abspath(module.__file__))
+    fname = os.path.abspath(module.__file__)
+    found = []
+    todo = [fname]
+    while len(todo) > 0:
+        fname = todo.pop()
+        if fname in found:
+            continue
+        found.append(fname)
+        with open(fname, 'r') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                candidate = os.path.join(dirname, name + '.py')
+                if os.path.exists(candidate):
+                    todo.append(candidate)
+    return sorted(found)
+
+
+def source_digest(module):
+    """Digest of the source of a module and the package modules it imports.
+    Changing any of these invalidates the cached results of its stages."""
+    return digest(*[file_digest(fname) for fname in package_imports(module)])
+
+
+def read_params(stage, p):
+    """The parameters (name and value) that a stage reads (see
+    stages.stage_params()). All parameters when that is unknown."""
+    if stage.params is None:
+        return {k: p[k] for k in sorted(p)}
+    patterns = [re.compile(pattern) for pattern in stage.params]
+    return {k: p[k] for k in sorted(p)
+            if any(pattern.fullmatch(k) for pattern in patterns)}
+
+
+def params_files(params):
+    """Digests of the input files that parameters refer to, either directly
+    or relative to datapath (see helpers.filepath())."""
+    files = {}
+    datapath = params.get('datapath', '')
+    for k, v in params.items():
+        if not isinstance(v, str):
+            continue
+        for fname in (v, str(datapath) + v):
+            if os.path.isfile(fname):
+                files[k] = file_digest(fname)
+                break
+    return files
+
+
+# Modules whose objects are always pickled as usual
+PICKLABLE_MODULES = ('builtins', 'collections', 'numpy', 'pandas', 'box')
+
+
+class LenientPickler(pickle.Pickler):
+    """
+    Pickler that stores objects that can not be pickled (e.g., semopy models,
+    which hold lambdas) as None instead of failing. The types of the objects
+    that were left out are kept in dropped.
+    """
+
+    def __init__(self, f):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.dropped = set()
+
+    def persistent_id(self, obj):
+        cls = type(obj)
+        if cls.__module__.split('.')[0] in PICKLABLE_MODULES:
+            return None
+        try:
+            pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            self.dropped.add(cls.__module__ + '.' + cls.__qualname__)
+            return 'dropped'
+        return None
+
+
+class LenientUnpickler(pickle.Unpickler):
+    """Unpickler for LenientPickler: objects that were left out are None."""
+
+    def persistent_load(self, pid):
+        return None
+
+
+def dumps(obj):
+    """Pickle an object, leaving out what can not be pickled (see
+    LenientPickler). Returns the data and the types that were left out."""
+    try:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), set()
+    except Exception:
+        f = io.BytesIO()
+        pickler = LenientPickler(f)
+        pickler.dump(obj)
+        return f.getvalue(), pickler.dropped
+
+
+def loads(data):
+    """Unpickle data from dumps()."""
+    return LenientUnpickler(io.BytesIO(data)).load()
+
+
+class StageCache:
+    """
+    Stage hook (see stages.hooked_stage()) that stores the result of every
+    stage on disk and reuses it in later runs when nothing it depends on
+    changed. The key of a stage is made of:
+
+    - the source of its module and the package modules that it imports,
+    - the parameters it reads and the contents of files they refer to,
+    - the keys of the stages whose results are its arguments.
+
+    Thus, a changed parameter only recomputes the stages that read it and the
+    stages below them. Stages that modify their arguments in place (e.g.,
+    scale_means adds columns to data) store the modified arguments as well,
+    and restore them when their result is taken from the cache.
+    """
+
+    def __init__(self, outputdir, recompute=False):
+        self.cachedir = outputdir + CACHE_DIR
+        self.recompute = recompute
+        # The key of the current state of every result
+        self.keys = {}
+        self.hits = []
+        self.misses = []
+
+    def stage_key(self, stage, p):
+        """The key of a stage, or None when the stage can not be cached."""
+        if any(arg not in self.keys for arg in stage.args):
+            return None
+        params = read_params(stage, p)
+        return digest(VERSION, stage.name, source_digest(stage.module),
+                      json.dumps(params, sort_keys=True, default=repr),
+                      json.dumps(params_files(params), sort_keys=True),
+                      *[self.keys[arg] for arg in stage.args])
+
+    def fname(self, stage, key):
+        return self.cachedir + stage.name + '/' + key + '.pkl'
+
+    def load(self, stage, key):
+        """Load a cached entry, or return None when there is none."""
+        fname = self.fname(stage, key)
+        if os.path.exists(fname) is False:
+            return None
+        try:
+            with open(fname, 'rb') as f:
+                return loads(f.read())
+        except Exception:
+            return None
+
+    def store(self, stage, key, entry):
+        """Store an entry. Entries with objects that can not be pickled (e.g.,
+        semopy models without slim_models) are not stored, as they would be
+        incomplete when taken from the cache."""
+        data, dropped = dumps(entry)
+        if len(dropped) > 0:
+            print(f"  Stage {stage.name}: not cached, cannot store " +
+                  ', '.join(sorted(dropped)))
+            return
+        fname = self.fname(stage, key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(fname + '.tmp', fname)
+        self.prune(stage)
+
+    def prune(self, stage):
+        """Remove all but the most recent MAX_ENTRIES results of a stage."""
+        dirname = self.cachedir + stage.name + '/'
+        fnames = [dirname + f for f in os.listdir(dirname)
+                  if f.endswith('.pkl')]
+        fnames.sort(key=os.path.getmtime, reverse=True)
+        for fname in fnames[MAX_ENTRIES:]:
+            os.remove(fname)
+
+    def __call__(self, stage, call, inputs, p):
+        key = self.stage_key(stage, p)
+
+        # Arguments modified in place must be restorable
+        if key is not None and any(not isinstance(inputs[arg], dict)
+                                   for arg in stage.mutates):
+            key = None
+
+        if key is None:
+            self.misses.append(stage.name)
+            # Nothing that depends on this result can be cached either
+            self.keys.pop(stage.name, None)
+            for arg in stage.mutates:
+                self.keys.pop(arg, None)
+            return call()
+
+        entry = None if self.recompute else self.load(stage, key)
+        if entry is not None:
+            self.hits.append(stage.name)
+            # Mark the entry as recently used (see prune())
+            os.utime(self.fname(stage, key))
+            for arg, value in entry['mutated'].items():
+                inputs[arg].clear()
+                inputs[arg].update(value)
+            result = entry['result']
+        else:
+            self.misses.append(stage.name)
+            result = call()
+            mutated = {arg: inputs[arg] for arg in stage.mutates}
+            self.store(stage, key, dict(result=result, mutated=mutated))
+
+        self.keys[stage.name] = key
+        for arg in stage.mutates:
+            self.keys[arg] = digest(self.keys[arg], key)
+
+        return result
+
+    def summary(self):
+        """Print how many stages were taken from the cache."""
+        total = len(self.hits) + len(self.misses)
+        print(f" Stage cache: {len(self.hits)} of {total} stages from cache" +
+              (f", computed: {', '.join(self.misses)}"
+               if 0 < len(self.misses) < total else ''))
@@ -3,11 +3,13 @@ from pandas import DataFrame
 from copy import deepcopy
 import pandas as pd
 
-import semopy as sp
-
 from nowpipes import pipe
 
-from helpers import rm_subcluster_vars, grade_prefix
+from helpers import (rm_subcluster_vars, grade_prefix, pairwise_stats,
+                     em_covariance, weighted_cross_products,
+                     moments_covariance)
+from kernels import rank_cutoff
+from profiler import semopy_size
 
 
 def sem_regression_formula(dvs, ivs):
@@ -18,6 +20,8 @@ def sem_regression_formula(dvs, ivs):
 def sem_regression(dvs, ivs, df, debug=False):
     """Use semopy to perform a (multivariate) regression with manifest
     variables on specified dataframe."""
+    # Imported here, because importing semopy takes seconds
+    import semopy as sp
 
     if debug:
         print(" Model with dvs:", ' '.join(dvs))
@@ -37,10 +41,122 @@ def sem_regression(dvs, ivs, df, debug=False):
     estimates = model.inspect()
     stats = sp.calc_stats(model).transpose()
 
-    return dict(formula=formula, vars=vars, model=model, fit=fit,
+    return dict(formula=formula, vars=varss, model=model, fit=fit,
                 estimates=estimates, stats=stats)
 
 
+# Estimators of the regression models: semopy per model, or from one
+# covariance matrix of all grade scores (see the models_estimator parameter)
+ESTIMATORS = ('sem', 'pairwise', 'em')
+
+
+def grade_covariance(df, estimator):
+    """
+    The (maximum likelihood) covariance matrix of the columns of df, from the
+    pairwise complete observations of every pair (pairwise) or estimated
+    from all rows with the EM algorithm (em).
+    """
+    if estimator == 'pairwise':
+        n, cov, _ = pairwise_stats(df)
+        return cov * (n - 1) / n
+    return em_covariance(df)[1]
+
+
+def effective_n(present, varss, estimator):
+    """
+    The number of observations behind the covariances of variables varss
+    (present tells which values are not missing): the smallest number of
+    pairwise complete observations (pairwise), or the number of rows with
+    any of the variables (em).
+    """
+    present = present[list(varss)].to_numpy()
+    if estimator == 'pairwise':
+        counts = present.T.astype(np.int64) @ present
+        return int(counts.min())
+    return int(present.any(axis=1).sum())
+
+
+def cov_regression(dvs, ivs, cov, n):
+    """
+    A (multivariate) regression of dvs on ivs from the covariance matrix cov
+    of (at least) their variables, with n observations. These are the
+    maximum likelihood estimates of sem_regression() on the same covariances,
+    where the residuals of the dvs do not covary, without fitting. The
+    estimates are in the format of semopy (Model.inspect()).
+    """
+    # Imported here, because importing scipy.stats is slow
+    from scipy.stats import norm
+
+    ivs, dvs = list(ivs), list(dvs)
+    sxx = cov.loc[ivs, ivs].to_numpy()
+    sxy = cov.loc[ivs, dvs].to_numpy()
+    variances = np.diag(cov.loc[dvs, dvs].to_numpy())
+
+    inverse = np.linalg.inv(sxx)
+    coefs = inverse @ sxy
+    residuals = variances - (sxy * coefs).sum(axis=0)
+    # Standard errors from the Fisher information, as semopy does
+    stderrs = np.sqrt(np.outer(np.diag(inverse), residuals) / n)
+
+    estimates = DataFrame({
+        'lval': np.repeat(dvs, len(ivs)).tolist() + dvs,
+        'op': ['~'] * (len(dvs) * len(ivs)) + ['~~'] * len(dvs),
+        'rval': ivs * len(dvs) + dvs,
+        'Estimate': np.concatenate([coefs.T.ravel(), residuals]),
+        'Std. Err': np.concatenate([stderrs.T.ravel(),
+                                    residuals * np.sqrt(2 / n)])})
+    estimates['z-value'] = estimates['Estimate'] / estimates['Std. Err']
+    estimates['p-value'] = 2 * norm.sf(estimates['z-value'].abs())
+
+    stats = DataFrame({'Value': [n] + list(1 - residuals / variances)},
+                      index=['N'] + ['R2 ' + dv for dv in dvs])
+
+    return dict(formula=sem_regression_formula(dvs, ivs), vars=ivs + dvs,
+                estimates=estimates, stats=stats, n=n)
+
+
+def model_specs(table, grades):
+    """The positions (in grades) of the ivs and dvs of every model, from the
+    model tables (see model_table())."""
+    specs = []
+    for name, modt in table.groupby('model', sort=False):
+        ivs = list(dict.fromkeys(modt['iv']))
+        dvs = list(dict.fromkeys(modt['dv']))
+        specs.append((name, [grades.index(v) for v in ivs],
+                      [grades.index(v) for v in dvs]))
+    return specs
+
+
+def batched_regression(cov, n, ivs, dvs):
+    """
+    cov_regression() for a stack of covariance matrices (e.g., of resamples
+    or groups) with n observations each, solved at once. Ivs and dvs are
+    positions in the covariance matrices. Returns the estimates and their
+    p-values as arrays (stack, ivs, dvs).
+    """
+    # Imported here, because importing scipy.stats is slow
+    from scipy.stats import norm
+
+    inverse = np.linalg.inv(cov[:, ivs][:, :, ivs])
+    sxy = cov[:, ivs][:, :, dvs]
+    coefs = inverse @ sxy
+    residuals = cov[:, dvs, dvs] - (sxy * coefs).sum(axis=1)
+    stderrs = np.sqrt(np.diagonal(inverse, axis1=1, axis2=2)[:, :, None] *
+                      residuals[:, None, :] / n[:, None, None])
+    return coefs, 2 * norm.sf(np.abs(coefs / stderrs))
+
+
+def slim_sem(sem):
+    """Drop the semopy model and fit objects from a sem regression
+    (sem_regression), keeping only its formula, variables and tables. The
+    memory size of the dropped objects is kept as slimmed_size (see
+    profiler.StageProfiler)."""
+    dropped = {k: v for k, v in sem.items() if k in ('model', 'fit')}
+    slim = {k: v for k, v in sem.items() if k not in dropped}
+    slim['slimmed_size'] = semopy_size(dropped)
+    return slim
+
+
 def model_table(sem, pval, dvcluster, ivcluster, modname):
     """Make a model table based on a sem regression (sem_regression)"""
     # R PORT: Implements (portions of) <regressions.R/calc_model()>
@@ -130,13 +246,25 @@ def sort_and_cutoff_pos(df, cutoff):
     return DataFrame({'cutoff': cutoffs, 'explained': explained})
 
 
-def model_weighted_growth_stats(wg, cutoff):
-    # Rank weighted growths per nesting entry
-    rank = wg.rank(ascending=False, axis=1)
-
+def model_weighted_growth_stats(wg, cutoff, fast=False):
     # Calculate growth relative to each nesting entry's sum
     relative = relative_df(wg, wg.sum(axis='columns'))
 
+    if fast:
+        # Rank, sort and cut off every nesting entry in one pass (see
+        # kernels.py), instead of via intermediate dataframes
+        rank, cutoffs, explained = rank_cutoff(wg.to_numpy(),
+                                               relative.to_numpy(), cutoff)
+        rank = DataFrame(rank, index=wg.index, columns=wg.columns)
+        cutoff = DataFrame({'cutoff': cutoffs, 'explained': explained})
+        stats = DataFrame({'mean_rank': rank.mean(axis='rows'),
+                           'sd_rank': rank.std(axis='rows')})
+        return dict(rank=rank, relative=relative,
+                    cutoff=cutoff, stats=stats)
+
+    # Rank weighted growths per nesting entry
+    rank = wg.rank(ascending=False, axis=1)
+
     # Get the position at which the cumulative sum exceeds cutoff.
     # This is later used to determine on how many independent variables
     # an entry in a nesting can 'grow' substantially. In other words, it's
@@ -174,6 +302,17 @@ def models(data, research_model, **p):
     pval = p['models_p_value']
     df = data.use
 
+    # With the pairwise or em estimator, the covariances of all grade scores
+    # are computed once, and every model is estimated from them
+    estimator = p.get('models_estimator', 'sem')
+    if estimator not in ESTIMATORS:
+        raise ValueError(f'Unknown models_estimator {estimator}, use one ' +
+                         'of: ' + ', '.join(ESTIMATORS))
+    if estimator != 'sem':
+        grades = df[list(rm['grade_name'])]
+        cov = grade_covariance(grades, estimator)
+        present = grades.notna()
+
     # Make an empty dataframe to concatenate all model tables and ivstats
     all_table, all_ivstats = DataFrame(), DataFrame()
 
@@ -183,8 +322,17 @@ def models(data, research_model, **p):
         dvs = rm_subcluster_vars(dvcluster, rm, grade_prefix)
         ivs = rm_subcluster_vars(ivcluster, rm, grade_prefix)
 
-        # Run the regression model using sem (semopy)
-        sem = sem_regression(dvs, ivs, df)
+        # Run the regression model using sem (semopy), or from the
+        # covariances with the effective number of respondents
+        if estimator == 'sem':
+            sem = sem_regression(dvs, ivs, df)
+        else:
+            n = effective_n(present, list(ivs) + list(dvs), estimator)
+            sem = cov_regression(dvs, ivs, cov, n)
+        # The semopy objects hold a copy of the data and optimizer state,
+        # which are not needed further on
+        if p.get('slim_models', False):
+            sem = slim_sem(sem)
         # Transform results into a model table
         modt = model_table(sem, pval, dvcluster, ivcluster, name)
         # Gather summary iv stats
@@ -225,12 +373,84 @@ def models(data, research_model, **p):
     return r
 
 
+# Names of the sign columns per direction of an estimate
+SIGN_NAMES = {-1.0: 'negative', 1.0: 'positive'}
+
+
+def sign_counts(table):
+    """
+    Count the significant estimates per dvcluster, model, iv and direction
+    (sign) with one grouped count into a dense array. Returns the counts
+    (dvclusters x models x ivs x directions) and the (sorted) labels of
+    every axis.
+    """
+    table = table[table['issig'] == True]
+    columns = ('dvcluster', 'model', 'iv', 'direction')
+    codes, labels = zip(*[pd.factorize(table[c], sort=True) for c in columns])
+    # Rows with a missing label (e.g., an estimate without direction) are not
+    # counted, like pd.crosstab does
+    valid = np.logical_and.reduce([c >= 0 for c in codes])
+    counts = np.zeros([len(label) for label in labels], dtype=np.int64)
+    np.add.at(counts, tuple(c[valid] for c in codes), 1)
+    return counts, labels
+
+
+def dvcluster_signs(counts, models, ivs, directions):
+    """
+    The signs table of one dvcluster from its counts (models x ivs x
+    directions, see sign_counts()), with the rows, columns and types of the
+    crosstab per model in signs(): a row per model and iv with a significant
+    estimate, and a column per direction. Directions that not every model has
+    are floats.
+    """
+    present = counts.sum(axis=2) > 0
+    rows_model, rows_iv = np.nonzero(present)
+    in_models = counts[present.any(axis=1)].sum(axis=1) > 0
+
+    # Columns in order of appearance over the models
+    order = []
+    for has in in_models:
+        order += [d for d in np.flatnonzero(has) if d not in order]
+
+    df = DataFrame({SIGN_NAMES.get(directions[d], directions[d]):
+                    counts[rows_model, rows_iv, d].astype(
+                        'int64' if in_models[:, d].all() else 'float64')
+                    for d in order})
+    df['model'] = np.asarray(models, dtype=object)[rows_model]
+    df['grade_name'] = np.asarray(ivs, dtype=object)[rows_iv]
+
+    def count(direction):
+        d = np.flatnonzero(np.asarray(directions) == direction)
+        return counts[rows_model, rows_iv, d[0]] if len(d) > 0 else 0
+
+    negative, positive = count(-1.0), count(1.0)
+    df['majority'] = np.where(negative > positive, -1,
+                              np.where(negative == positive, 0, 1))
+    return df
+
+
 @pipe
 def signs(research_model, models, **p):
 
     dvclusters = models.by_dvcluster.keys()
     r = {'by_dvcluster': {dvclus: {} for dvclus in dvclusters}}
 
+    if p.get('engine', 'reference') == 'fast':
+        # Count all signs at once, instead of a crosstab per dvcluster and
+        # model (see the engine parameter)
+        counts, (dvcluster_labels, models_labels, ivs, directions) = \
+            sign_counts(models.all.table)
+        rm = research_model[['grade_name', 'direction']]
+        for dvcluster in dvclusters:
+            d = np.flatnonzero(np.asarray(dvcluster_labels) == dvcluster)
+            dvclus_counts = counts[d[0]] if len(d) > 0 else \
+                np.zeros(counts.shape[1:], dtype=np.int64)
+            signs_df = dvcluster_signs(dvclus_counts, models_labels, ivs,
+                                       directions)
+            r['by_dvcluster'][dvcluster] = signs_df.merge(
+                rm, left_on='grade_name', right_on='grade_name', how='inner')
+        return r
+
     for dvcluster in dvclusters:
         signs = models.all.table
         signs = signs[signs.dvcluster == dvcluster]
@@ -253,8 +473,109 @@ def signs(research_model, models, **p):
     return r
 
 
+def entity_model_table(cov, n, values, spec, grades, pval):
+    """The estimates of a model (spec, see model_specs()) for every entity
+    (values), with n respondents and covariance matrix cov each, as one long
+    table. Non-significant estimates are 0, like in model_table()."""
+    name, ivs, dvs = spec
+    coefs, pvalues = batched_regression(cov, n, ivs, dvs)
+    entities, nivs, ndvs = coefs.shape
+    grades = np.asarray(grades, dtype=object)
+
+    modt = DataFrame({
+        'value': np.repeat(values, nivs * ndvs),
+        'n': np.repeat(n, nivs * ndvs).astype(np.int64),
+        'dv': np.tile(grades[dvs], entities * nivs),
+        'iv': np.tile(np.repeat(grades[ivs], ndvs), entities),
+        'est': coefs.ravel(),
+        'p': pvalues.ravel()})
+    modt['est'] = modt['est'].where(modt['p'] < pval, 0)
+    modt['estabs'] = modt['est'].abs()
+    modt['model'] = name
+    return modt
+
+
 @pipe
-def weighted_growth(growth, models, nesting, research_model, **p):
+def entity_models(data, research_model, models, **p):
+    """
+    Fit the regression models per entity of the nestings in the
+    entity_model_nestings parameter, for entities with at least
+    entity_models_min_n respondents (without missing grade scores). The
+    cross-products of the grade scores of all entities come from one pass
+    over the respondents, after which every model is estimated for all
+    entities at once from their covariances (like cov_regression()).
+    Returns per nesting the estimates of every entity and model (table) and
+    the ivstats of every entity over all models (ivstats), like the overall
+    ivstats of models().
+    """
+    # Imported here, because importing scipy.sparse is slow
+    from scipy.sparse import csc_matrix
+
+    r = dict(table=dict(), ivstats=dict())
+
+    min_n = p.get('entity_models_min_n', 100)
+    pval = p['models_p_value']
+    used = set(models.all.table['iv']) | set(models.all.table['dv'])
+    grades = [g for g in research_model['grade_name'] if g in used]
+    specs = model_specs(models.all.table, grades)
+    clusters = models.all.table.drop_duplicates('model')[
+        ['model', 'dvcluster', 'ivcluster']]
+
+    for n in p.get('entity_model_nestings', ()):
+        df = data.use[[n] + grades].dropna()
+        codes, values = pd.factorize(df[n])
+        sizes = np.bincount(codes, minlength=len(values))
+        large = np.flatnonzero(sizes >= min_n)
+
+        # Which respondents belong to which (large) entity, as a sparse
+        # matrix with a row per entity
+        position = np.full(len(values), -1)
+        position[large] = np.arange(len(large))
+        rows = np.flatnonzero(position[codes] >= 0)
+        members = csc_matrix((np.ones(len(rows)), (position[codes[rows]],
+                                                   rows)),
+                             shape=(len(large), len(df)))
+
+        # Center the grade scores, so the cross-products keep their precision
+        z = df[grades].to_numpy(dtype=float)
+        z = z - z.mean(axis=0)
+        sums, products = weighted_cross_products(z, members)
+        counts = sizes[large].astype(float)
+        cov = moments_covariance(sums, products, counts)
+
+        table = pd.concat([entity_model_table(cov, counts, values[large],
+                                              spec, grades, pval)
+                           for spec in specs], ignore_index=True)
+        table = table.merge(clusters, on='model', how='left')
+        r['table'][n] = table
+
+        # Ivstats per entity and model (see model_iv_stats()), and their
+        # means over models
+        ivstats = table.groupby(['value', 'model', 'iv'])['estabs'].agg(
+            mean_est='mean', max_est='max')
+        r['ivstats'][n] = ivstats.groupby(['value', 'iv']).mean().reset_index()
+
+    return r
+
+
+def entity_weights(values, ivstats, pooled, weigh_by):
+    """
+    The weights of the ivs for every entity (values) from its own ivstats
+    (see entity_models()) or, for entities without their own models, the
+    pooled weights of all respondents. Returns a DataFrame with a row per
+    entity.
+    """
+    if weigh_by not in ivstats.columns:
+        raise ValueError(f'Cannot weigh growth per entity by {weigh_by}, ' +
+                         'use mean_est or max_est')
+    own = ivstats.pivot(index='value', columns='iv', values=weigh_by)
+    weights = own.reindex(index=values, columns=pooled.index).fillna(pooled)
+    return weights.set_index(values.index)
+
+
+@pipe
+def weighted_growth(growth, models, nesting, research_model, entity_models,
+                    **p):
     """Weigh growth potentials by multiplying the absolute growth potentials of
     every entity in every nesting with corrected regression estimates /
     weights. These are derived from ivstats from the models() analysis."""
@@ -289,11 +610,21 @@ def weighted_growth(growth, models, nesting, research_model, **p):
     # returns and provides marginal benefits.
     cumcut = p.get('cumulative_growth_cutoff', 0.7)
 
+    # Use the rank and cutoff kernels (see the engine parameter)
+    fast = p.get('engine', 'reference') == 'fast'
+    # Weigh growth of entities with their own models by their own ivstats
+    by_entity = p.get('weigh_growth_by_entity', False)
+
     for n in p['nestings']:
         # Get growth scores for nesting
         g = growth[n][varnames_overall]
         # Weigh these scores by multiplying them with weights from ivstats
-        wg = g * weights_overall
+        if by_entity and n in entity_models['ivstats']:
+            wg = g * entity_weights(growth[n]['value'],
+                                    entity_models['ivstats'][n],
+                                    weights_overall, weigh_by)
+        else:
+            wg = g * weights_overall
         r[n] = wg
 
         # Weight growth scores per dvcluster
@@ -304,7 +635,7 @@ def weighted_growth(growth, models, nesting, research_model, **p):
             r['by_dvcluster'][dvcluster][n] = wg_dvclus
 
         # Calculate additional statistics for the weighted growth potentials
-        wg_stats = model_weighted_growth_stats(wg, cumcut)
+        wg_stats = model_weighted_growth_stats(wg, cumcut, fast)
         # Rank position of the weighted growth potential
         r['rank'][n] = wg_stats['rank']
         # Relative potential compared to sum (e.g., all sum to 1 = 100%)
@@ -319,7 +650,7 @@ def weighted_growth(growth, models, nesting, research_model, **p):
         wgm = weights_per_model.apply(lambda w: w * g)
         r['by_model'][n] = wgm
 
-        wgm_stats = model_weighted_growth_stats(wgm, cumcut)
+        wgm_stats = model_weighted_growth_stats(wgm, cumcut, fast)
         wgm_stats['cutoff'].index = wgm_stats['relative'].index
         r['by_model']['rank'][n] = wgm_stats['rank']
         r['by_model']['relative'][n] = wgm_stats['relative']
@@ -0,0 +1,331 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+
+from time import perf_counter
+from functools import lru_cache
+from collections import Counter
+
+from helpers import delete_file_if_exists
+from memo import file_digest
+
+
+# The container in base.html that holds the rendered pages (slides)
+SLIDES_OPEN = re.compile(r'<div\s+id=["\']slides["\'][^>]*>')
+# Opening and closing div tags. Comments are matched as well so that
+# commented-out markup in the templates is skipped.
+DIV_TAG = re.compile(r'<!--.*?-->|<div\b|</div\s*>', re.DOTALL)
+# Local stylesheets linked from the head of a report (see base.html)
+STYLESHEET_LINK = re.compile(r'<link\s+href=["\']file://([^"\']+)["\']\s+'
+                             r'rel=["\']stylesheet["\']\s*/?>')
+
+# Directories with files that determine what a pdf looks like besides its html
+ASSET_DIRS = ('./assets/css/', './assets/templates/')
+# Directory (in outputdir) where rendered pdfs are stored by content hash
+CACHE_DIR = '.pdfcache/'
+# File (in outputdir) that records the content hash of every written report
+MANIFEST = 'pdf_manifest.json'
+
+
+def split_pages(html):
+    """
+    Split a rendered presentation into its head, pages and tail. Pages are the
+    top-level elements of the slides container (see base.html). The head is
+    everything before the first page, the tail everything after the last page.
+    When no pages can be found, the whole html is returned as head.
+    """
+    m = SLIDES_OPEN.search(html)
+    if m is None:
+        return html, [], ''
+
+    spans = []
+    depth = 0
+    start = None
+    for tag in DIV_TAG.finditer(html, m.end()):
+        text = tag.group(0)
+        if text.startswith('<!--'):
+            continue
+        if text.startswith('</'):
+            # Closing tag of the slides container itself
+            if depth == 0:
+                break
+            depth -= 1
+            if depth == 0:
+                spans.append((start, tag.end()))
+        else:
+            if depth == 0:
+                start = tag.start()
+            depth += 1
+
+    if len(spans) == 0:
+        return html, [], ''
+
+    head = html[:spans[0][0]]
+    pages = [html[s:e] for s, e in spans]
+    tail = html[spans[-1][1]:]
+    return head, pages, tail
+
+
+def static_pages(htmls):
+    """
+    Determine which pages are the same for all provided reports (e.g., front
+    matter, model explanations, glossary). Returns a tuple of booleans (one per
+    page) that is True for pages that are entity-independent, or None when no
+    pages can be shared.
+
+    Only reports with the most common number of pages are compared. Reports
+    with a different number of pages are rendered in full.
+    """
+    splits = [split_pages(html) for html in htmls]
+    if len(splits) < 2:
+        return None
+
+    npages, count = Counter(len(s[1]) for s in splits).most_common(1)[0]
+    if npages == 0 or count < 2:
+        return None
+
+    splits = [s for s in splits if len(s[1]) == npages]
+    head, pages, tail = splits[0]
+
+    # Pages are rendered with a shared head and tail, so these must be equal
+    if any(s[0] != head or s[2] != tail for s in splits):
+        return None
+
+    mask = tuple(all(s[1][i] == pages[i] for s in splits)
+                 for i in range(npages))
+
+    if not any(mask):
+        return None
+
+    return mask
+
+
+def page_runs(mask):
+    """Group page numbers into consecutive runs of static and varying pages.
+    Example: (True, True, False, True) -> [(True, [0, 1]), (False, [2]),
+    (True, [3])]"""
+    runs = []
+    for i, is_static in enumerate(mask):
+        if len(runs) > 0 and runs[-1][0] == is_static:
+            runs[-1][1].append(i)
+        else:
+            runs.append((is_static, [i]))
+    return runs
+
+
+@lru_cache(maxsize=None)
+def font_config():
+    """The font configuration that is shared by all renders in this worker."""
+    from weasyprint.text.fonts import FontConfiguration
+    return FontConfiguration()
+
+
+@lru_cache(maxsize=256)
+def fetch_url(url):
+    """Fetch a resource for weasyprint (remote stylesheets, fonts, images)
+    and keep its contents, so it is only fetched once per worker."""
+    from weasyprint import default_url_fetcher
+    resource = default_url_fetcher(url)
+    if 'file_obj' in resource:
+        resource['string'] = resource.pop('file_obj').read()
+    return resource
+
+
+def url_fetcher(url):
+    """Url fetcher for weasyprint that uses the cached fetch_url()."""
+    return dict(fetch_url(url))
+
+
+@lru_cache(maxsize=64)
+def parsed_stylesheet(fname, mtime_ns, size):
+    """Parse a stylesheet once per worker and version of the file."""
+    from weasyprint import CSS
+    return CSS(filename=fname, font_config=font_config(),
+               url_fetcher=url_fetcher)
+
+
+def stylesheet(fname):
+    """The parsed stylesheet in a file. It is parsed again when the file
+    changed (e.g., when it is edited between interactive runs)."""
+    stat = os.stat(fname)
+    return parsed_stylesheet(fname, stat.st_mtime_ns, stat.st_size)
+
+
+def shared_stylesheets(html):
+    """
+    Replace links to local stylesheets in html by pre-parsed stylesheets.
+    Returns the html without these links and the list of stylesheets that
+    should be passed to weasyprint instead.
+    """
+    fnames = [f for f in STYLESHEET_LINK.findall(html) if os.path.isfile(f)]
+    if len(fnames) == 0:
+        return html, []
+    html = STYLESHEET_LINK.sub(
+            lambda m: '' if m.group(1) in fnames else m.group(0), html)
+    return html, [stylesheet(f) for f in fnames]
+
+
+def render_document(html):
+    """Lay out html with weasyprint and return the rendered document."""
+    from weasyprint import HTML
+    html, stylesheets = shared_stylesheets(html)
+    document = HTML(string=html, base_url="", url_fetcher=url_fetcher)
+    return document.render(stylesheets=stylesheets, font_config=font_config())
+
+
+@lru_cache(maxsize=64)
+def static_document(html):
+    """Lay out html that is shared between reports. The rendered document is
+    cached, so layout is only done once per worker."""
+    return render_document(html)
+
+
+def layout_document(html, static=None):
+    """
+    Lay out html with weasyprint. With a page mask from static_pages(),
+    static pages are rendered once and spliced into the document, and only
+    the varying pages are laid out.
+    """
+    head, pages, tail = split_pages(html)
+    if static is None or len(pages) != len(static):
+        # Nothing to share: render the report in one go
+        return render_document(html)
+
+    # Render every run of pages separately, static runs come from the cache
+    documents = []
+    for is_static, run in page_runs(static):
+        run_html = head + ''.join(pages[i] for i in run) + tail
+        if is_static:
+            documents.append(static_document(run_html))
+        else:
+            documents.append(render_document(run_html))
+
+    # Stitch pages together in their original order
+    all_pages = [page for doc in documents for page in doc.pages]
+    return documents[0].copy(all_pages)
+
+
+def write_pdf(html, target=None, static=None, timings=None):
+    """
+    Render html to a pdf file. Returns the pdf data when target is None.
+
+    Arguments:
+    html -- the html of the report
+    target -- the filename of the pdf file or None
+    static -- page mask from static_pages() (see layout_document())
+    timings -- optional dict, the seconds spent on layout and writing the pdf
+               are stored in it
+    """
+    start = perf_counter()
+    document = layout_document(html, static)
+
+    laid_out = perf_counter()
+    data = document.write_pdf(target)
+
+    if timings is not None:
+        timings['layout'] = laid_out - start
+        timings['write'] = perf_counter() - laid_out
+
+    return data
+
+
+def assets_fingerprint(dirs=ASSET_DIRS):
+    """
+    Make a fingerprint of everything besides the html that determines the
+    contents of a pdf: the stylesheets, the templates and the version of
+    weasyprint.
+    """
+    import weasyprint
+
+    h = hashlib.sha256(weasyprint.__version__.encode())
+    for d in dirs:
+        for dirname, subdirs, fnames in os.walk(d):
+            subdirs.sort()
+            for fname in sorted(fnames):
+                fullfile = os.path.join(dirname, fname)
+                h.update(fullfile.encode())
+                h.update(file_digest(fullfile).encode())
+    return h.hexdigest()
+
+
+def report_hash(html, fingerprint):
+    """Content hash of a report: its html, the local stylesheets it links to
+    and the assets fingerprint (see assets_fingerprint())."""
+    h = hashlib.sha256(fingerprint.encode())
+    h.update(html.encode())
+    for fname in STYLESHEET_LINK.findall(html):
+        if os.path.isfile(fname):
+            h.update(file_digest(fname).encode())
+    return h.hexdigest()
+
+
+def load_manifest(outputdir):
+    """Load the manifest with the content hash per report."""
+    fname = outputdir + MANIFEST
+    if os.path.exists(fname) is False:
+        return {}
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(outputdir, manifest):
+    """Save the manifest and remove cached pdfs that no report refers to."""
+    with open(outputdir + MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    cachedir = outputdir + CACHE_DIR
+    if os.path.exists(cachedir) is False:
+        return
+    keep = set(h + '.pdf' for h in manifest.values())
+    for fname in os.listdir(cachedir):
+        if fname not in keep:
+            os.remove(cachedir + fname)
+
+
+def link_file(src, dst):
+    """Hard-link src to dst, or copy when hard-linking is not possible."""
+    delete_file_if_exists(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def cached_pdf(outputdir, h):
+    """The filename of the cached pdf with content hash h."""
+    return outputdir + CACHE_DIR + h + '.pdf'
+
+
+def restore_pdf(outputdir, h, target):
+    """Write the cached pdf with content hash h to target. Returns False if
+    there is no such pdf."""
+    cached = cached_pdf(outputdir, h)
+    if os.path.exists(cached) is False:
+        return False
+    link_file(cached, target)
+    return True
+
+
+def read_cached_pdf(outputdir, h):
+    """Return the data of the cached pdf with content hash h, or None if there
+    is no such pdf."""
+    cached = cached_pdf(outputdir, h)
+    if os.path.exists(cached) is False:
+        return None
+    with open(cached, 'rb') as f:
+        return f.read()
+
+
+def store_pdf(outputdir, h, data):
+    """Add the data of a rendered pdf to the cache under its content hash."""
+    cached = cached_pdf(outputdir, h)
+    if os.path.exists(cached):
+        return
+    os.makedirs(outputdir + CACHE_DIR, exist_ok=True)
+    # Write to a temporary file first, so that the cache never contains
+    # partially written pdfs
+    with open(cached + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(cached + '.tmp', cached)
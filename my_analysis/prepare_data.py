@@ -10,7 +10,9 @@ from nowpipes import pipe
 
 from helpers import (filepath, make_row_codes, count_unique_values, join_range,
                      items_range, mean_prefix, grade_prefix, items_scale_means,
-                     grade10, scale_var_names)
+                     grade10, scale_var_names, pairwise_stats,
+                     scale_reliability, pairwise_corr, group_moments,
+                     icc_oneway, rwg_j)
 
 
 @pipe
@@ -91,7 +93,8 @@ def research_model(data, **p):
     r['items_reverse_names'] = r.apply(lambda row: join_range(row['var'], '_',
                                        row['items_reverse_range']),
                                        axis='columns')
-    update_rows = r['items_reverse_names'].apply(lambda x: isinstance(x, list))
+    # Scales without reversed items have an empty range
+    update_rows = r['items_reverse_range'].apply(lambda x: len(x) == 0)
     r.items_reverse_names.where(update_rows != True, None, inplace=True)
 
     # Cannot use same name twice.
@@ -121,9 +124,6 @@ def scale_means(data, research_model, **p):
         for item in items:
             data.use[item] = (scalemax + 1) - data.use[item]
 
-    # Verify inter-item correlations do not include negative signs
-    # ensure_inter_item_corrs(deepcopy(data.use), deepcopy(research_model))
-
     # Calculate scale means
     means = items_scale_means(data.use, research_model)
 
@@ -153,6 +153,73 @@ def scale_means(data, research_model, **p):
     return means
 
 
+@pipe
+def reliability(data, research_model, scale_means, **p):
+    """
+    Inter-item correlations, Cronbach's alpha and item-rest correlations of
+    every scale in the research model, after reversing items (see
+    scale_means). The covariances and correlations of all items are computed
+    at once, after which every scale uses its own block. Negative inter-item
+    correlations are reported, or raise an error with the reliability_strict
+    parameter.
+    """
+    r = dict(corr=dict())
+
+    items = list(dict.fromkeys(item for names in research_model.items_names
+                               for item in names))
+    n, cov, corr = pairwise_stats(data.use[items])
+
+    scales = []
+    item_tables = []
+    for _, row in research_model.iterrows():
+        names = list(row['items_names'])
+        block = corr.loc[names, names]
+        scale, table = scale_reliability(cov.loc[names, names], block)
+        scale['mean_name'] = row['mean_name']
+        scale['min_n'] = n.loc[names, names].to_numpy().min()
+        scale['negative'] = bool((block.to_numpy() < 0).any())
+        scales.append(scale)
+
+        reverse = row['items_reverse_names'] or []
+        table.insert(0, 'mean_name', row['mean_name'])
+        table.insert(1, 'item', table.index)
+        table.insert(2, 'reversed', table.index.isin(reverse))
+        table['negative'] = table['min_corr'] < 0
+        item_tables.append(table)
+        r['corr'][row['mean_name']] = block
+
+    r['scales'] = DataFrame(scales, columns=['mean_name', 'items', 'min_n',
+                                             'alpha', 'alpha_std', 'mean_corr',
+                                             'min_corr', 'negative'])
+    r['items'] = pd.concat(item_tables, ignore_index=True)
+
+    # Negative inter-item correlations suggest an item that should be
+    # reversed (or should not be), see items_reverse_names
+    problems = list(r['scales'].loc[r['scales']['negative'], 'mean_name'])
+    if len(problems) > 0:
+        message = ('There are negative inter-item corrs for scales: ' +
+                   ' '.join(problems))
+        if p.get('reliability_strict', False):
+            raise ValueError(message)
+        print(f"  WARNING: {message}")
+
+    return r
+
+
+@pipe
+def correlations(data, research_model, scale_means, **p):
+    """
+    Pairwise correlations between the grade scores of all scales, with their
+    p-values and number of respondents (see helpers.pairwise_corr()). Set
+    the correlation_dtype parameter to 'float32' to halve the time and
+    memory on large datasets.
+    """
+    dtype = np.dtype(p.get('correlation_dtype', 'float64'))
+    corr, pvalues, n = pairwise_corr(data.use[research_model['grade_name']],
+                                     dtype)
+    return dict(corr=corr, p=pvalues, n=n)
+
+
 @pipe
 def aggregate(data, research_model, nesting, scale_means, **p):
     """Aggregate scale means per nesting column."""
@@ -176,3 +243,43 @@ def aggregate(data, research_model, nesting, scale_means, **p):
         r[n] = subdf
 
     return r
+
+
+@pipe
+def agreement(data, research_model, nesting, scale_means, **p):
+    """
+    Within-group agreement per scale for each nesting variable, to judge
+    whether aggregated scores (e.g., team means) are meaningful: ICC(1) and
+    ICC(2) of the scale means, and rwg(J) of every nesting entry from the
+    variances of the scale items. All statistics come from one grouped pass
+    over the scale means and items per nesting.
+    """
+    r = dict(icc=dict(), rwg=dict())
+
+    means = list(research_model['mean_name'])
+    items = list(dict.fromkeys(item for names in research_model.items_names
+                               for item in names))
+
+    for n in p['nestings']:
+        sums, squares, counts = group_moments(data.use, n, means + items)
+
+        icc = icc_oneway(sums[means], squares[means], counts[means])
+        icc.insert(0, 'mean_name', means)
+
+        # Within-group variance of every item. Entries with one respondent
+        # have no variance.
+        variances = (squares[items] - sums[items] ** 2 / counts[items]) / \
+            (counts[items] - 1)
+        rwg = DataFrame({row['mean_name']: rwg_j(
+            variances[list(row['items_names'])].mean(axis='columns'),
+            len(row['items_names']), row['scalemax'])
+            for _, row in research_model.iterrows()})
+
+        icc['mean_rwg'] = rwg.mean().to_numpy()
+        icc['median_rwg'] = rwg.median().to_numpy()
+        r['icc'][n] = icc
+
+        rwg['value'] = rwg.index
+        r['rwg'][n] = rwg.merge(nesting[n], on='value', how='left')
+
+    return r
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import cProfile
+import resource
+
+from pandas import DataFrame
+
+from helpers import object_size, make_str_date
+
+
+def semopy_size(obj, seen=None):
+    """The memory size of the semopy objects (models, solver results) in a
+    result, see models.slim_sem()."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if type(obj).__module__.split('.')[0] == 'semopy':
+        return object_size(obj)
+    if isinstance(obj, dict):
+        return sum(semopy_size(v, seen) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(semopy_size(x, seen) for x in obj)
+    return 0
+
+
+def slimmed_size(obj, seen=None):
+    """The memory size of the semopy objects that were dropped from a result
+    (see models.slim_sem())."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, dict):
+        return obj.get('slimmed_size', 0) + sum(
+            slimmed_size(v, seen) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(slimmed_size(x, seen) for x in obj)
+    return 0
+
+
+def peak_rss():
+    """Peak resident set size (high-water mark) of this process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+
+class StageProfiler:
+    """
+    Stage hook (see stages.hooked_stage()) that records for every stage:
+    wall time, cpu time, the growth of the peak resident set size, the size
+    of the result, how much of it are semopy objects and the size of the
+    semopy objects that were left out (see slim_models in the analysis
+    config). Optionally, a cProfile dump is written per stage, which can
+    be inspected with pstats, snakeviz or converted to a flamegraph.
+
+    NOTE: cpu time and peak RSS are measured for the whole process. When
+    stages run concurrently (stage_workers > 1), they include other stages.
+    """
+
+    def __init__(self, outputdir, cprofile=False):
+        self.outputdir = outputdir
+        self.cprofile = cprofile
+        self.dt = make_str_date()
+        self.records = []
+
+    def profile_dir(self):
+        """The directory for the cProfile dumps."""
+        return self.outputdir + 'profile_' + self.dt + '/'
+
+    def __call__(self, stage, call, inputs, p):
+        rss = peak_rss()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+
+        if self.cprofile:
+            profile = cProfile.Profile()
+            result = profile.runcall(call)
+        else:
+            result = call()
+
+        record = {
+            'stage': stage.name,
+            'module': stage.module.__name__,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'peak_rss_delta': peak_rss() - rss,
+            'output_size': object_size(result),
+            'semopy_size': semopy_size(result),
+            'slimmed_size': slimmed_size(result)
+        }
+        self.records.append(record)
+
+        if self.cprofile:
+            os.makedirs(self.profile_dir(), exist_ok=True)
+            profile.dump_stats(self.profile_dir() + stage.name + '.prof')
+
+        return result
+
+    def table(self):
+        """The profile as a table with one row per stage."""
+        return DataFrame(self.records).set_index('stage')
+
+    def write(self):
+        """Write the profile to a JSON file in outputdir and print a
+        summary. Returns the filename."""
+        fname = self.outputdir + 'profile_' + self.dt + '.json'
+        with open(fname, 'w') as f:
+            json.dump(self.records, f, indent=1)
+
+        table = self.table()
+        table['peak_rss_delta'] = (table['peak_rss_delta'] / 2**20).round(1)
+        table['output_size'] = (table['output_size'] / 2**20).round(1)
+        table['semopy_size'] = (table['semopy_size'] / 2**20).round(1)
+        table['slimmed_size'] = (table['slimmed_size'] / 2**20).round(1)
+        table = table.rename(columns={'peak_rss_delta': 'rss_mb',
+                                      'output_size': 'size_mb',
+                                      'semopy_size': 'semopy_mb',
+                                      'slimmed_size': 'slimmed_mb'})
+        print(" Stage profile:")
+        for line in table.round(3).to_string().split('\n'):
+            print("  " + line)
+        print(f" Total result size: {table['size_mb'].sum():.1f} MB, of " +
+              f"which semopy objects: {table['semopy_mb'].sum():.1f} MB, " +
+              f"left out by slim_models: {table['slimmed_mb'].sum():.1f} MB")
+        print(f" Profile in: {fname}")
+        if self.cprofile:
+            print(f" cProfile dumps in: {self.profile_dir()}")
+
+        return fname
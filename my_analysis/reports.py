@@ -1,18 +1,20 @@
-from nowslides import load_yaml, render_presentation
 from nowpipes import pipe
-from weasyprint import HTML
 from importlib import reload
 from helpers import (make_str_date, make_report_fname, isinteractive,
                      make_org_report_fname)
+from timings import (worker_id, timing_log_fname, log_timing,
+                     print_timings_summary)
+from pdfs import (static_pages, write_pdf, assets_fingerprint, report_hash,
+                  load_manifest, save_manifest, store_pdf, read_cached_pdf,
+                  cached_pdf, link_file)
 from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
                                 as_completed)
-from copy import deepcopy
 
-from zipfile import ZipFile
-from os.path import basename
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
 
 import logging
 import os
+import time
 
 
 def make_report(results, prefix, nesting, no, y, elparsers, doprev=False,
@@ -30,7 +32,11 @@ def make_report(results, prefix, nesting, no, y, elparsers, doprev=False,
     doprev -- Whether previous comparison values should be retrieved
     """
     from entities import (get_response, get_scores, get_summary, get_advice,
-                          get_prev_scores, get_advice_by_dvcluster)
+                          get_prev_scores, get_advice_by_dvcluster,
+                          get_score_slots)
+    from nowslides import render_presentation
+
+    start = time.perf_counter()
 
     # Variables that are provided to render the report
     variables = {
@@ -45,6 +51,8 @@ def make_report(results, prefix, nesting, no, y, elparsers, doprev=False,
         'advice': get_advice(results, nesting, no),
         'advice_by_dvcluster': get_advice_by_dvcluster(results, nesting, no)
     }
+    # Scores indexed by variable, filled into the score elements
+    variables['score_slots'] = get_score_slots(variables['scores'])
 
     # Add previous scores if requested
     if doprev:
@@ -53,7 +61,10 @@ def make_report(results, prefix, nesting, no, y, elparsers, doprev=False,
         variables['prev_mark_delta'] = prev_mark_delta
 
     # Render the actual presentation
+    gathered = time.perf_counter()
     html = render_presentation(y, variables, elparsers)
+    timings = {'gather': gathered - start,
+               'html': time.perf_counter() - gathered}
 
     # The resulting report information
     report = {
@@ -61,7 +72,8 @@ def make_report(results, prefix, nesting, no, y, elparsers, doprev=False,
         'nesting': nesting,
         'value': variables['response']['value'],
         'no': no,
-        'html': html
+        'html': html,
+        'timings': timings
     }
 
     return report
@@ -80,7 +92,11 @@ def make_org_report(results, y, elparsers, doprev=False):
     from entities import (get_org_response, get_org_scores,
                           get_org_summary, get_ivstats,
                           get_org_prev_scores,
-                          get_org_advice_for_dvclusters)
+                          get_org_advice_for_dvclusters,
+                          get_score_slots, get_ivstat_slots)
+    from nowslides import render_presentation
+
+    start = time.perf_counter()
 
     # Variables that are provided to render the report
     variables = {
@@ -95,84 +111,269 @@ def make_org_report(results, y, elparsers, doprev=False):
         'ivstats': get_ivstats(results),
         'advice_by_dvcluster': get_org_advice_for_dvclusters(results)
     }
+    # Scores and ivstats indexed by variable, filled into the elements
+    variables['score_slots'] = get_score_slots(variables['scores'])
+    variables['ivstat_slots'] = get_ivstat_slots(variables['ivstats'])
 
     # Add previous scores if requested
     if doprev:
         variables['prev'] = get_org_prev_scores(results)
 
     # Render the actual presentation
+    gathered = time.perf_counter()
     html = render_presentation(y, variables, elparsers)
+    timings = {'gather': gathered - start,
+               'html': time.perf_counter() - gathered}
 
     # The resulting report information
     report = {
         'title': variables['title'],
-        'html': html
+        'html': html,
+        'timings': timings
     }
 
     return report
 
 
-def write_report(report, nesting, fpath):
+# Compression methods for the zip archives. PDFs are already compressed, so
+# storing them is nearly as small and a lot faster.
+ZIP_COMPRESSION = {
+    'stored': ZIP_STORED,
+    'deflated': ZIP_DEFLATED,
+    'bzip2': ZIP_BZIP2,
+    'lzma': ZIP_LZMA
+}
+
+
+def pdf_options(p):
+    """Get the options for writing pdfs from the reports configuration."""
+    return {
+        'share_pages': p.get('static_pages', True),
+        'incremental': p.get('incremental', True),
+        'loose_pdfs': p.get('loose_pdfs', True),
+        'compression': p.get('zip_compression', 'stored'),
+        'compresslevel': p.get('zip_compresslevel', None),
+        'log_timings': p.get('log_timings', True)
+    }
+
+
+def write_report(html, fname, static=None, submitted=None):
     """
-    Write HTML report to PDF file for provided report.
+    Render HTML report to PDF. Returns the PDF data and the timings of
+    rendering it.
 
     Arguments:
-    report: the report dictionary (from make_report())
-    nesting: the name of the nesting to write the report for
-    fpath: the directory where the file should be written
-    """
-    # The number of the report
-    no = report.no
-    # The name of the entity value (e.g., team name)
-    value = report.value
-    # The filename of the pdf file
-    fname = make_report_fname(nesting, no, value)
-    fullfname = fpath + fname + '.pdf'
-    print(f"  Making PDF #{no} for {fname}", end="\r")
-    # Use weasyprint to generate pdf file and write to disk
-    html = HTML(string=report.html, base_url="")
-    html.write_pdf(fullfname)
+    html: the HTML of the report (see make_report())
+    fname: the name of the report (for progress output)
+    static: page mask of entity-independent pages (see pdfs.static_pages())
+    submitted: the time at which the report was submitted to the workers
+    """
+    timings = {'worker': worker_id()}
+    if submitted is not None:
+        timings['queue_wait'] = time.time() - submitted
+    print(f"  Making PDF for {fname}", end="\r")
+    # Use weasyprint to generate pdf
+    data = write_pdf(html, None, static, timings)
+    return data, timings
 
 
-def write_reports_for_nesting(reports, nesting, fpath, sanitize, multiproc=2,
-                              Executor=ThreadPoolExecutor):
-    # Make filename for the zipfile and directory
+def write_reports(nestings, fpath, multiproc=2, Executor=ThreadPoolExecutor,
+                  org_report=None, share_pages=True, incremental=True,
+                  loose_pdfs=True, compression='stored', compresslevel=None,
+                  log_timings=True):
+    """
+    Render HTML reports to PDF for all nestings, and optionally the org
+    report, on one pool of workers. Reports are scheduled largest first so
+    that workers are not left idle at the end. Every nesting is written to a
+    zip archive and, optionally, to a directory. PDFs are written as soon as
+    they are rendered, from this (single) thread.
+
+    Arguments:
+    nestings -- dict with the HTML reports (see make_report()) per nesting
+    fpath -- the directory where the files should be written
+    multiproc -- the number of workers
+    Executor -- the executor class (threads or processes)
+    org_report -- the HTML org report (see make_org_report()) or None
+    (see pdf_options() for the other arguments)
+    """
+    # Reports that did not change since the previous run are not rendered
+    # again, but are taken from the pdf cache in the output directory
+    outputdir = fpath
+    if incremental:
+        manifest = load_manifest(outputdir)
+        fingerprint = assets_fingerprint()
+
     dt = make_str_date()
-    zipf = fpath + nesting + '_' + dt
-    fpath = zipf + '/'
-    zipf += '.zip'
-    print(f"  Making PDFs for '{nesting}', writing to: {fpath}")
-
-    # Make directory if not exists
-    if os.path.exists(fpath) is False:
-        print("    -> Making directory")
-        os.makedirs(fpath)
-
-    # Render HTML reports to PDF and write to disk
-    with Executor(max_workers=multiproc) as executor:
-        futures = []
+    # Where to write the pdfs per nesting, and how many are still to come
+    outputs = {}
+    # Every job is (nesting, manifest key, filename, report, static pages)
+    jobs = []
+
+    for nesting, reports in nestings.items():
+        # Make filename for the zipfile and directory
+        zipf = fpath + nesting + '_' + dt
+        out = {'dir': zipf + '/', 'zipf': zipf + '.zip',
+               'pending': len(reports)}
+        print(f"  Making PDFs for '{nesting}', writing to: {out['zipf']}")
+
+        # Make directory if not exists
+        if loose_pdfs and os.path.exists(out['dir']) is False:
+            print(f"    -> Making directory {out['dir']}")
+            os.makedirs(out['dir'])
+
+        out['zip'] = ZipFile(out['zipf'], 'w',
+                             compression=ZIP_COMPRESSION[compression],
+                             compresslevel=compresslevel)
+        outputs[nesting] = out
+
+        # Find pages that are the same for every report, so that these are
+        # only laid out once per worker instead of once per report
+        static = None
+        if share_pages:
+            static = static_pages([r.html for r in reports.values()])
+            if static is not None:
+                print(f"    -> Sharing {sum(static)} of {len(static)} pages")
+
         for report in reports.values():
-            futures.append(executor.submit(write_report,
-                                           report=deepcopy(report),
-                                           nesting=deepcopy(nesting),
-                                           fpath=deepcopy(fpath)))
-        for future in as_completed(futures):
-            pass
+            fname = make_report_fname(nesting, report.no, report.value)
+            jobs.append((nesting, fname, fname, report, static))
+
+    if org_report is not None:
+        outputs['organisatie'] = {'dir': fpath, 'zip': None, 'pending': 1}
+        fname = make_org_report_fname('organisatie')
+        jobs.append(('organisatie', 'organisatie', fname, org_report, None))
+
+    def finish(nesting):
+        """Close the archive of a nesting when all its pdfs are written."""
+        out = outputs[nesting]
+        if out['pending'] > 0 or out['zip'] is None:
+            return
+        out['zip'].close()
+        print(f"  PDFs for '{nesting}' in: {out['zipf']}" + " " * 20)
+
+    def write_output(nesting, fname, data, cached=None):
+        """Write pdf data to the archive and the directory."""
+        out = outputs[nesting]
+        if out['zip'] is not None:
+            out['zip'].writestr(fname, data)
+        if out['zip'] is None or loose_pdfs:
+            if cached is not None:
+                link_file(cached, out['dir'] + fname)
+            else:
+                with open(out['dir'] + fname, 'wb') as f:
+                    f.write(data)
+        out['pending'] -= 1
+        finish(nesting)
+
+    # Largest reports first. The size of the html is a good indication of
+    # how long it takes to render the pdf.
+    jobs.sort(key=lambda job: len(job[3].html), reverse=True)
+
+    # Log the timings of every report to a JSONL file
+    records = []
+    timing_log = None
+    if log_timings:
+        timing_log = open(timing_log_fname(outputdir, dt), 'w')
+
+    def write_timings(nesting, fname, report, timings):
+        """Log and keep the timings of a report."""
+        record = {'nesting': nesting, 'report': fname}
+        record.update(report.get('timings', {}))
+        record.update(timings)
+        records.append(record)
+        if timing_log is not None:
+            log_timing(timing_log, record)
+
+    # Render HTML reports to PDF and write them as they complete
+    start = time.perf_counter()
+    try:
+        for nesting in outputs:
+            finish(nesting)
+        with Executor(max_workers=multiproc) as executor:
+            futures = {}
+            reused = 0
+            for nesting, key, fname, report, static in jobs:
+                h = None
+                if incremental:
+                    h = report_hash(report.html, fingerprint)
+                    manifest[nesting + '/' + key] = h
+                    cached = read_cached_pdf(outputdir, h)
+                    if cached is not None:
+                        zipped = time.perf_counter()
+                        write_output(nesting, fname + '.pdf', cached,
+                                     cached_pdf(outputdir, h))
+                        zipped = time.perf_counter() - zipped
+                        write_timings(nesting, fname, report,
+                                      {'reused': True, 'zip': zipped})
+                        reused += 1
+                        continue
+                future = executor.submit(write_report, report.html, fname,
+                                         static, time.time())
+                futures[future] = (nesting, fname, report, h)
+            for future in as_completed(futures):
+                nesting, fname, report, h = futures[future]
+                data, timings = future.result()
+                zipped = time.perf_counter()
+                if incremental:
+                    store_pdf(outputdir, h, data)
+                    write_output(nesting, fname + '.pdf', data,
+                                 cached_pdf(outputdir, h))
+                else:
+                    write_output(nesting, fname + '.pdf', data)
+                timings['zip'] = time.perf_counter() - zipped
+                timings['reused'] = False
+                write_timings(nesting, fname, report, timings)
+    finally:
+        for out in outputs.values():
+            if out['zip'] is not None:
+                out['zip'].close()
+        if timing_log is not None:
+            timing_log.close()
 
     print()
-    print(f"  Zipping to: {zipf}")
-    # Make zip archive for reports
-    with ZipFile(zipf, 'w') as zipobj:
-        for dirname, subdirs, fnames in os.walk(fpath):
-            for fname in fnames:
-                fullfile = os.path.join(dirname, fname)
-                zipobj.write(fullfile, basename(fullfile))
-
-    print("\n  Zipping DONE!\n")
-    print(f"  PDFs for '{nesting}' in: {fpath}")
+    if incremental:
+        save_manifest(outputdir, manifest)
+        print(f"    -> Reused {reused} unchanged PDFs")
+    print_timings_summary(records, time.perf_counter() - start)
+    if timing_log is not None:
+        print(f"  Report timings in: {timing_log_fname(outputdir, dt)}")
     print("")
 
 
+def write_reports_for_nesting(reports, nesting, fpath, sanitize, multiproc=2,
+                              Executor=ThreadPoolExecutor, **options):
+    """
+    Render HTML reports of one nesting to PDF (see write_reports()).
+    """
+    write_reports({nesting: reports}, fpath, multiproc, Executor, **options)
+
+
+def write_options(reports_config):
+    """The reports configuration without the inputs of the reports pipeline
+    (results, sanitize), to pass on to write_all_reports()."""
+    return {k: v for k, v in reports_config.items()
+            if k not in ('results', 'sanitize')}
+
+
+def write_all_reports(results, nestings, **p):
+    """
+    Render the org report and the HTML reports of all provided nestings to
+    PDF on one long-lived pool of workers, instead of one pool per nesting.
+
+    Arguments:
+    results -- the results of the reports pipeline (setup, org_report and
+               <nesting>_reports)
+    nestings -- the nestings to write pdfs for (e.g., ['org', 'team'])
+    """
+    fpath = p.get('outputdir', './output/')
+    # Get number of cores to use
+    multiproc = p.get('multiproc', 2)
+    reports = {n: results[n + '_reports'] for n in nestings if n != 'org'}
+    org_report = results.org_report if 'org' in nestings else None
+    write_reports(reports, fpath, multiproc, Executor=results.setup.executor,
+                  org_report=org_report, **pdf_options(p))
+
+
 @pipe
 def setup(**p):
     """
@@ -181,8 +382,9 @@ def setup(**p):
     import nowslides
     import elparsers
 
-    reload(elparsers)
-    reload(nowslides)
+    if p.get('reload', False):
+        reload(elparsers)
+        reload(nowslides)
 
     # Set the template path from configuration
     nowslides.set_template_path(p.get('tpldir', './templates/'))
@@ -208,12 +410,14 @@ def setup(**p):
         'executor': executor,
         # Custom element parsers for template rendering
         'elparsers': elparsers.elparsers,
+        # Makes the element parsers for a render plan (once per nesting)
+        'compile_elparsers': elparsers.compile_elparsers,
         # The respective YAML presentations to use for template rendering
-        'y_team': load_yaml('./assets/yaml/_team.yaml'),
-        'y_functie': load_yaml('./assets/yaml/functie.yaml'),
-        'y_unit': load_yaml('./assets/yaml/unit.yaml'),
-        'y_onderdeel': load_yaml('./assets/yaml/onderdeel.yaml'),
-        'y_org': load_yaml('./assets/yaml/org.yaml')
+        'y_team': nowslides.load_yaml('./assets/yaml/_team.yaml'),
+        'y_functie': nowslides.load_yaml('./assets/yaml/functie.yaml'),
+        'y_unit': nowslides.load_yaml('./assets/yaml/unit.yaml'),
+        'y_onderdeel': nowslides.load_yaml('./assets/yaml/onderdeel.yaml'),
+        'y_org': nowslides.load_yaml('./assets/yaml/org.yaml')
     }
 
 
@@ -226,8 +430,8 @@ def team_reports(setup, **p):
 
     # The YAML presentation format
     y = setup.y_team
-    # The custom element parsers
-    elparsers = setup.elparsers
+    # The custom element parsers, compiled once for all reports
+    elparsers = setup.compile_elparsers(setup.elparsers)
     # The team prefix
     prefix = 'Team: '
 
@@ -263,8 +467,8 @@ def functie_reports(setup, **p):
 
     # The YAML presentation format
     y = setup.y_functie
-    # The custom element parsers
-    elparsers = setup.elparsers
+    # The custom element parsers, compiled once for all reports
+    elparsers = setup.compile_elparsers(setup.elparsers)
     # The functie prefix
     prefix = 'Functie: '
 
@@ -298,8 +502,8 @@ def unit_reports(setup, **p):
 
     # The YAML presentation format
     y = setup.y_unit
-    # The custom element parsers
-    elparsers = setup.elparsers
+    # The custom element parsers, compiled once for all reports
+    elparsers = setup.compile_elparsers(setup.elparsers)
     # The functie prefix
     prefix = 'Divisie: '
 
@@ -333,8 +537,8 @@ def onderdeel_reports(setup, **p):
 
     # The YAML presentation format
     y = setup.y_onderdeel
-    # The custom element parsers
-    elparsers = setup.elparsers
+    # The custom element parsers, compiled once for all reports
+    elparsers = setup.compile_elparsers(setup.elparsers)
     # The functie prefix
     prefix = 'Onderdeel: '
 
@@ -366,8 +570,8 @@ def org_report(setup, **p):
     """
     # The YAML presentation format
     y = setup.y_org
-    # The custom element parsers
-    elparsers = setup.elparsers
+    # The custom element parsers, compiled once for all reports
+    elparsers = setup.compile_elparsers(setup.elparsers)
     # Retrieve where there are previous scores to process
     doprev = p.get('prev', False)
     # Make the actual HTML report
@@ -387,7 +591,8 @@ def write_team_reports(setup, team_reports, **p):
     sanitize = p['sanitize']
     executor = setup.executor
     write_reports_for_nesting(team_reports, 'team', fpath, sanitize,
-                              multiproc, Executor=executor)
+                              multiproc, Executor=executor,
+                              **pdf_options(p))
 
 
 @pipe
@@ -403,7 +608,8 @@ def write_functie_reports(setup, functie_reports, **p):
     sanitize = p['sanitize']
     executor = setup.executor
     write_reports_for_nesting(functie_reports, 'functie', fpath, sanitize,
-                              multiproc, Executor=executor)
+                              multiproc, Executor=executor,
+                              **pdf_options(p))
 
 
 @pipe
@@ -419,7 +625,8 @@ def write_unit_reports(setup, unit_reports, **p):
     sanitize = p['sanitize']
     executor = setup.executor
     write_reports_for_nesting(unit_reports, 'unit', fpath, sanitize,
-                              multiproc, Executor=executor)
+                              multiproc, Executor=executor,
+                              **pdf_options(p))
 
 @pipe
 def write_onderdeel_reports(setup, onderdeel_reports, **p):
@@ -434,7 +641,8 @@ def write_onderdeel_reports(setup, onderdeel_reports, **p):
     sanitize = p['sanitize']
     executor = setup.executor
     write_reports_for_nesting(onderdeel_reports, 'onderdeel', fpath, sanitize,
-                              multiproc, Executor=executor)
+                              multiproc, Executor=executor,
+                              **pdf_options(p))
 
 
 @pipe
@@ -443,13 +651,4 @@ def write_org_report(org_report, **p):
     Generate org report to PDF and write to disk
     """
     fpath = p.get('outputdir', './output/')
-
-    fname = make_org_report_fname('organisatie')
-    fullfname = fpath + fname + '.pdf'
-    print(f"  Making PDF for {fname}", end="\r")
-    html = HTML(string=org_report.html, base_url="")
-    html.write_pdf(fullfname)
-
-    print()
-    print(f"  PDFs for 'organisatie' in: {fpath}")
-    print("")
+    write_reports({}, fpath, 1, org_report=org_report, **pdf_options(p))
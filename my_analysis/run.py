@@ -1,66 +1,91 @@
 from importlib import reload
 
+import args
+
+# Parse commandline arguments first, so that --help does not have to wait for
+# the pipeline modules to be imported
+params = args.parser.parse_args()
+
 from nowpipes import Pipeline
 
 from helpers import sanitize_filename, reload_modules
-from analysis import results, output_files, output_dataset
-from reports import setup
+from reports import setup, write_all_reports, write_options
+from snapshot import load_snapshot, snapshot_dir
 
 import config
-import args
 
 
 # TODO: refactor so that it can handle multiple nestings
 
 
-# (Re)load modules
-reload_modules(['analysis', 'reports'])
-reload(config)
+# (Re)load modules that changed during an interactive session
+if params.reload:
+    reload_modules(['analysis', 'reports'])
+    reload(config)
 
-# Parse commandline arguments
-params = args.parser.parse_args()
+if params.command == 'report':
+    # Load the results of a previous analysis
+    r = load_snapshot(params.snapshot or snapshot_dir(config.outputdir))
+else:
+    from analysis import results, output_files, output_dataset
 
-# Make the data pipeline
-data = Pipeline()
-data.config(
-    outputdir=config.outputdir
-)
+    # Make the data pipeline
+    data = Pipeline()
+    data.config(
+        outputdir=config.outputdir,
+        profile=params.profile,
+        cprofile=params.cprofile,
+        recompute=params.recompute,
+        reload=params.reload,
+        dump_format=params.dump_format,
+        # Reports are made from the snapshot later on (see the report
+        # command)
+        snapshot=params.command == 'analyze'
+    )
 
-data.add(results)
-if params.dodump:
-    data.add(output_files)
-if params.dodataset:
-    data.add(output_dataset)
+    data.add(results)
+    if params.dodump:
+        data.add(output_files)
+    if params.dodataset:
+        data.add(output_dataset)
 
-# Compute results
-# data.add(output_files)
-# data.add(output_dataset)
-data.run(verbose=True)
-r = data.results
+    # Compute results
+    # data.add(output_files)
+    # data.add(output_dataset)
+    data.run(verbose=True)
+    r = data.results
+
+if params.command == 'analyze':
+    raise SystemExit
 
 # Make the reports pipeline
 reports = Pipeline()
 reports_config = config.reports | dict(
     results=r,
-    sanitize=sanitize_filename
+    sanitize=sanitize_filename,
+    reload=params.reload
 )
 reports.config(**reports_config)
 reports.add(setup)
 if 'org' in params.nestings:
-    from reports import org_report, write_org_report
-    reports.add(org_report, write_org_report)
+    from reports import org_report
+    reports.add(org_report)
 if 'team' in params.nestings:
-    from reports import team_reports, write_team_reports
-    reports.add(team_reports, write_team_reports)
+    from reports import team_reports
+    reports.add(team_reports)
 if 'functie' in params.nestings:
-    from reports import functie_reports, write_functie_reports
-    reports.add(functie_reports, write_functie_reports)
+    from reports import functie_reports
+    reports.add(functie_reports)
 if 'unit' in params.nestings:
-    from reports import unit_reports, write_unit_reports
-    reports.add(unit_reports, write_unit_reports)
+    from reports import unit_reports
+    reports.add(unit_reports)
 if 'onderdeel' in params.nestings:
-    from reports import onderdeel_reports, write_onderdeel_reports
-    reports.add(onderdeel_reports, write_onderdeel_reports)
+    from reports import onderdeel_reports
+    reports.add(onderdeel_reports)
 
-# Make reports
+# Make HTML reports
 reports.run(verbose=True)
+
+# Write the PDFs for all nestings on one pool of workers
+write_all_reports(reports.results, params.nestings,
+                  **write_options(reports_config))
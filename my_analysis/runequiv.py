@@ -0,0 +1,35 @@
+import sys
+import argparse
+
+from equivalence import RTOL, ATOL, equivalence
+from scaling import parse_size
+
+import config
+
+
+parser = argparse.ArgumentParser(
+        description='Check that the fast engine of the analysis gives the '
+                    'same results as the reference engine, and report the '
+                    'speedup per stage.')
+
+parser.add_argument('-s', '--sizes', dest='sizes', nargs='*',
+                    type=parse_size,
+                    help='Sizes of synthetic workloads as respondents:teams '
+                         '(default: 1000:50 10000:500)',
+                    default=[(1000, 50), (10000, 500)])
+
+parser.add_argument('-r', '--recorded', dest='recorded', action='store_true',
+                    help='Also check the input data in the configuration',
+                    default=False)
+
+parser.add_argument('--rtol', dest='rtol', type=float,
+                    help='Relative tolerance for numbers', default=RTOL)
+
+parser.add_argument('--atol', dest='atol', type=float,
+                    help='Absolute tolerance for numbers', default=ATOL)
+
+params = parser.parse_args()
+
+if not equivalence(config.outputdir, params.sizes, params.recorded,
+                   params.rtol, params.atol):
+    sys.exit(1)
@@ -30,7 +30,8 @@ reload(config)
 # Make the data pipeline
 data = Pipeline()
 data.config(
-    outputdir=config.outputdir
+    outputdir=config.outputdir,
+    reload=True
 )
 
 data.add(results)
@@ -0,0 +1,41 @@
+import argparse
+
+from scaling import SIZES, parse_size, benchmark
+
+import config
+
+
+parser = argparse.ArgumentParser(
+        description='Benchmark the analysis and reports on synthetic data of '
+                    'several sizes and write the timings per stage to a JSON '
+                    'file.')
+
+parser.add_argument('-s', '--sizes', dest='sizes', nargs='+', type=parse_size,
+                    help='Workload sizes as respondents:teams, e.g., '
+                         '1000:50 10000:500 (default: ' +
+                         ' '.join(f'{r}:{t}' for r, t in SIZES) + ')',
+                    default=SIZES)
+
+parser.add_argument('--items', dest='items', type=int,
+                    help='The number of items per scale', default=4)
+
+parser.add_argument('--scales', dest='scales', type=int,
+                    help='The number of scales', default=8)
+
+parser.add_argument('--models', dest='models', type=int,
+                    help='The number of regression models', default=4)
+
+parser.add_argument('--no-reports', dest='reports', action='store_false',
+                    help='Only benchmark the analysis, not the reports',
+                    default=True)
+
+parser.add_argument('--compare', dest='previous',
+                    help='A previous benchmark result (JSON) to compare to '
+                         '(default: the most recent one in the output '
+                         'directory)',
+                    default=None)
+
+params = parser.parse_args()
+
+benchmark(config.outputdir, params.sizes, params.items, params.scales,
+          params.models, params.reports, params.previous)
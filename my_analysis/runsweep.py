@@ -0,0 +1,22 @@
+import argparse
+
+from sweep import sweep
+
+import config
+
+
+parser = argparse.ArgumentParser(
+        description='Run the analysis for a grid of parameter sets and '
+                    'compare the advice and rankings.')
+
+parser.add_argument('params', nargs='+',
+                    help='Analysis parameter and values to sweep, e.g., '
+                         'r10_quantile=.8,.9 weigh_growth_by=mean_est,max_est')
+
+parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                    help='The number of parameter sets to run in parallel',
+                    default=config.reports['multiproc'])
+
+params = parser.parse_args()
+
+sweep(params.params, config.outputdir, params.jobs)
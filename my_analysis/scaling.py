@@ -0,0 +1,193 @@
+import os
+import gc
+import json
+import glob
+import platform
+import subprocess
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from nowpipes import Pipeline
+
+from helpers import make_str_date, sanitize_filename
+from profiler import StageProfiler
+from synthetic import NESTINGS, write_workload
+
+import config
+import stages
+
+
+# Workload sizes to benchmark: (respondents, teams)
+SIZES = ((1000, 50), (10000, 500), (100000, 5000))
+# Directory (in outputdir) for the synthetic workloads and benchmark results
+SCALING_DIR = 'scaling/'
+# Report stages that are timed, besides write_all_reports
+REPORT_STAGES = ('setup', 'org_report', 'team_reports', 'functie_reports',
+                 'onderdeel_reports')
+
+
+def parse_size(spec):
+    """Parse a workload size like '10000:500' (respondents:teams)."""
+    respondents, _, teams = spec.partition(':')
+    return int(respondents), int(teams)
+
+
+def workload_params(respondents, teams):
+    """The number of functies and onderdelen for a workload, which grow with
+    the number of teams."""
+    return dict(respondents=respondents, teams=teams,
+                functies=max(5, teams // 10), onderdelen=max(3, teams // 50))
+
+
+def environment():
+    """The versions of python, the main dependencies and the code, to tell
+    benchmark results of different versions apart."""
+    import semopy
+
+    try:
+        revision = subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return dict(revision=revision,
+                python=platform.python_version(),
+                pandas=pd.__version__,
+                numpy=np.__version__,
+                semopy=semopy.__version__,
+                machine=platform.machine(),
+                cpus=os.cpu_count())
+
+
+def time_analysis(analysis_config, profiler):
+    """Run the analysis stages one after the other, profiling every stage.
+    Returns the results."""
+    from analysis import analysis_parts
+
+    analysis = Pipeline()
+    analysis.config(**analysis_config)
+    analysis.add(*stages.hooked_stages(analysis_parts(), profiler))
+    analysis.run(verbose=False)
+    return analysis.results
+
+
+def time_reports(r, outputdir, profiler):
+    """Make the HTML reports and write the PDFs of all nestings, profiling
+    every report stage."""
+    import reports
+
+    reports_config = config.reports | dict(
+        results=r,
+        sanitize=sanitize_filename,
+        outputdir=outputdir
+    )
+    pipeline = Pipeline()
+    pipeline.config(**reports_config)
+    pipeline.add(*[stages.hooked_stage(stage, profiler)
+                   for stage in stages.pipe_stages(reports)
+                   if stage.name in REPORT_STAGES])
+    pipeline.run(verbose=False)
+
+    nestings = ['org'] + [n for n in NESTINGS if n + '_reports' in
+                          REPORT_STAGES]
+    stage = stages.Stage('write_all_reports', reports, (), None, ())
+    profiler(stage, lambda: reports.write_all_reports(
+        pipeline.results, nestings, **reports.write_options(reports_config)),
+        {}, reports_config)
+
+
+def run_size(respondents, teams, workdir, items=4, scales=8, models=4,
+             with_reports=True):
+    """
+    Benchmark one workload size: write a synthetic workload (see
+    synthetic.write_workload()), run the analysis and, optionally, make the
+    reports. Returns the workload parameters and the profile of every stage
+    (see profiler.StageProfiler).
+    """
+    workload = workload_params(respondents, teams) | dict(
+        items=items, scales=scales, models=models)
+    datapath = workdir + f'data_{respondents}_{teams}/'
+    overrides = write_workload(datapath, **workload)
+
+    profiler = StageProfiler(workdir)
+    r = time_analysis(config.analysis | overrides, profiler)
+    if with_reports:
+        time_reports(r, datapath + 'reports/', profiler)
+
+    return dict(workload, stages=profiler.records,
+                wall=sum(record['wall'] for record in profiler.records))
+
+
+def summary(runs):
+    """The wall time per stage (rows) and workload size (columns)."""
+    table = DataFrame({(run['respondents'], run['teams']):
+                       {record['stage']: record['wall']
+                        for record in run['stages']} for run in runs})
+    table.columns.names = ['respondents', 'teams']
+    table.loc['total'] = table.sum()
+    return table
+
+
+def compare(current, previous):
+    """
+    Compare the wall times of two benchmark results per workload size and
+    stage. A ratio above 1 means the current version is slower.
+    """
+    now, before = summary(current['runs']), summary(previous['runs'])
+    table = pd.concat([now.stack(['respondents', 'teams']),
+                       before.stack(['respondents', 'teams'])],
+                      axis='columns', keys=['current', 'previous']).dropna()
+    table['ratio'] = table['current'] / table['previous']
+    return table
+
+
+def previous_result(workdir, fname):
+    """The most recent benchmark result in workdir before fname, if any."""
+    fnames = sorted(f for f in glob.glob(workdir + 'scaling_*.json')
+                    if f < fname)
+    return fnames[-1] if len(fnames) > 0 else None
+
+
+def benchmark(outputdir, sizes=SIZES, items=4, scales=8, models=4,
+              with_reports=True, previous=None):
+    """
+    Benchmark the analysis (and reports) at several workload sizes. Every
+    stage is timed at every size. The results are written to a JSON file in
+    outputdir, and compared to a previous result (by default, the most
+    recent one in outputdir) to make regressions between versions visible.
+    Returns the filename.
+    """
+    workdir = outputdir + SCALING_DIR
+    os.makedirs(workdir, exist_ok=True)
+    fname = workdir + 'scaling_' + make_str_date("%Y-%m-%d_%H-%M-%S") + '.json'
+
+    runs = []
+    for respondents, teams in sizes:
+        print(f" Benchmark {respondents} respondents, {teams} teams..")
+        runs.append(run_size(respondents, teams, workdir, items, scales,
+                             models, with_reports))
+        gc.collect()
+
+    result = dict(created=make_str_date("%Y-%m-%dT%H:%M:%S"),
+                  environment=environment(), runs=runs)
+    with open(fname, 'w') as f:
+        json.dump(result, f, indent=1)
+
+    print(" Wall time (s) per stage:")
+    for line in summary(runs).round(3).to_string().split('\n'):
+        print("  " + line)
+
+    previous = previous or previous_result(workdir, fname)
+    if previous is not None:
+        with open(previous, 'r') as f:
+            table = compare(result, json.load(f))
+        print(f" Compared to {previous}:")
+        for line in table.round(3).to_string().split('\n'):
+            print("  " + line)
+
+    print(f" Benchmark results in: {fname}")
+    return fname
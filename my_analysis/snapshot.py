@@ -0,0 +1,175 @@
+import os
+import json
+import shutil
+import pickle
+
+from datetime import datetime
+from importlib.util import find_spec
+
+import pandas as pd
+from pandas import DataFrame, Series
+from box import Box
+
+
+# Version of the snapshot layout. Snapshots with another version can not be
+# loaded.
+VERSION = 1
+# Directory (in outputdir) of the snapshot of the latest analysis results
+SNAPSHOT_DIR = 'snapshot/'
+# File (in the snapshot directory) that describes the stored results
+MANIFEST = 'manifest.json'
+# Types of values that are stored in the manifest itself
+JSON_TYPES = (str, int, float, bool, type(None))
+
+
+def snapshot_dir(outputdir):
+    """The directory of the snapshot of the latest analysis results."""
+    return outputdir + SNAPSHOT_DIR
+
+
+def is_semopy(obj):
+    """Whether obj is a semopy object (model, solver result). These are not
+    stored, their estimates and statistics are in tables already."""
+    return type(obj).__module__.split('.')[0] == 'semopy'
+
+
+def has_parquet():
+    """Whether tables can be stored in the parquet (columnar) format."""
+    return find_spec('pyarrow') is not None
+
+
+def is_columnar(df):
+    """
+    Whether a DataFrame can be stored as parquet and read back unchanged:
+    string column names and, for columns and indexes of objects, only
+    strings (other objects would be converted or fail).
+    """
+    if not all(isinstance(c, str) for c in df.columns):
+        return False
+    indexes = [df.index.get_level_values(i) for i in range(df.index.nlevels)]
+    for values in [df[c] for c in df.columns] + indexes:
+        if values.dtype == object and \
+                pd.api.types.infer_dtype(values, skipna=False) != 'string':
+            return False
+    return True
+
+
+def write_table(obj, fname):
+    """
+    Write a DataFrame or Series to fname (without extension) as parquet.
+    Tables that parquet can not hold unchanged (see is_columnar()) are
+    pickled instead. Returns the filename.
+    """
+    df = obj.to_frame() if isinstance(obj, Series) else obj
+    if has_parquet() and is_columnar(df):
+        df.to_parquet(fname + '.parquet')
+        return fname + '.parquet'
+    obj.to_pickle(fname + '.pkl')
+    return fname + '.pkl'
+
+
+def read_table(fname, kind):
+    """Read a table written by write_table()."""
+    if fname.endswith('.pkl'):
+        return pd.read_pickle(fname)
+    df = pd.read_parquet(fname)
+    return df.iloc[:, 0] if kind == 'series' else df
+
+
+def flatten(obj, path=()):
+    """
+    Walk the results and yield (path, value) for every dict below obj and
+    every value in these dicts. Semopy objects are left out.
+    """
+    for k, v in obj.items():
+        if is_semopy(v):
+            continue
+        # Keys are stored as JSON, so numpy integers are converted
+        k = k.item() if hasattr(k, 'item') else k
+        yield path + (k, ), v
+        if isinstance(v, dict):
+            yield from flatten(v, path + (k, ))
+
+
+def write_snapshot(results, outputdir):
+    """
+    Write a snapshot of the analysis results to outputdir, replacing the
+    previous one. Tables are stored in a columnar format (parquet) when
+    possible, other values in the manifest or pickled. Returns the directory
+    of the snapshot.
+    """
+    target = snapshot_dir(outputdir)
+    tmpdir = target.rstrip('/') + '.tmp/'
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    os.makedirs(tmpdir)
+
+    entries = []
+    for i, (path, value) in enumerate(flatten(results)):
+        entry = dict(path=list(path))
+        fname = tmpdir + f'{i:05d}'
+        if isinstance(value, dict):
+            entry['kind'] = 'dict'
+        elif isinstance(value, (DataFrame, Series)):
+            entry['kind'] = 'frame' if isinstance(value, DataFrame) \
+                else 'series'
+            entry['file'] = os.path.basename(write_table(value, fname))
+        elif isinstance(value, JSON_TYPES) and not (
+                isinstance(value, float) and value != value):
+            entry['kind'] = 'value'
+            entry['value'] = value
+        else:
+            entry['kind'] = 'pickle'
+            entry['file'] = os.path.basename(fname + '.pkl')
+            with open(fname + '.pkl', 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        entries.append(entry)
+
+    manifest = dict(version=VERSION,
+                    created=datetime.now().isoformat(timespec='seconds'),
+                    pandas=pd.__version__,
+                    entries=entries)
+    with open(tmpdir + MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=1, default=str)
+
+    # Replace the previous snapshot only when the new one is complete
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmpdir, target)
+
+    return target
+
+
+def load_snapshot(path):
+    """
+    Load analysis results from a snapshot directory (see write_snapshot()).
+    The results are returned as Box, like the results of the analysis
+    pipeline.
+    """
+    with open(path + MANIFEST, 'r') as f:
+        manifest = json.load(f)
+
+    if manifest.get('version') != VERSION:
+        raise ValueError(f"Snapshot in {path} has version " +
+                         f"{manifest.get('version')}, expected {VERSION}. " +
+                         "Run the analysis again.")
+
+    results = dict()
+    for entry in manifest['entries']:
+        *parents, key = entry['path']
+        node = results
+        for k in parents:
+            node = node[k]
+
+        kind = entry['kind']
+        if kind == 'dict':
+            value = dict()
+        elif kind in ('frame', 'series'):
+            value = read_table(path + entry['file'], kind)
+        elif kind == 'value':
+            value = entry['value']
+        else:
+            with open(path + entry['file'], 'rb') as f:
+                value = pickle.load(f)
+
+        node[key] = value
+
+    return Box(results)
@@ -0,0 +1,270 @@
+import re
+import ast
+import inspect
+
+from collections import namedtuple
+
+from nowpipes import pipe
+
+
+# A stage in a pipeline is a @pipe decorated function.
+# name -- the name of the function, which is also the name of its result
+# module -- the module the function is defined in
+# args -- the named arguments, which are the results of upstream stages
+# params -- regular expressions for the parameter names the stage reads, or
+#           None when the stage may read any parameter (see stage_params())
+# mutates -- the arguments that the stage modifies in place
+#            (see stage_mutates())
+Stage = namedtuple('Stage', ['name', 'module', 'args', 'params', 'mutates'])
+
+# Methods of the parameters dict that read a single key
+PARAM_GETTERS = ('get', 'pop', 'setdefault')
+# Methods that modify the object they are called on (of lists, dicts, sets
+# and pandas objects). Some of them only do so on some types (e.g., append
+# returns a new DataFrame), which orders stages that could run at the same
+# time, but never the other way around.
+MUTATING_METHODS = ('append', 'extend', 'insert', 'update', 'pop', 'popitem',
+                    'clear', 'setdefault', 'remove', 'discard', 'add', 'sort',
+                    'reverse')
+
+
+def is_pipe_decorator(node):
+    """Whether an ast decorator node is the nowpipes pipe decorator."""
+    if isinstance(node, ast.Name):
+        return node.id == 'pipe'
+    if isinstance(node, ast.Attribute):
+        return node.attr == 'pipe'
+    return False
+
+
+def key_pattern(node, bindings={}):
+    """
+    Make a regular expression for the parameter names that an ast expression
+    can evaluate to. Parts that cannot be determined statically match
+    anything. Examples: 'advice_n' -> 'advice_n', f'r10_{n}_comparison' ->
+    'r10_.*_comparison', 'prev_aggregate_' + n -> 'prev_aggregate_.*'.
+    Bindings maps names (of function arguments) to known patterns.
+    """
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return re.escape(node.value)
+    if isinstance(node, ast.JoinedStr):
+        return ''.join(key_pattern(v, bindings) for v in node.values)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return key_pattern(node.left, bindings) + \
+            key_pattern(node.right, bindings)
+    if isinstance(node, ast.Name) and node.id in bindings:
+        return bindings[node.id]
+    return '.*'
+
+
+def function_node(fn):
+    """The ast node of a function, or None if its source is unavailable."""
+    try:
+        tree = ast.parse(inspect.getsource(fn).strip())
+    except (OSError, TypeError, SyntaxError):
+        return None
+    node = tree.body[0]
+    return node if isinstance(node, ast.FunctionDef) else None
+
+
+def params_read(node, name, module, bindings={}, depth=0):
+    """
+    Determine which parameters are read in a function (ast node) that has
+    the parameters dict as argument name. Returns a tuple of regular
+    expressions for parameter names, or None when that cannot be determined.
+
+    Recognized: p['k'], p.get('k'), 'k' in p, and calls that pass p to other
+    functions in the package, such as filepath(p, 'hrfile'), which are
+    followed.
+    """
+    def is_p(n):
+        return isinstance(n, ast.Name) and n.id == name
+
+    # Local names that hold parameter names, e.g., key = 'prev_' + n
+    local = {}
+    for n in ast.walk(node):
+        if isinstance(n, ast.Assign) and len(n.targets) == 1 and \
+                isinstance(n.targets[0], ast.Name):
+            local.setdefault(n.targets[0].id, []).append(
+                    key_pattern(n.value, bindings))
+    bindings = dict(bindings, **{
+        k: v[0] if len(v) == 1 else '(?:' + '|'.join(v) + ')'
+        for k, v in local.items()})
+
+    patterns = []
+    handled = set()
+    for n in ast.walk(node):
+        if isinstance(n, ast.Subscript) and is_p(n.value):
+            patterns.append(key_pattern(n.slice, bindings))
+            handled.add(id(n.value))
+        elif (isinstance(n, ast.Call) and isinstance(n.func, ast.Attribute)
+              and is_p(n.func.value) and n.func.attr in PARAM_GETTERS
+              and len(n.args) > 0):
+            patterns.append(key_pattern(n.args[0], bindings))
+            handled.add(id(n.func.value))
+        elif isinstance(n, ast.Compare) and any(
+                isinstance(op, (ast.In, ast.NotIn)) for op in n.ops) and any(
+                is_p(c) for c in n.comparators):
+            patterns.append(key_pattern(n.left, bindings))
+            handled.update(id(c) for c in n.comparators if is_p(c))
+        elif isinstance(n, ast.Call) and any(is_p(a) for a in n.args):
+            # Follow the function that p is passed to
+            fn = None
+            if isinstance(n.func, ast.Name) and depth < 3:
+                fn = getattr(module, n.func.id, None)
+            callee = function_node(fn) if inspect.isfunction(fn) else None
+            if callee is None or len(n.keywords) > 0:
+                return None
+            callee_args = [arg.arg for arg in callee.args.args]
+            if len(n.args) > len(callee_args) or any(
+                    isinstance(a, ast.Starred) for a in n.args):
+                return None
+            callee_bindings = {arg: key_pattern(a, bindings)
+                               for arg, a in zip(callee_args, n.args)}
+            for arg, a in zip(callee_args, n.args):
+                if not is_p(a):
+                    continue
+                found = params_read(callee, arg, inspect.getmodule(fn),
+                                    callee_bindings, depth + 1)
+                if found is None:
+                    return None
+                patterns.extend(found)
+                handled.add(id(a))
+
+    # Any other use of p (e.g., **p, iterating over it) can read anything
+    if any(is_p(n) and id(n) not in handled for n in ast.walk(node)):
+        return None
+
+    return tuple(sorted(set(patterns)))
+
+
+def stage_params(node, module):
+    """
+    Determine which parameters a stage (ast function node in module) reads.
+    Returns a tuple of regular expressions for parameter names, or None when
+    that cannot be determined (e.g., the parameters are passed on as a
+    whole). See params_read().
+    """
+    if node.args.kwarg is None:
+        return ()
+    return params_read(node, node.args.kwarg.arg, module)
+
+
+def root_name(node):
+    """The name at the root of an attribute/subscript chain (e.g., data for
+    data.use['x']), or None."""
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def stage_mutates(node):
+    """
+    Determine which arguments of a stage (ast function node) are modified in
+    place: assignments to their attributes or items (data['use'] = ...,
+    data.use[item] = ...), inplace=True method calls and calls of mutating
+    methods (data.update(...), see MUTATING_METHODS). Names that refer to
+    (a part of) an argument, e.g., rank = weighted_growth.by_model.rank[n],
+    are followed.
+    """
+    args = [arg.arg for arg in node.args.args]
+    alias = {arg: arg for arg in args}
+
+    # Follow names that are bound to a part of an argument
+    for n in ast.walk(node):
+        if isinstance(n, ast.Assign) and isinstance(
+                n.value, (ast.Name, ast.Attribute, ast.Subscript)):
+            root = alias.get(root_name(n.value))
+            if root is None:
+                continue
+            for target in n.targets:
+                if isinstance(target, ast.Name):
+                    alias[target.id] = root
+
+    mutates = set()
+    for n in ast.walk(node):
+        targets = []
+        if isinstance(n, ast.Assign):
+            targets = n.targets
+        elif isinstance(n, (ast.AugAssign, ast.AnnAssign)):
+            targets = [n.target]
+        elif isinstance(n, ast.Delete):
+            targets = n.targets
+        for target in targets:
+            if isinstance(target, (ast.Attribute, ast.Subscript)):
+                root = alias.get(root_name(target))
+                if root is not None:
+                    mutates.add(root)
+
+        if isinstance(n, ast.Call) and isinstance(n.func, ast.Attribute) and (
+                n.func.attr in MUTATING_METHODS or
+                any(k.arg == 'inplace' and isinstance(k.value, ast.Constant)
+                    and k.value.value is True for k in n.keywords)):
+            root = alias.get(root_name(n.func.value))
+            if root is not None:
+                mutates.add(root)
+
+    return tuple(arg for arg in args if arg in mutates)
+
+
+def pipe_stages(module):
+    """Find the stages (@pipe functions) in a module, in the order in which
+    they are defined."""
+    tree = ast.parse(inspect.getsource(module))
+    stages = []
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        if not any(is_pipe_decorator(d) for d in node.decorator_list):
+            continue
+        args = tuple(arg.arg for arg in node.args.args)
+        stages.append(Stage(node.name, module, args, stage_params(node, module),
+                            stage_mutates(node)))
+    return stages
+
+
+def hooked_stage(stage, hook):
+    """
+    Make a @pipe function that replaces a stage and calls
+    hook(stage, call, inputs, p) instead. The hook is responsible for calling
+    call(), which runs the original stage, and returns its result. Inputs is a
+    dict with the results of the upstream stages, p are the parameters.
+    """
+    fn = getattr(stage.module, stage.name)
+
+    def run(inputs, p):
+        return hook(stage, lambda: fn(**inputs, **p), inputs, p)
+
+    # nowpipes determines the order of execution from the names of the
+    # arguments, so the replacement must have exactly the same signature
+    args = ''.join(arg + ', ' for arg in stage.args)
+    inputs = ', '.join(f'{arg}={arg}' for arg in stage.args)
+    source = (f'def {stage.name}({args}**p):\n' +
+              f'    return run(dict({inputs}), p)\n')
+    namespace = {'run': run}
+    exec(source, namespace)
+
+    wrapper = namespace[stage.name]
+    wrapper.__doc__ = fn.__doc__
+    wrapper.__module__ = stage.module.__name__
+    return pipe(wrapper)
+
+
+def hooked_stages(modules, hook):
+    """Replace the stages of all modules by hooked stages (see
+    hooked_stage())."""
+    return [hooked_stage(stage, hook)
+            for module in modules for stage in pipe_stages(module)]
+
+
+def chain_hooks(*hooks):
+    """Combine hooks into one hook. The first hook is the outermost one."""
+    hooks = [hook for hook in hooks if hook is not None]
+
+    def chained(stage, call, inputs, p):
+        for hook in reversed(hooks):
+            call = (lambda hook, call: lambda: hook(stage, call, inputs, p))(
+                    hook, call)
+        return call()
+
+    return chained
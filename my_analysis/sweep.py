@@ -0,0 +1,214 @@
+import ast
+import re
+
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from pandas import DataFrame
+
+from nowpipes import Pipeline
+
+from helpers import delete_file_if_exists, make_org_report_fname
+
+import config
+import stages
+import memo
+
+
+def parse_value(value):
+    """Parse a parameter value from the command line: numbers, tuples, etc.
+    are evaluated, anything else is a string."""
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def parameter_grid(specs):
+    """
+    Make the grid of parameter sets from specifications like
+    'r10_quantile=.8,.9'. Every combination of values is a parameter set.
+
+    Example: ['r10_quantile=.8,.9', 'weigh_growth_by=mean_est,max_est'] ->
+    [{'r10_quantile': .8, 'weigh_growth_by': 'mean_est'},
+     {'r10_quantile': .8, 'weigh_growth_by': 'max_est'}, ...]
+    """
+    names, values = [], []
+    for spec in specs:
+        name, _, vals = spec.partition('=')
+        names.append(name.strip())
+        values.append([parse_value(v.strip()) for v in vals.split(',')])
+    return [dict(zip(names, combination)) for combination in product(*values)]
+
+
+def parameter_set_label(overrides):
+    """A readable label for a parameter set."""
+    return ', '.join(f'{k}={v}' for k, v in overrides.items())
+
+
+def reads_any(stage, names):
+    """Whether a stage reads (one of) the named parameters."""
+    if stage.params is None:
+        return True
+    return any(re.fullmatch(pattern, name)
+               for pattern in stage.params for name in names)
+
+
+def dirty_stages(all_stages, names):
+    """
+    Determine the stages whose results depend on the named parameters: the
+    stages that read them, the stages below those, and the stages that read
+    results that one of these modifies in place (e.g., rankings modifies
+    weighted_growth). All other stages are shared by every parameter set.
+    """
+    dirty = set(stage.name for stage in all_stages if reads_any(stage, names))
+    changed = True
+    while changed:
+        changed = False
+        mutated = set(arg for stage in all_stages if stage.name in dirty
+                      for arg in stage.mutates)
+        for stage in all_stages:
+            if stage.name in dirty:
+                continue
+            if any(arg in dirty or arg in mutated for arg in stage.args):
+                dirty.add(stage.name)
+                changed = True
+    return dirty
+
+
+def shared_results(parts, dirty, outputdir):
+    """
+    Run the stages that do not depend on the swept parameters once. Dirty
+    stages are skipped. Returns the results per stage, as they are at the end
+    of the run (i.e., including modifications by later stages such as
+    scale_means).
+    """
+    def skip_dirty(stage, call, inputs, p):
+        if stage.name in dirty:
+            return None
+        return call()
+
+    stage_cache = None
+    if config.analysis.get('memoize', False):
+        stage_cache = memo.StageCache(outputdir)
+
+    analysis = Pipeline()
+    analysis.config(**config.analysis)
+    analysis.add(*stages.hooked_stages(
+        parts, stages.chain_hooks(skip_dirty, stage_cache)))
+    analysis.run(verbose=True, indent=1)
+
+    return {stage.name: analysis.results[stage.name]
+            for part in parts for stage in stages.pipe_stages(part)
+            if stage.name not in dirty}
+
+
+def advice_table(r, nestings):
+    """The advice (grade names of the strongest weighted growth potentials)
+    per nesting entity, overall and per dvcluster, as one table."""
+    rows = []
+    for dvclus, advice in r.advice.org.by_dvcluster.items():
+        rows.append(('org', dvclus, 'org', ', '.join(advice.grade_name)))
+    for n in nestings:
+        values = r.nesting[n]['value']
+        for i, advice in r.advice[n].items():
+            rows.append((n, '', values[i], ', '.join(advice.grade_name)))
+        for dvclus, by_nesting in r.advice.by_dvcluster.items():
+            for i, advice in by_nesting[n].items():
+                rows.append((n, dvclus, values[i],
+                             ', '.join(advice.grade_name)))
+    return DataFrame(rows, columns=['nesting', 'dvcluster', 'value',
+                                    'advice'])
+
+
+def rankings_table(r, nestings):
+    """The weighted growth ranks per nesting entity, model and variable as
+    one table."""
+    dfs = []
+    for n in nestings:
+        df = r.rankings[n].copy()
+        df['value'] = df['value'].map(r.nesting[n]['value'])
+        df.insert(0, 'nesting', n)
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def run_parameter_set(shared, dirty, overrides):
+    """
+    Run the dirty stages for one parameter set. Results of the other stages
+    are taken from shared (pickled with memo.dumps()). Returns the advice and
+    rankings tables.
+    """
+    from analysis import analysis_parts
+
+    shared = memo.loads(shared)
+
+    def reuse(stage, call, inputs, p):
+        if stage.name in dirty:
+            return call()
+        return shared[stage.name]
+
+    analysis_config = config.analysis | overrides
+    analysis = Pipeline()
+    analysis.config(**analysis_config)
+    analysis.add(*stages.hooked_stages(analysis_parts(), reuse))
+    analysis.run(verbose=False)
+
+    r = analysis.results
+    nestings = analysis_config['nestings']
+    return dict(advice=advice_table(r, nestings),
+                rankings=rankings_table(r, nestings))
+
+
+def compare(tables, labels, index):
+    """Put the tables of all parameter sets side by side: one column per
+    parameter set. The column 'same' indicates that all parameter sets have
+    the same value."""
+    column = [c for c in tables[0].columns if c not in index][0]
+    df = pd.concat([t.set_index(index)[column] for t in tables],
+                   axis='columns', keys=labels)
+    df['same'] = df.nunique(axis='columns', dropna=False) == 1
+    return df
+
+
+def sweep(specs, outputdir, multiproc=2):
+    """
+    Run the analysis for every parameter set in the grid (see
+    parameter_grid()). Stages that do not depend on the swept parameters
+    (e.g., data, scale_means, aggregate and, unless models_p_value is swept,
+    models) are computed once; only the stages that do are run per parameter
+    set, in parallel. Writes a comparison of the advice and rankings to an
+    excel file and returns its filename.
+    """
+    from analysis import analysis_parts
+
+    grid = parameter_grid(specs)
+    labels = [parameter_set_label(overrides) for overrides in grid]
+    parts = analysis_parts()
+    all_stages = [stage for part in parts
+                  for stage in stages.pipe_stages(part)]
+    dirty = dirty_stages(all_stages, grid[0].keys())
+
+    print(f" Sweep over {len(grid)} parameter sets, " +
+          f"per parameter set: {', '.join(sorted(dirty))}")
+    shared, _ = memo.dumps(shared_results(parts, dirty, outputdir))
+
+    # Order is preserved by map, so results line up with labels
+    with ProcessPoolExecutor(max_workers=min(multiproc, len(grid))) as pool:
+        results = list(pool.map(run_parameter_set, [shared] * len(grid),
+                                [dirty] * len(grid), grid))
+
+    fname = outputdir + make_org_report_fname('_sweep') + '.xlsx'
+    delete_file_if_exists(fname)
+    with pd.ExcelWriter(fname) as writer:
+        DataFrame(grid, index=labels).to_excel(writer, sheet_name='params')
+        compare([r['advice'] for r in results], labels,
+                ['nesting', 'dvcluster', 'value']).to_excel(
+                writer, sheet_name='advice')
+        compare([r['rankings'] for r in results], labels,
+                ['nesting', 'value', 'model', 'var']).to_excel(
+                writer, sheet_name='rankings')
+
+    print(f" Sweep comparison in: {fname}")
+    return fname
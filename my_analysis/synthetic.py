@@ -0,0 +1,171 @@
+import os
+
+from itertools import product
+
+import numpy as np
+from pandas import DataFrame
+
+
+# Subclusters of the dependent variables; every model regresses one of them
+# on one subcluster of independent variables
+DV_CLUSTERS = ('Welzijn', 'Betrokkenheid')
+# Nesting columns in the synthetic hr data
+NESTINGS = ('team', 'functie', 'onderdeel')
+# Answers are given on a scale from 1 to SCALEMAX
+SCALEMAX = 7
+# Fraction of missing answers, of respondents that did not finish the survey
+# and of employees in the hr data that did not respond
+MISSING = .02
+UNFINISHED = .03
+NONRESPONSE = .05
+
+
+def iv_clusters(models):
+    """The names of the subclusters of independent variables needed for the
+    number of models (every subcluster is combined with every dv
+    subcluster)."""
+    n = -(-models // len(DV_CLUSTERS))
+    return [f'Factor {i + 1}' for i in range(n)]
+
+
+def research_model(scales, items, models):
+    """
+    The research model: scales - len(DV_CLUSTERS) independent scales divided
+    over the iv subclusters, and one dependent scale per dv subcluster. The
+    second scale has a negative direction and the items of the third scale
+    are partly reversed.
+    """
+    ivclusters = iv_clusters(models)
+    nivs = scales - len(DV_CLUSTERS)
+    if nivs < len(ivclusters):
+        raise ValueError(f'{models} models need at least ' +
+                         f'{len(ivclusters) + len(DV_CLUSTERS)} scales')
+
+    reverse = '2,3' if items >= 3 else str(items)
+    rows = []
+    for s in range(scales):
+        iv = s < nivs
+        rows.append(dict(
+            var=f'sc{s}',
+            meanname=f'scale{s}',
+            prevname=f'prev{s}',
+            direction='negative' if s == 1 else 'positive',
+            use=1,
+            subcluster=ivclusters[s % len(ivclusters)] if iv
+            else DV_CLUSTERS[s - nivs],
+            type='iv' if iv else 'dv',
+            scalemax=SCALEMAX,
+            items=f'1-{items}',
+            reverse=reverse if s == 2 and items > 1 else '0',
+            name=f'Scale {s}',
+            definition=f'Definition of scale {s}'))
+    return DataFrame(rows)
+
+
+def model_file(models):
+    """The regression models: every iv subcluster with every dv
+    subcluster."""
+    combinations = list(product(iv_clusters(models), DV_CLUSTERS))[:models]
+    return DataFrame([dict(name=f'model_{i + 1}', ivs=ivs, dvs=dvs)
+                      for i, (ivs, dvs) in enumerate(combinations)])
+
+
+def latent_scores(rm, membership, rng):
+    """
+    Latent scores per respondent and scale. Dependent scales are a weighted
+    sum of the independent scales plus noise (the second scale lowers them),
+    and every nesting entity (see membership) shifts the scores of its
+    members, so that regressions and differences between entities are like
+    those in real data.
+    """
+    n = len(membership[NESTINGS[0]])
+    ivs = (rm['type'] == 'iv').to_numpy()
+    latent = rng.normal(size=(n, len(rm.index)))
+
+    weights = rng.uniform(-.2, .5, size=(ivs.sum(), (~ivs).sum()))
+    # The scale with a negative direction lowers the dependent scales
+    weights[1] = -rng.uniform(.2, .4, size=(~ivs).sum())
+    latent[:, ~ivs] += latent[:, ivs] @ weights
+
+    for codes in membership.values():
+        shift = rng.normal(scale=.3, size=(codes.max() + 1, len(rm.index)))
+        latent += shift[codes]
+    return latent
+
+
+def survey(rm, items, latent, rng):
+    """The survey responses: items are latent scores plus noise, rounded to
+    the answer scale. Reversed items are stored reversed."""
+    n = latent.shape[0]
+    answers = dict()
+    for s, row in rm.iterrows():
+        reverse = [int(i) for i in row['reverse'].split(',') if i != '0']
+        for i in range(1, items + 1):
+            x = np.round(4 + latent[:, s] + rng.normal(scale=.8, size=n))
+            x = np.clip(x, 1, SCALEMAX)
+            if i in reverse:
+                x = SCALEMAX + 1 - x
+            x[rng.random(n) < MISSING] = np.nan
+            answers[f"{row['var']}_{i}"] = x
+    sv = DataFrame(answers)
+    sv['RecipientEmail'] = [f'employee{i}@example.com' for i in range(n)]
+    sv['Finished'] = (rng.random(n) >= UNFINISHED).astype(int)
+    sv['Consent'] = 1
+    return sv
+
+
+def previous_scores(rm, values, rng):
+    """Aggregated scores of a previous year for the values of a nesting."""
+    df = DataFrame({prevname: rng.uniform(4, 8, len(values))
+                    for prevname in rm['prevname']})
+    df['value'] = values
+    return df
+
+
+def write_workload(datapath, respondents=1000, items=4, scales=8, teams=50,
+                   functies=10, onderdelen=5, models=4, seed=0):
+    """
+    Write a synthetic workload to datapath: consistent hr, survey, research
+    model, model and previous year files for the given number of
+    respondents, items per scale, scales, nesting entities and models.
+    Returns the analysis parameters (see config.analysis) to run the
+    analysis on it.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(datapath, exist_ok=True)
+
+    rm = research_model(scales, items, models)
+    sizes = dict(team=teams, functie=functies, onderdeel=onderdelen)
+    names = {n: np.array([f'{n.capitalize()} {i + 1}'
+                          for i in range(sizes[n])]) for n in NESTINGS}
+
+    # Employees in the hr data, of whom the first respondents responded
+    employees = respondents + int(respondents * NONRESPONSE)
+    membership = {n: rng.integers(0, sizes[n], employees) for n in NESTINGS}
+    latent = latent_scores(
+        rm, {n: codes[:respondents] for n, codes in membership.items()}, rng)
+
+    hr = DataFrame({'mail': [f'employee{i}@example.com'
+                             for i in range(employees)]})
+    for n in NESTINGS:
+        hr[n] = names[n][membership[n]]
+
+    files = dict(hrfile='hrfile.csv', svfile='svfile.csv',
+                 rmfile='rmfile.csv', modfile='modfile.csv',
+                 prev_aggregate_org='prev_agg_org.csv')
+    hr.to_csv(datapath + files['hrfile'], index=False)
+    survey(rm, items, latent, rng).to_csv(datapath + files['svfile'],
+                                          index=False)
+    rm.to_csv(datapath + files['rmfile'], index=False)
+    model_file(models).to_csv(datapath + files['modfile'], index=False)
+
+    org = previous_scores(rm, ['org'], rng).drop(columns='value')
+    org.to_csv(datapath + files['prev_aggregate_org'], index=False)
+    for n in NESTINGS:
+        files['prev_aggregate_' + n] = f'prev_agg_{n}.csv'
+        previous_scores(rm, names[n], rng).to_csv(
+            datapath + files['prev_aggregate_' + n], index=False)
+
+    # The models stage reads the model file from its full path
+    return dict(files, datapath=datapath,
+                modfile=datapath + files['modfile'], nestings=NESTINGS)
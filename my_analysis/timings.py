@@ -0,0 +1,59 @@
+import os
+import json
+import threading
+
+from pandas import DataFrame
+
+
+# Phases of making a report, in order:
+# gather -- gathering the entity data from the results
+# html -- rendering the html presentation
+# queue_wait -- waiting for a worker to pick up the report
+# layout -- laying out the pdf with weasyprint
+# write -- serializing the pdf
+# zip -- writing the pdf to the archive and directory
+PHASES = ('gather', 'html', 'queue_wait', 'layout', 'write', 'zip')
+
+
+def worker_id():
+    """Identify the worker (process and thread) that renders a report."""
+    return f'{os.getpid()}/{threading.current_thread().name}'
+
+
+def timing_log_fname(outputdir, dt):
+    """The filename of the JSONL log with the timings of every report."""
+    return outputdir + 'report_timings_' + dt + '.jsonl'
+
+
+def log_timing(f, record):
+    """Write the timings of one report as a line of JSON to file f."""
+    f.write(json.dumps(record) + '\n')
+    f.flush()
+
+
+def summarize_timings(records):
+    """
+    Summarize report timings per phase: median, 95th percentile, maximum and
+    total number of seconds. Reports taken from the pdf cache do not have
+    layout and write timings and are left out for those phases.
+    """
+    df = DataFrame(list(records))
+    phases = [phase for phase in PHASES if phase in df.columns]
+    df = df[phases].astype(float)
+    return DataFrame({'p50': df.quantile(.5),
+                      'p95': df.quantile(.95),
+                      'max': df.max(),
+                      'total': df.sum()})
+
+
+def print_timings_summary(records, elapsed):
+    """Print the timings summary and the number of reports per second."""
+    if len(records) == 0:
+        return
+    summary = summarize_timings(records)
+    print("  Report timings (seconds):")
+    for line in summary.round(3).to_string().split('\n'):
+        print("    " + line)
+    rate = len(records) / elapsed if elapsed > 0 else float('inf')
+    print(f"  {len(records)} reports in {elapsed:.1f}s " +
+          f"({rate:.2f} reports per second)")
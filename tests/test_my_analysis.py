@@ -1,5 +1,900 @@
+import os
+import sys
+
+import pytest
+
 from my_analysis import __version__
 
+# The pipeline modules import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'my_analysis'))
+
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def make_html(*pages):
+    return ('<html><body><div id="slides">\n' + '\n'.join(pages) +
+            '\n</div><!-- </div> --></body></html>')
+
+
+def test_split_pages():
+    from pdfs import split_pages
+
+    page1 = '<div class="page"><div class="row">A</div></div>'
+    page2 = '<div class="page"><!-- <div> -->B</div>'
+    head, pages, tail = split_pages(make_html(page1, page2))
+
+    assert pages == [page1, page2]
+    assert head.endswith('<div id="slides">\n')
+    assert tail.startswith('\n</div>')
+
+
+def test_static_pages():
+    from pdfs import static_pages, page_runs
+
+    front = '<div class="page">Front</div>'
+    htmls = [make_html(front, f'<div class="page">Team {i}</div>', front)
+             for i in range(3)]
+
+    mask = static_pages(htmls)
+    assert mask == (True, False, True)
+    assert page_runs(mask) == [(True, [0]), (False, [1]), (True, [2])]
+    assert static_pages(htmls[:1]) is None
+
+
+def page_texts(document):
+    """The text on every page of a rendered weasyprint document."""
+    return [' '.join(box.text for box in page._page_box.descendants()
+                     if hasattr(box, 'text')) for page in document.pages]
+
+
+def test_splice_pages(tmp_path):
+    pytest.importorskip('weasyprint')
+    from pdfs import (static_pages, layout_document, render_document,
+                      static_document, write_pdf)
+
+    def page(text):
+        return f'<div class="page" style="break-after: page">{text}</div>'
+
+    htmls = [make_html(page('Front'), page(f'Team {i}'), page('Back'))
+             for i in range(3)]
+    mask = static_pages(htmls)
+    assert mask == (True, False, True)
+
+    static_document.cache_clear()
+    for i, html in enumerate(htmls):
+        spliced = layout_document(html, mask)
+        plain = render_document(html)
+        assert len(spliced.pages) == len(plain.pages) == 3
+        assert page_texts(spliced) == page_texts(plain)
+        assert 'Team ' + str(i) in page_texts(spliced)[1]
+    # The front and back pages are laid out once
+    assert static_document.cache_info().misses == 2
+    assert static_document.cache_info().hits == 4
+
+    target = str(tmp_path / 'report.pdf')
+    write_pdf(htmls[0], target, mask)
+    with open(target, 'rb') as f:
+        assert f.read(4) == b'%PDF'
+
+
+def test_pdf_cache(tmp_path):
+    from pdfs import (load_manifest, save_manifest, restore_pdf, store_pdf,
+                      report_hash)
+
+    outputdir = str(tmp_path) + '/'
+    h = report_hash('<html></html>', 'fingerprint')
+    assert h != report_hash('<html></html>', 'other fingerprint')
+    assert restore_pdf(outputdir, h, outputdir + 'a.pdf') is False
+
+    store_pdf(outputdir, h, b'%PDF')
+    save_manifest(outputdir, {'team/a': h})
+
+    assert load_manifest(outputdir) == {'team/a': h}
+    assert restore_pdf(outputdir, h, outputdir + 'b.pdf') is True
+    assert open(outputdir + 'b.pdf', 'rb').read() == b'%PDF'
+
+    # Cached pdfs that are no longer referenced are removed
+    save_manifest(outputdir, {})
+    assert restore_pdf(outputdir, h, outputdir + 'c.pdf') is False
+
+    # An edited stylesheet changes the hash within the same process
+    css = tmp_path / 'style.css'
+    css.write_text('p { color: red }')
+    html = f'<html><link href="file://{css}" rel="stylesheet"></html>'
+    before = report_hash(html, 'fingerprint')
+    assert report_hash(html, 'fingerprint') == before
+    css.write_text('p { color: blue }')
+    assert report_hash(html, 'fingerprint') != before
+
+
+def test_snapshot(tmp_path):
+    import pandas as pd
+    from snapshot import write_snapshot, load_snapshot
+
+    frame = pd.DataFrame({'var': ['a', 'b'], 'score': [1.5, 2.5]})
+    mixed = pd.DataFrame({'n': pd.Series([1, 2], dtype=object)})
+    results = {'aggregate': {'org': frame, 'team': {}},
+               'advice': {'team': pd.Series([frame, frame])},
+               'glossary': frame['var'],
+               'advice_n': 3,
+               'categories': (1, 5, 10),
+               'mixed': mixed}
+
+    path = write_snapshot(results, str(tmp_path) + '/')
+    loaded = load_snapshot(path)
+
+    pd.testing.assert_frame_equal(loaded.aggregate.org, frame)
+    pd.testing.assert_frame_equal(loaded.advice.team[1], frame)
+    pd.testing.assert_series_equal(loaded.glossary, frame['var'])
+    pd.testing.assert_frame_equal(loaded.mixed, mixed)
+    assert loaded.aggregate.team == {}
+    assert loaded.advice_n == 3
+    assert loaded.categories == (1, 5, 10)
+
+
+def test_dump(tmp_path):
+    import pandas as pd
+    from dump import build_tables, write_dump
+
+    df = pd.DataFrame({'a': [1.5, float('nan')], 'b': ['x', 3]},
+                      index=pd.Index(['p', 'q'], name='a'))
+    tables = build_tables([('first', lambda: df), ('skipped', lambda: None),
+                           ('second', lambda: df.reset_index(drop=True))])
+    assert [name for name, _ in tables] == ['first', 'second']
+
+    fname = write_dump(tables, str(tmp_path / 'dump'), 'xlsx')
+    sheets = pd.read_excel(fname, sheet_name=None)
+    assert list(sheets) == ['first', 'second']
+    assert sheets['first'].columns.tolist() == ['a', 'a.1', 'b']
+    assert sheets['first']['a.1'].isnull().tolist() == [False, True]
+
+    dirname = write_dump(tables, str(tmp_path / 'dump'), 'parquet')
+    first = pd.read_parquet(os.path.join(dirname, 'first.parquet'))
+    assert first.columns.tolist() == ['index_a', 'a', 'b']
+    assert first['b'].tolist() == ['x', '3']
+
+
+def test_synthetic_workload(tmp_path):
+    import pandas as pd
+    from synthetic import write_workload
+
+    datapath = str(tmp_path) + '/'
+    p = write_workload(datapath, respondents=200, items=3, scales=6,
+                       teams=12, functies=4, onderdelen=3, models=3)
+
+    hr = pd.read_csv(datapath + p['hrfile'])
+    sv = pd.read_csv(datapath + p['svfile'])
+    rm = pd.read_csv(datapath + p['rmfile'])
+    mod = pd.read_csv(p['modfile'])
+
+    assert len(sv.index) == 200
+    assert sv['RecipientEmail'].isin(hr['mail']).all()
+    assert hr['team'].nunique() <= 12
+    assert len(sv.columns) == 6 * 3 + 3
+    assert sv.filter(regex='^sc').stack().between(1, 7).all()
+    assert len(mod.index) == 3
+    assert mod['ivs'].isin(rm['subcluster']).all()
+    assert mod['dvs'].isin(rm.loc[rm['type'] == 'dv', 'subcluster']).all()
+
+    for n in ('org',) + p['nestings']:
+        prev = pd.read_csv(datapath + p['prev_aggregate_' + n])
+        assert set(rm['prevname']) <= set(prev.columns)
+
+
+def test_descending_order():
+    import numpy as np
+    import pandas as pd
+    from helpers import descending_order
+
+    rng = np.random.default_rng(0)
+    # Many ties (like growth potentials clipped at zero) and some NaNs
+    values = rng.integers(0, 4, size=(200, 12)).astype(float)
+    values[rng.random(values.shape) < .05] = np.nan
+
+    order = descending_order(values)
+    for row, positions in zip(values, order):
+        expected = pd.Series(row).sort_values(ascending=False).index
+        assert positions.tolist() == expected.tolist()
+
+
+def test_rank_cutoff():
+    import numpy as np
+    import pandas as pd
+    import kernels
+
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 4, size=(300, 9)).astype(float)
+    values[rng.random(values.shape) < .05] = np.nan
+    relative = values / np.nansum(values, axis=1, keepdims=True)
+
+    # The reference implementation in models.model_weighted_growth_stats()
+    # and models.sort_and_cutoff_pos()
+    rank = pd.DataFrame(values).rank(ascending=False, axis=1).to_numpy()
+    cumulative = pd.DataFrame(-np.sort(-relative)).cumsum(axis='columns')
+    cutoffs = np.minimum((.7 > cumulative).sum(axis=1) + 1, 9).to_numpy()
+    explained = cumulative.to_numpy()[np.arange(300), cutoffs - 1]
+
+    kernel = [kernels.rank_cutoff_numpy]
+    if kernels.HAVE_NUMBA:
+        kernel.append(kernels.rank_cutoff_numba)
+    for rank_cutoff in kernel:
+        r, c, e = rank_cutoff(values, relative, .7)
+        assert np.array_equal(r, rank, equal_nan=True)
+        assert np.array_equal(c, cutoffs)
+        assert np.array_equal(e, explained, equal_nan=True)
+
+
+def test_reliability():
+    import numpy as np
+    import pandas as pd
+    from helpers import pairwise_stats, scale_reliability
+
+    rng = np.random.default_rng(0)
+    latent = rng.normal(size=(400, 1))
+    df = pd.DataFrame(latent + rng.normal(size=(400, 4)), columns=list('abcd'))
+    df['d'] = -df['d']
+
+    n, cov, corr = pairwise_stats(df)
+    assert np.allclose(cov, df.cov())
+    assert np.allclose(corr, df.corr())
+    assert (n.to_numpy() == 400).all()
+
+    scale, items = scale_reliability(cov, corr)
+    c = df.cov().to_numpy()
+    assert np.isclose(scale['alpha'], 4 / 3 * (1 - np.trace(c) / c.sum()))
+    rest = df.sum(axis='columns') - df['a']
+    assert np.isclose(items.loc['a', 'item_rest_corr'], df['a'].corr(rest))
+    assert items.loc['d', 'item_rest_corr'] < 0 < scale['alpha']
+
+    # Pairwise complete observations, like DataFrame.corr()
+    df[rng.random(df.shape) < .1] = np.nan
+    n, cov, corr = pairwise_stats(df)
+    assert np.allclose(corr, df.corr())
+    present = df.notna().to_numpy(dtype=int)
+    assert (n.to_numpy() == present.T @ present).all()
+
+
+def test_pairwise_corr():
+    import numpy as np
+    import pandas as pd
+    from scipy.stats import pearsonr
+    from helpers import pairwise_corr
+
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame(rng.normal(size=(200, 6)), columns=list('abcdef'))
+    df['b'] += df['a'] / 4
+    df[rng.random(df.shape) < .2] = np.nan
+
+    corr, p, n = pairwise_corr(df)
+    assert np.allclose(corr, df.corr())
+    both = df[['a', 'b']].dropna()
+    r, pvalue = pearsonr(both['a'], both['b'])
+    assert np.isclose(corr.loc['a', 'b'], r)
+    assert np.isclose(p.loc['a', 'b'], pvalue)
+    assert n.loc['a', 'b'] == len(both)
+
+    corr32, p32, n32 = pairwise_corr(df, np.float32)
+    assert corr32.dtypes.eq(np.float32).all()
+    assert np.allclose(corr32, corr, atol=1e-5)
+    assert n32.equals(n)
+
+
+def test_agreement():
+    import numpy as np
+    import pandas as pd
+    from helpers import group_moments, icc_oneway, rwg_j
+
+    rng = np.random.default_rng(2)
+    teams = rng.integers(0, 12, size=300)
+    df = pd.DataFrame({'team': teams})
+    for i in range(3):
+        df[f'x_{i}'] = np.clip(np.round(4 + teams / 4 +
+                                        rng.normal(size=300)), 1, 7)
+    df.loc[rng.random(300) < .1, 'x_0'] = np.nan
+
+    sums, squares, n = group_moments(df, 'team', ['x_0', 'x_1', 'x_2'])
+    icc = icc_oneway(sums, squares, n)
+
+    # One-way analysis of variance per column
+    x = df[['team', 'x_0']].dropna()
+    groups = x.groupby('team')['x_0']
+    total, k = len(x), groups.ngroups
+    msb = (groups.size() * (groups.mean() - x['x_0'].mean()) ** 2).sum() / \
+        (k - 1)
+    msw = ((x['x_0'] - groups.transform('mean')) ** 2).sum() / (total - k)
+    k0 = (total - (groups.size() ** 2).sum() / total) / (k - 1)
+    assert np.isclose(icc.loc[0, 'icc1'], (msb - msw) / (msb + (k0 - 1) * msw))
+    assert np.isclose(icc.loc[0, 'icc2'], (msb - msw) / msb)
+
+    variances = df.groupby('team')[['x_1', 'x_2']].var().mean(axis=1)
+    ratio = variances / 4
+    expected = 2 * (1 - ratio) / (2 * (1 - ratio) + ratio)
+    assert np.allclose(rwg_j(variances, 2, 7), expected)
+    assert rwg_j(np.array([0.0, 4.0, 9.0]), 1, 7).tolist() == [1, 0, 0]
+
+
+def test_em_covariance():
+    import numpy as np
+    import pandas as pd
+    from helpers import em_covariance
+
+    rng = np.random.default_rng(3)
+    x = rng.normal(size=500)
+    df = pd.DataFrame({'x': x, 'y': x / 2 + rng.normal(size=500)})
+
+    # Complete data: the maximum likelihood estimates
+    mu, sigma = em_covariance(df)
+    assert np.allclose(mu, df.mean())
+    assert np.allclose(sigma, df.cov(ddof=0))
+
+    # Missing y (depending on x): the mean of y follows from the regression
+    # of y on x in the complete rows
+    df.loc[df['x'] > .5, 'y'] = np.nan
+    mu, sigma = em_covariance(df)
+    complete = df.dropna()
+    slope = complete.cov().loc['x', 'y'] / complete['x'].var()
+    expected = complete['y'].mean() + \
+        slope * (df['x'].mean() - complete['x'].mean())
+    assert np.isclose(mu['y'], expected)
+
+
+def test_grouped_cross_products():
+    import numpy as np
+    from scipy.sparse import csc_matrix
+    from helpers import weighted_cross_products, moments_covariance
+
+    rng = np.random.default_rng(4)
+    z = rng.normal(size=(1000, 5))
+    groups = rng.integers(0, 7, size=1000)
+    members = csc_matrix((np.ones(1000), (groups, np.arange(1000))),
+                         shape=(7, 1000))
+
+    # Small chunks, to add up the cross-products of several chunks
+    sums, products = weighted_cross_products(z, members, chunk_rows=300)
+    n = np.bincount(groups).astype(float)
+    cov = moments_covariance(sums, products, n)
+    for g in range(7):
+        assert np.allclose(cov[g], np.cov(z[groups == g], rowvar=False,
+                                          bias=True))
+
+    # Resample weights: every row counts as often as it was drawn
+    weights = np.bincount(rng.integers(0, 1000, 1000), minlength=1000)
+    sums, products = weighted_cross_products(z, weights[None, :] * 1.0)
+    expected = np.repeat(z, weights, axis=0)
+    assert np.allclose(sums[0], expected.sum(axis=0))
+    assert np.allclose(products[0], expected.T @ expected)
+
+
+def test_write_all_reports(tmp_path):
+    pytest.importorskip('nowpipes')
+    from concurrent.futures import ThreadPoolExecutor
+    from types import SimpleNamespace
+    import config
+    from helpers import sanitize_filename
+    from reports import write_all_reports, write_options
+
+    # The configuration of the reports pipeline, as made by run.py
+    results = SimpleNamespace(setup=SimpleNamespace(
+        executor=ThreadPoolExecutor))
+    reports_config = config.reports | dict(
+        results=results, sanitize=sanitize_filename, reload=False,
+        outputdir=str(tmp_path) + '/', incremental=False,
+        log_timings=False)
+
+    options = write_options(reports_config)
+    assert 'results' not in options and 'sanitize' not in options
+    assert options['outputdir'] == reports_config['outputdir']
+
+    write_all_reports(results, [], **options)
+
+
+def test_time_reports(tmp_path, monkeypatch):
+    pytest.importorskip('nowpipes')
+    from concurrent.futures import ThreadPoolExecutor
+    import reports
+    from scaling import time_reports, REPORT_STAGES
+
+    # The report stages and the PDF writer without templates and weasyprint
+    monkeypatch.setattr(reports, 'setup',
+                        lambda **p: dict(executor=ThreadPoolExecutor))
+    for name in REPORT_STAGES[1:]:
+        monkeypatch.setattr(reports, name, lambda setup, name=name, **p: name)
+    written = dict()
+    monkeypatch.setattr(reports, 'write_reports',
+                        lambda *args, **kw: written.update(args=args, kw=kw))
+
+    timed = []
+
+    def profiler(stage, call, inputs, p):
+        timed.append(stage.name)
+        return call()
+
+    outputdir = str(tmp_path) + '/'
+    time_reports(dict(), outputdir, profiler)
+
+    assert set(timed[:-1]) == set(REPORT_STAGES)
+    assert timed[-1] == 'write_all_reports'
+    htmls, fpath, _ = written['args']
+    assert fpath == outputdir
+    assert set(htmls) == {n[:-len('_reports')] for n in REPORT_STAGES[2:]}
+    assert written['kw']['org_report'] == 'org_report'
+    assert written['kw']['Executor'] is ThreadPoolExecutor
+
+
+def test_entity_models():
+    pytest.importorskip('nowpipes')
+    from types import SimpleNamespace
+    import numpy as np
+    import pandas as pd
+    from models import cov_regression, entity_models, entity_weights
+
+    rng = np.random.default_rng(5)
+    team = np.repeat(['x', 'y', 'z'], [300, 200, 20])
+    df = pd.DataFrame(rng.normal(size=(len(team), 2)), columns=['a', 'b'])
+    df['c'] = .5 * df['a'] + .3 * df['b'] + rng.normal(size=len(team))
+    df['team'] = team
+    df.loc[[3, 310], 'b'] = np.nan
+
+    table = pd.DataFrame({'model': 'm', 'iv': ['a', 'b'], 'dv': 'c',
+                          'dvcluster': 'D', 'ivcluster': 'I'})
+    research_model = pd.DataFrame({'grade_name': ['a', 'b', 'c']})
+    r = entity_models(SimpleNamespace(use=df), research_model,
+                      SimpleNamespace(all=SimpleNamespace(table=table)),
+                      models_p_value=1.0, entity_model_nestings=('team',),
+                      entity_models_min_n=100)
+
+    # Only the large teams get their own models, estimated like
+    # cov_regression() on their own respondents
+    t = r['table']['team']
+    assert set(t['value']) == {'x', 'y'}
+    for value in ('x', 'y'):
+        rows = df[df['team'] == value][['a', 'b', 'c']].dropna()
+        cov = pd.DataFrame(np.cov(rows, rowvar=False, bias=True),
+                           index=rows.columns, columns=rows.columns)
+        est = cov_regression(['c'], ['a', 'b'], cov, len(rows))['estimates']
+        est = est[est['op'] == '~']
+        fit = t[t['value'] == value]
+        assert fit['n'].tolist() == [len(rows)] * 2
+        assert fit['iv'].tolist() == est['rval'].tolist()
+        assert np.allclose(fit['est'], est['Estimate'])
+        assert np.allclose(fit['p'], est['p-value'])
+
+    # Teams without their own models get the pooled weights
+    pooled = pd.Series({'a': .4, 'b': .2})
+    values = pd.Series(['z', 'x', 'y'], index=[7, 8, 9])
+    weights = entity_weights(values, r['ivstats']['team'], pooled,
+                             'mean_est')
+    own = r['ivstats']['team'].set_index(['value', 'iv'])['mean_est']
+    assert weights.index.tolist() == [7, 8, 9]
+    assert weights.loc[7].tolist() == pooled.tolist()
+    assert weights.loc[8].tolist() == [own['x', 'a'], own['x', 'b']]
+    with pytest.raises(ValueError):
+        entity_weights(values, r['ivstats']['team'], pooled, 'mean_rank')
+
+
+def test_bootstrap():
+    pytest.importorskip('nowpipes')
+    from types import SimpleNamespace
+    import numpy as np
+    import pandas as pd
+    from helpers import weighted_cross_products, moments_covariance
+    from models import (grade_covariance, cov_regression, model_table,
+                        model_iv_stats, model_specs)
+    from bootstrap import bootstrap, resample_weights
+
+    rng = np.random.default_rng(6)
+    df = pd.DataFrame(rng.normal(size=(400, 2)), columns=['a', 'b'])
+    df['c'] = .5 * df['a'] + .3 * df['b'] + rng.normal(size=400)
+    df['d'] = .4 * df['a'] + .05 * df['b'] + rng.normal(size=400)
+    df['team'] = rng.integers(0, 5, size=400)
+    grades = ['a', 'b', 'c', 'd']
+
+    # The models of the pairwise estimator (see models.models())
+    cov = grade_covariance(df[grades], 'pairwise')
+    tables, ivstats = [], []
+    for name, ivs, dvs in (('m1', ['a', 'b'], ['c', 'd']),
+                           ('m2', ['a'], ['d'])):
+        sem = cov_regression(dvs, ivs, cov, len(df))
+        tables.append(model_table(sem, .05, 'D', 'I', name))
+        ivstats.append(model_iv_stats(tables[-1], 'D', 'I', name))
+    overall = pd.concat(ivstats).groupby('iv')[['mean_est', 'max_est']].mean()
+    models = SimpleNamespace(all=SimpleNamespace(table=pd.concat(tables)),
+                             overall=SimpleNamespace(ivstats=overall))
+
+    # A resample that draws every respondent once is the observed data
+    z = df[grades].to_numpy() - df[grades].to_numpy().mean(axis=0)
+    sums, products = weighted_cross_products(z, np.ones((1, len(z))))
+    n = np.array([float(len(z))])
+    specs = [(ivpos, dvpos, ivpos)
+             for _, ivpos, dvpos in model_specs(models.all.table, grades)]
+    for weigh_by in ('mean_est', 'max_est'):
+        weights = resample_weights(moments_covariance(sums, products, n), n,
+                                   specs, 2, .05, weigh_by)
+        assert np.allclose(weights[0], overall[weigh_by], rtol=0,
+                           atol=1e-15)
+
+    # The results only depend on the seed, not on the number of workers
+    growth = pd.DataFrame(rng.random((5, 2)), columns=['a', 'b'])
+    growth['value'] = growth['code'] = range(5)
+    p = dict(bootstrap_resamples=120, models_p_value=.05, nestings=['team'],
+             advice_n=1)
+
+    def run(**params):
+        return bootstrap(SimpleNamespace(use=df),
+                         pd.DataFrame({'grade_name': grades}), models,
+                         dict(team=growth), dict(team=growth), **p, **params)
+
+    one = run(bootstrap_workers=1, bootstrap_seed=3)
+    three = run(bootstrap_workers=3, bootstrap_seed=3)
+    other = run(bootstrap_workers=1, bootstrap_seed=4)
+    assert one['weights'].shape == (120, 2)
+    pd.testing.assert_frame_equal(one['weights'], three['weights'])
+    pd.testing.assert_frame_equal(one['frequency']['team'],
+                                  three['frequency']['team'])
+    assert not one['weights'].equals(other['weights'])
+    assert one['summary'].index.tolist() == ['a', 'b']
+
+
+def test_cov_regression():
+    pytest.importorskip('nowpipes')
+    pytest.importorskip('semopy')
+    import numpy as np
+    import pandas as pd
+    from models import (sem_regression, cov_regression, grade_covariance,
+                        model_table)
+
+    rng = np.random.default_rng(7)
+    df = pd.DataFrame(rng.normal(size=(500, 2)), columns=['a', 'b'])
+    df['c'] = .5 * df['a'] + .3 * df['b'] + rng.normal(size=500)
+    df['d'] = .4 * df['a'] + rng.normal(size=500)
+
+    sem = sem_regression(['c', 'd'], ['a', 'b'], df)
+    cov = cov_regression(['c', 'd'], ['a', 'b'],
+                         grade_covariance(df, 'pairwise'), len(df))
+    columns = ['lval', 'op', 'rval', 'Estimate', 'Std. Err', 'z-value',
+               'p-value']
+    assert sem['estimates'].columns.tolist() == columns
+    assert cov['estimates'].columns.tolist() == columns
+
+    # The same estimates, up to the precision of the semopy optimizer
+    expected = sem['estimates'].set_index(['lval', 'op', 'rval'])
+    estimates = cov['estimates'].set_index(['lval', 'op', 'rval'])
+    assert estimates.index.equals(expected.index)
+    assert np.allclose(estimates, expected.astype(float), rtol=1e-3,
+                       atol=1e-3)
+
+    tables = [model_table(r, .05, 'D', 'I', 'm') for r in (sem, cov)]
+    assert tables[1].columns.tolist() == tables[0].columns.tolist()
+    assert tables[1]['issig'].tolist() == tables[0]['issig'].tolist()
+
+
+def test_signs():
+    pytest.importorskip('nowpipes')
+    from types import SimpleNamespace
+    import pandas as pd
+    from models import signs
+
+    rows = [('m1', 'x', 'c', 1.), ('m1', 'x', 'd', 1.), ('m1', 'y', 'c', -1.),
+            ('m1', 'y', 'd', 0.), ('m2', 'y', 'c', 1.), ('m2', 'x', 'c', 1.),
+            ('m2', 'z', 'c', 0.)]
+    table = pd.DataFrame(rows, columns=['model', 'iv', 'dv', 'direction'])
+    table['dvcluster'] = 'D'
+    table['issig'] = table['direction'] != 0
+    research_model = pd.DataFrame({'grade_name': ['x', 'y', 'z'],
+                                   'direction': [1, -1, 1]})
+
+    def run(table, engine):
+        models = SimpleNamespace(all=SimpleNamespace(table=table),
+                                 by_dvcluster={'D': None})
+        return signs(research_model, models, engine=engine)['by_dvcluster']
+
+    # Model m2 has no negative estimates, so negative is a float column
+    fast, reference = run(table, 'fast'), run(table, 'reference')
+    assert fast['D'].columns.tolist() == [
+        'negative', 'positive', 'model', 'grade_name', 'majority',
+        'direction']
+    assert fast['D']['negative'].dtype == 'float64'
+    pd.testing.assert_frame_equal(fast['D'], reference['D'])
+
+    # Without any negative estimates (the reference crosstab has no negative
+    # column there)
+    fast = run(table[table['direction'] >= 0], 'fast')
+    expected = pd.DataFrame({'positive': [2, 1, 1],
+                             'model': ['m1', 'm2', 'm2'],
+                             'grade_name': ['x', 'x', 'y'],
+                             'majority': [1, 1, 1], 'direction': [1, 1, -1]})
+    pd.testing.assert_frame_equal(fast['D'], expected)
+
+
+def test_advice():
+    pytest.importorskip('nowpipes')
+    from types import SimpleNamespace
+    import numpy as np
+    import pandas as pd
+    from entities import advice
+
+    rng = np.random.default_rng(0)
+    names = ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+    growth = pd.DataFrame(rng.random((4, len(names))), columns=names)
+    signs = SimpleNamespace(by_dvcluster={'D': pd.DataFrame({
+        'grade_name': names, 'majority': 1, 'direction': 1})})
+    models = SimpleNamespace(by_dvcluster={'D': pd.DataFrame({
+        'iv': names, 'estabs': rng.random(len(names))})})
+
+    class Results(dict):
+        __getattr__ = dict.__getitem__
+
+    weighted_growth = Results(team=growth,
+                              by_dvcluster={'D': {'team': growth}})
+
+    # Team and dvcluster advice both have advice_n rows per entry, in both
+    # engines
+    results = [advice(None, models, weighted_growth, signs, nestings=['team'],
+                      advice_n=3, engine=engine)
+               for engine in ('reference', 'fast')]
+    for r in results:
+        for team in (r['team'], r['by_dvcluster']['D']['team']):
+            assert [len(entry) for entry in team] == [3] * len(growth)
+    reference, fast = results
+    for entry, expected in zip(fast['team'], reference['team']):
+        pd.testing.assert_frame_equal(entry, expected)
+        assert entry['score'].tolist() == sorted(entry['score'],
+                                                 reverse=True)
+
+
+def test_stage_cache(tmp_path):
+    import importlib.util
+    from types import SimpleNamespace
+    from memo import StageCache
+
+    # A stage module and an input file
+    source = tmp_path / 'stagemodule.py'
+    source.write_text('def load(**p):\n    return 1\n')
+    spec = importlib.util.spec_from_file_location('stagemodule', source)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    (tmp_path / 'hr.csv').write_text('a,b\n1,2\n')
+
+    stage = SimpleNamespace(name='load', module=module, args=(),
+                            params=('datapath', 'hrfile', 'cutoff'),
+                            mutates=())
+    calls = []
+
+    def run(**params):
+        """Run the stage with a new cache (as in a new run); whether its
+        result came from the cache."""
+        cache = StageCache(str(tmp_path) + '/')
+        p = dict(datapath=str(tmp_path) + '/', hrfile='hr.csv', cutoff=.7,
+                 other=1) | params
+        cache(stage, lambda: calls.append(1), {}, p)
+        return cache.hits == ['load']
+
+    assert run() is False
+    assert run() is True
+    # A parameter that the stage does not read
+    assert run(other=2) is True
+    # A parameter that the stage reads
+    assert run(cutoff=.8) is False
+    assert run() is True
+    # The contents of an input file
+    (tmp_path / 'hr.csv').write_text('a,b\n1,3,4\n')
+    assert run() is False
+    assert run() is True
+    # The source of the stage
+    source.write_text('def load(**p):\n    return 10\n')
+    assert run() is False
+    assert run() is True
+    assert len(calls) == 4
+
+    # Results that can not be pickled completely (like semopy models, which
+    # hold lambdas) are not cached
+    class Model:
+        def __init__(self):
+            self.objective = lambda x: x
+
+    stage = SimpleNamespace(name='fit', module=module, args=(), params=(),
+                            mutates=())
+    for _ in range(2):
+        cache = StageCache(str(tmp_path) + '/')
+        result = cache(stage, lambda: dict(model=Model()), {}, {})
+        assert cache.misses == ['fit'] and result['model'] is not None
+
+
+STAGE_MODULE = """
+import time
+
+
+def load(**p):
+    return dict(rows=[1, 2, 3])
+
+
+def count(load, **p):
+    time.sleep(.05)
+    return len(load)
+
+
+def extend(load, **p):
+    time.sleep(.05)
+    load['total'] = sum(load['rows'])
+    return True
+
+
+def other(**p):
+    time.sleep(.05)
+    return p['factor']
+
+
+def report(load, extend, other, **p):
+    return load['total'] * other
+"""
+
+
+def test_run_stages(tmp_path):
+    import importlib.util
+    import threading
+    import time
+    from types import SimpleNamespace
+    import dag
+
+    source = tmp_path / 'dagstages.py'
+    source.write_text(STAGE_MODULE)
+    spec = importlib.util.spec_from_file_location('dagstages', source)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    def stage(name, args=(), mutates=()):
+        return SimpleNamespace(name=name, module=module, args=args,
+                               params=None, mutates=mutates)
+
+    # Like scale_means, extend adds to the result of load in place
+    all_stages = [stage('load'), stage('count', ('load',)),
+                  stage('extend', ('load',), ('load',)), stage('other'),
+                  stage('report', ('load', 'extend', 'other'))]
+
+    lock = threading.Lock()
+    spans = dict()
+
+    def timed(stage, call, inputs, p):
+        start = time.perf_counter()
+        result = call()
+        with lock:
+            spans[stage.name] = (start, time.perf_counter())
+        return result
+
+    concurrent = dag.run_stages(all_stages, dict(factor=2), timed, workers=4,
+                                verbose=False)
+    sequential = dag.run_stages(all_stages, dict(factor=2), workers=1,
+                                verbose=False)
+    assert concurrent == sequential
+    assert concurrent['count'] == 1 and concurrent['report'] == 12
+
+    # The stage that modifies load never runs at the same time as the
+    # other stages that read it
+    start, end = spans['extend']
+    for name in ('count', 'report'):
+        assert spans[name][1] <= start or end <= spans[name][0]
+    # Independent stages do run at the same time
+    assert spans['other'][0] < spans['count'][1] and \
+        spans['count'][0] < spans['other'][1]
+
+
+def test_stage_mutates():
+    pytest.importorskip('nowpipes')
+    import ast
+    from stages import stage_mutates
+
+    source = """
+def assigns(data, research_model, **p):
+    data['use'] = data.use.dropna()
+
+def aliased(weighted_growth, **p):
+    rank = weighted_growth.by_model.rank
+    rank.sort_values('x', inplace=True)
+
+def calls(growth, models, scores, **p):
+    growth.update(other=1)
+    models.all.table.insert(0, 'x', 1)
+    scores.values().sort()
+    return len(p.get('nestings', []))
+
+def reads(data, models, **p):
+    table = models.all.table.copy()
+    table.update(x=1)
+    return data.use.append(table)
+"""
+    nodes = {node.name: node for node in ast.parse(source).body}
+    assert stage_mutates(nodes['assigns']) == ('data',)
+    assert stage_mutates(nodes['aliased']) == ('weighted_growth',)
+    assert stage_mutates(nodes['calls']) == ('growth', 'models')
+    # append returns a new DataFrame, but the list method of the same name
+    # does not, so data counts as modified
+    assert stage_mutates(nodes['reads']) == ('data',)
+
+
+def test_analysis_dependencies():
+    pytest.importorskip('nowpipes')
+    import dag
+    import stages
+    from analysis import analysis_parts
+
+    all_stages = [stage for part in analysis_parts()
+                  for stage in stages.pipe_stages(part)]
+    mutates = {stage.name: stage.mutates for stage in all_stages}
+    assert 'data' in mutates['scale_means']
+
+    # The stages that read a result which another stage modifies in place
+    # run before or after that stage, never at the same time
+    deps = dag.stage_dependencies(all_stages)
+    for mutator in all_stages:
+        for reader in all_stages:
+            if reader is mutator or \
+                    not set(mutator.mutates) & set(reader.args):
+                continue
+            assert reader.name in deps[mutator.name] or \
+                mutator.name in deps[reader.name]
+
+
+def test_slim_sem():
+    pytest.importorskip('nowpipes')
+    pytest.importorskip('semopy')
+    from types import SimpleNamespace
+    import numpy as np
+    import pandas as pd
+    from models import sem_regression, slim_sem
+    from profiler import StageProfiler, semopy_size
+
+    rng = np.random.default_rng(8)
+    df = pd.DataFrame(rng.normal(size=(200, 3)), columns=['a', 'b', 'c'])
+    sem = sem_regression(['c'], ['a', 'b'], df)
+    slim = slim_sem(sem)
+    assert 'model' not in slim and 'fit' not in slim
+    assert slim['slimmed_size'] == semopy_size(sem) > 0
+
+    # The profiler reports the size that slim_models saved per stage
+    profiler = StageProfiler('')
+    stage = SimpleNamespace(name='models', module=SimpleNamespace(
+        __name__='models'))
+    profiler(stage, lambda: dict(m1=slim, m2=slim_sem(sem)), {}, {})
+    record = profiler.records[0]
+    assert record['semopy_size'] == 0
+    assert record['slimmed_size'] == 2 * slim['slimmed_size']
+
+
+def test_stage_imports():
+    pytest.importorskip('nowpipes')
+    import ast
+    import os
+    import sysconfig
+    from importlib.util import find_spec
+    from analysis import analysis_parts, STAGE_IMPORTS
+    from memo import package_imports
+
+    def is_stdlib(name):
+        origin = find_spec(name).origin
+        return origin in ('built-in', 'frozen') or (
+            origin.startswith(sysconfig.get_paths()['stdlib']) and
+            'site-packages' not in origin)
+
+    # Every package that a stage (or a function it calls) imports where it
+    # is used is imported before stages run concurrently
+    fnames = set(fname for part in analysis_parts()
+                 for fname in package_imports(part))
+    package = set(os.path.basename(fname)[:-3] for fname in fnames)
+    lazy = set()
+    for fname in fnames:
+        with open(fname) as f:
+            tree = ast.parse(f.read())
+        for function in ast.walk(tree):
+            if not isinstance(function, ast.FunctionDef):
+                continue
+            for node in ast.walk(function):
+                if isinstance(node, ast.Import):
+                    lazy.update(alias.name for alias in node.names)
+                elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                    lazy.add(node.module)
+    lazy = set(name for name in lazy if name.split('.')[0] not in package
+               and not is_stdlib(name.split('.')[0]))
+    assert lazy == set(STAGE_IMPORTS)